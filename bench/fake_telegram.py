@@ -0,0 +1,219 @@
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов.
+
+  python bench/fake_telegram.py [--port 8081] [--latency-ms 30] [--jitter-ms 10] [--p429 0.01]
+
+Бот направляется сюда через TELEGRAM_API_URL=http://127.0.0.1:8081.
+Реализованы getUpdates (long polling), sendMessage, getChatMember, getMe, sendDocument, sendPhoto;
+после setWebhook апдейты не копятся для getUpdates, а отправляются POST-ом на вебхук (deleteWebhook — обратно).
+На остальные методы (answerCallbackQuery, editMessageText, ...) отвечает ok.
+Задержка ответа — latency ± jitter; с вероятностью p429 исходящие методы отвечают
+429 "retry after", как настоящий API при превышении лимитов.
+
+Из кода (bench/loadtest.py): push_message/push_callback кладут апдейты в очередь getUpdates,
+wait_replies ждёт, пока бот ответит в чат нужное число раз.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import ClientSession, web
+
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+SEND_METHODS = {"sendmessage", "senddocument", "sendphoto", "editmessagetext", "answercallbackquery"}
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, p429=0.0, retry_after=1, seed=None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+        self.updates = []  # очередь для getUpdates
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_updates = asyncio.Event()
+        self.replies = {}  # chat_id -> asyncio.Queue[(method, payload)]
+        self.calls = {}  # method -> число вызовов
+        self.injected_429 = 0
+        self.webhook = None  # (url, secret_token)
+        self.webhook_errors = 0
+        self.http = None
+        self.runner = None
+
+    # --- апдейты от "пользователей" ---
+
+    def _push(self, update):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        if self.webhook:
+            asyncio.get_running_loop().create_task(self._deliver(update))
+            return
+        self.updates.append(update)
+        self.new_updates.set()
+
+    async def _deliver(self, update):
+        url, secret = self.webhook
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        try:
+            async with self.http.post(url, json=update, headers=headers) as resp:
+                if resp.status != 200:
+                    self.webhook_errors += 1
+        except Exception:
+            self.webhook_errors += 1
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+    def _message(self, chat_id, text, from_user):
+        self.next_message_id += 1
+        return {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": from_user,
+            "text": text,
+        }
+
+    def push_message(self, user_id, text):
+        msg = self._message(user_id, text, self._user(user_id))
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._push({"message": msg})
+
+    def push_callback(self, user_id, data):
+        self._push({"callback_query": {
+            "id": f"cb{self.next_update_id}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, "Главное меню:", BOT_USER),
+        }})
+
+    def _queue(self, chat_id):
+        q = self.replies.get(chat_id)
+        if q is None:
+            q = self.replies[chat_id] = asyncio.Queue()
+        return q
+
+    async def wait_replies(self, chat_id, count, timeout):
+        """Ждёт count ответов бота в чат; возвращает их список (может быть короче при таймауте)."""
+        q = self._queue(chat_id)
+        got = []
+        deadline = time.perf_counter() + timeout
+        while len(got) < count:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                break
+            try:
+                got.append(await asyncio.wait_for(q.get(), left))
+            except asyncio.TimeoutError:
+                break
+        return got
+
+    # --- HTTP ---
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        if method == "getupdates":
+            return await self._get_updates(params)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.rnd.uniform(-self.jitter, self.jitter)))
+        if method in SEND_METHODS and self.p429 and self.rnd.random() < self.p429:
+            self.injected_429 += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method, params):
+        if method == "getme":
+            return BOT_USER
+        if method == "setwebhook":
+            self.webhook = (params["url"], params.get("secret_token"))
+            return True
+        if method == "deletewebhook":
+            self.webhook = None
+            return True
+        if method == "getchatmember":
+            return {"status": "member", "user": self._user(int(params.get("user_id", 0)))}
+        if method in ("sendmessage", "senddocument", "sendphoto", "editmessagetext"):
+            chat_id = int(params["chat_id"])
+            msg = self._message(chat_id, params.get("text", ""), BOT_USER)
+            if method == "senddocument":
+                doc = params.get("document")
+                msg["document"] = {"file_id": f"f{msg['message_id']}", "file_unique_id": f"u{msg['message_id']}",
+                                   "file_name": getattr(doc, "filename", None)}
+                del msg["text"]
+            if method == "sendphoto":
+                msg["photo"] = [{"file_id": f"p{msg['message_id']}", "file_unique_id": f"up{msg['message_id']}",
+                                 "width": 800, "height": 350}]
+                msg["caption"] = params.get("caption", "")
+                del msg["text"]
+            if method != "editmessagetext":
+                self._queue(chat_id).put_nowait((method, msg))
+            return msg
+        return True
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return web.json_response({"ok": True, "result": self.updates[:limit]})
+
+    async def _on_startup(self, app):
+        self.http = ClientSession()  # для доставки на вебхук
+
+    async def _on_cleanup(self, app):
+        await self.http.close()
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host=host, port=port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+def run():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency-ms", type=float, default=0)
+    ap.add_argument("--jitter-ms", type=float, default=0)
+    ap.add_argument("--p429", type=float, default=0)
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+    fake = FakeTelegram(args.latency_ms, args.jitter_ms, args.p429, seed=args.seed)
+    print(json.dumps(vars(args)))
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    run()
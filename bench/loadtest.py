@@ -0,0 +1,245 @@
+"""
+Нагрузочный тест бота целиком: aiogram-поллинг + БД + HTTP API против фейкового Bot API.
+
+  python bench/loadtest.py [-n 500] [--concurrency 50] [--ref-ratio 0.5]
+                           [--latency-ms 30] [--jitter-ms 10] [--p429 0]
+                           [--redeem-concurrency 8] [--seed 1]
+                           [--mode polling|webhook] [--out result.json] [--compare prev.json]
+
+Поднимает bench/fake_telegram.py на --tg-port, направляет на него бота (TELEGRAM_API_URL),
+запускает main.main() на временной БД: API на --api-port, апдейты — поллингом или
+вебхуком на том же порту (--mode). Синтетический пользователь проходит:
+  start     — /start (с вероятностью --ref-ratio по реф-ссылке одного из предыдущих);
+  get_token — кнопка "Получить токен": сообщение с токеном + документ с конфигом;
+  my_tokens — кнопка "Мои токены".
+Задержка шага — от отправки апдейта до последнего ожидаемого ответа бота в чат.
+Параллельно --redeem-concurrency клиентов долбят POST /redeem: половина запросов — выданные
+токены (первый раз redeemed, дальше already_used), половина — несуществующие.
+
+Результаты сравнимы между прогонами: все случайности от --seed, каждый прогон на новой БД,
+параметры и git-ревизия пишутся в JSON. --compare печатает разницу с прошлым результатом.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-n", type=int, default=500, help="синтетических пользователей")
+ap.add_argument("--concurrency", type=int, default=50, help="пользователей одновременно")
+ap.add_argument("--ref-ratio", type=float, default=0.5)
+ap.add_argument("--think-ms", type=float, default=0, help="пауза между шагами пользователя")
+ap.add_argument("--latency-ms", type=float, default=30, help="задержка фейкового Bot API")
+ap.add_argument("--jitter-ms", type=float, default=10)
+ap.add_argument("--p429", type=float, default=0, help="доля ответов 429 на исходящие методы")
+ap.add_argument("--redeem-concurrency", type=int, default=8)
+ap.add_argument("--step-timeout", type=float, default=10)
+ap.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+ap.add_argument("--seed", type=int, default=1)
+ap.add_argument("--tg-port", type=int, default=18081)
+ap.add_argument("--api-port", type=int, default=15001)
+ap.add_argument("--out", help="сохранить результат в JSON")
+ap.add_argument("--compare", help="сравнить с прошлым JSON")
+args = ap.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix="bench_load_")
+os.environ["DB_PATH"] = os.path.join(tmpdir, "bench.db")
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.tg_port}"
+os.environ["API_HOST"] = "127.0.0.1"
+os.environ["API_PORT"] = str(args.api_port)
+os.environ["BOT_MODE"] = args.mode
+os.environ["WEBHOOK_URL"] = f"http://127.0.0.1:{args.api_port}"
+os.environ["TOKENS_PER_DAY_LIMIT"] = "1000000"  # лимит не должен менять число ответов бота
+# все клиенты /redeem идут с одного адреса и одного JWT — лимиты перебора меряли бы сами себя
+os.environ.setdefault("REDEEM_IP_RATE", "0")
+os.environ.setdefault("REDEEM_JWT_RATE", "0")
+os.environ["WG_CLIENT_SUBNET"] = "10.0.0.0/8"
+os.environ.setdefault("ADMIN_IDS", "1")
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import main  # noqa: E402
+from aiohttp import ClientSession  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+STEPS = ("start", "get_token", "my_tokens")
+USER_BASE = 10_000_000
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(latencies, duration, errors=0):
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+        "per_s": round(len(latencies) / duration, 1) if duration else None,
+    }
+
+
+class Scenario:
+    def __init__(self, fake):
+        self.fake = fake
+        self.rnd = random.Random(args.seed)
+        self.lat = {s: [] for s in STEPS}
+        self.timeouts = {s: 0 for s in STEPS}
+        self.tokens = []  # выданные токены — для /redeem
+        self.started_users = []
+        self.done = False
+
+    async def step(self, name, uid, push, expect):
+        t0 = time.perf_counter()
+        push()
+        got = await self.fake.wait_replies(uid, expect, args.step_timeout)
+        if len(got) < expect:
+            self.timeouts[name] += 1
+            return got
+        self.lat[name].append(time.perf_counter() - t0)
+        return got
+
+    async def user(self, i, ref_by):
+        uid = USER_BASE + i
+        text = f"/start ref{ref_by}" if ref_by else "/start"
+        await self.step("start", uid, lambda: self.fake.push_message(uid, text), 1)
+        self.started_users.append(uid)
+        await asyncio.sleep(args.think_ms / 1000)
+        got = await self.step("get_token", uid, lambda: self.fake.push_callback(uid, "get_token"), 2)
+        for method, msg in got:
+            if method == "sendmessage" and "`" in msg.get("text", ""):
+                self.tokens.append(msg["text"].split("`")[1])
+        await asyncio.sleep(args.think_ms / 1000)
+        await self.step("my_tokens", uid, lambda: self.fake.push_callback(uid, "my_tokens"), 1)
+
+    async def users(self):
+        sem = asyncio.Semaphore(args.concurrency)
+        # реф-ссылки выбираются заранее, чтобы не зависеть от порядка завершения корутин
+        plan = [USER_BASE + self.rnd.randrange(i) if i and self.rnd.random() < args.ref_ratio else None
+                for i in range(args.n)]
+
+        async def one(i):
+            async with sem:
+                await self.user(i, plan[i])
+
+        await asyncio.gather(*(one(i) for i in range(args.n)))
+        self.done = True
+
+
+async def hammer_redeem(scenario, worker, stats):
+    rnd = random.Random(args.seed * 1000 + worker)
+    url = f"http://127.0.0.1:{args.api_port}/redeem"
+    jwt_token = main.issue_server_jwt(f"bench-{worker}")
+    async with ClientSession() as http:
+        while not scenario.done:
+            if scenario.tokens and rnd.random() < 0.5:
+                token = rnd.choice(scenario.tokens)
+            else:
+                token = secrets.token_urlsafe(main.DEFAULT_TOKEN_BYTES)
+            t0 = time.perf_counter()
+            try:
+                async with http.post(url, json={"jwt": jwt_token, "token": token}) as resp:
+                    body = await resp.json()
+            except Exception:
+                stats["errors"] += 1
+                continue
+            stats["lat"].append(time.perf_counter() - t0)
+            code = body.get("status") if body.get("ok") else body.get("error")
+            stats["codes"][code] = stats["codes"].get(code, 0) + 1
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+async def bench():
+    fake = FakeTelegram(args.latency_ms, args.jitter_ms, args.p429, seed=args.seed)
+    await fake.start(port=args.tg_port)
+    main.dp.start_polling = functools.partial(main.dp.start_polling, handle_signals=False)
+    bot_task = asyncio.create_task(main.main())
+    # бот готов, когда начал забирать апдейты или поставил вебхук
+    while not (fake.calls.get("getupdates") or fake.webhook):
+        if bot_task.done():
+            bot_task.result()
+        await asyncio.sleep(0.05)
+
+    scenario = Scenario(fake)
+    redeem = {"lat": [], "errors": 0, "codes": {}}
+    t0 = time.perf_counter()
+    hammers = [asyncio.create_task(hammer_redeem(scenario, w, redeem)) for w in range(args.redeem_concurrency)]
+    await scenario.users()
+    duration = time.perf_counter() - t0
+    await asyncio.gather(*hammers)
+
+    if args.mode == "polling":
+        await main.dp.stop_polling()
+    else:
+        bot_task.cancel()
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    await fake.stop()
+
+    updates = sum(len(v) + scenario.timeouts[k] for k, v in scenario.lat.items())
+    return {
+        "config": vars(args) | {"python": platform.python_version(), "git": git_rev()},
+        "duration_s": round(duration, 3),
+        "users_per_s": round(args.n / duration, 1),
+        "updates_per_s": round(updates / duration, 1),
+        "steps": {s: summarize(scenario.lat[s], duration, scenario.timeouts[s]) for s in STEPS},
+        "redeem": summarize(redeem["lat"], duration, redeem["errors"]) | {"codes": redeem["codes"]},
+        "fake_api": {"calls": fake.calls, "injected_429": fake.injected_429, "webhook_errors": fake.webhook_errors},
+    }
+
+
+def print_report(res, prev=None):
+    def delta(cur, old, key):
+        if not prev or old is None or cur.get(key) is None or old.get(key) in (None, 0):
+            return ""
+        return f" ({(cur[key] - old[key]) / old[key] * 100:+.0f}%)"
+
+    print(f"{'':<10} {'count':>7} {'err':>5} {'p50 ms':>16} {'p99 ms':>16} {'per s':>16}")
+    rows = [(s, res["steps"][s], prev and prev["steps"].get(s)) for s in STEPS]
+    rows.append(("redeem", res["redeem"], prev and prev.get("redeem")))
+    for name, cur, old in rows:
+        cells = [f"{cur[k]}{delta(cur, old, k)}" for k in ("p50_ms", "p99_ms", "per_s")]
+        print(f"{name:<10} {cur['count']:>7} {cur['errors']:>5} {cells[0]:>16} {cells[1]:>16} {cells[2]:>16}")
+    print(f"users/s {res['users_per_s']}{delta(res, prev, 'users_per_s')}   "
+          f"updates/s {res['updates_per_s']}{delta(res, prev, 'updates_per_s')}   "
+          f"429 injected {res['fake_api']['injected_429']}   ({res['duration_s']} s)")
+    if prev:
+        changed = {k: (prev["config"].get(k), v) for k, v in res["config"].items()
+                   if k not in ("out", "compare", "git") and prev["config"].get(k) != v}
+        if changed:
+            print(f"ВНИМАНИЕ: параметры отличаются от {args.compare}: {changed}")
+
+
+if __name__ == "__main__":
+    result = asyncio.run(bench())
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(result, previous)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,100 @@
+"""
+Бенчмарк регистраций с реферальной наградой: signups/s.
+
+  python bench/signups.py [-n 2000] [--reward 1] [--concurrency 50] [--shards 1] [--group-max 256]
+
+Сравнивает на временной БД:
+  - before: прежний порядок /start — register_user и credit_referral_for отдельными заходами
+    в поток-писатель, каждый токен награды — своя транзакция;
+  - single: signup — регистрация и награда одной транзакцией, токены награды одним executemany,
+    но транзакция на каждый /start (GROUP_COMMIT_MAX=1);
+  - group: signup с групповым коммитом — одна транзакция на пачку до --group-max регистраций;
+    с --shards N пользователи раскладываются по N файлам, у каждого свой поток-писатель.
+Каждый новый пользователь приходит по реф-ссылке предыдущего.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-n", type=int, default=2000)
+ap.add_argument("--reward", type=int, default=1)
+ap.add_argument("--concurrency", type=int, default=50)
+ap.add_argument("--shards", type=int, default=1)
+ap.add_argument("--group-max", type=int, default=256, help="GROUP_COMMIT_MAX для прогона group")
+args = ap.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix="bench_signups_")
+os.environ["DB_PATH"] = os.path.join(tmpdir, "bench.db")
+os.environ["REF_REWARD"] = str(args.reward)
+os.environ["DB_SHARDS"] = str(args.shards)
+os.environ["WG_CLIENT_SUBNET"] = "10.0.0.0/8"
+os.environ["IPAM_MAX_HOSTS"] = str(4 * args.n * (args.reward + 1) + 16)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def legacy_credit(new_user):
+    # прежний credit_referral_for: счётчик и отметка в одной транзакции, каждый токен — в своей
+    conn = main.get_conn()
+    row = conn.execute("SELECT ref_by, credited FROM referrals WHERE new_user=?", (new_user,)).fetchone()
+    if not row or row[1]:
+        return False, None
+    ref_by = row[0]
+    if not conn.execute("SELECT user_id FROM users WHERE user_id=?", (ref_by,)).fetchone():
+        return False, ref_by
+    conn.execute("UPDATE users SET refs_count = refs_count + 1 WHERE user_id=?", (ref_by,))
+    conn.commit()
+    for _ in range(main.REF_REWARD):
+        with conn:
+            main._insert_tokens(conn, ref_by, 1)
+    conn.execute("UPDATE referrals SET credited=1 WHERE new_user=?", (new_user,))
+    conn.commit()
+    return True, ref_by
+
+
+async def before(uid, ref_by):
+    if await main.db_write(main.register_user, uid, ref_by):
+        await main.db_write(legacy_credit, uid)
+
+
+async def after(uid, ref_by):
+    await main.signup(uid, ref_by)
+
+
+async def run(name, fn, base, group_max=None):
+    sem = asyncio.Semaphore(args.concurrency)
+    if group_max:
+        main.GROUP_COMMIT_MAX = group_max
+    ops = main.GROUP_COMMIT_OPS
+    ops.sum, ops.count = 0.0, 0
+
+    async def one(i):
+        async with sem:
+            uid = base + i
+            await fn(uid, uid - 1 if i else None)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.n)))
+    dt = time.perf_counter() - t0
+    batch = f", avg batch={ops.sum / ops.count:.1f}" if ops.count else ""
+    print(f"{name:<8} {args.n / dt:>10.0f} signups/s   ({dt:.2f} s, reward={args.reward}, shards={args.shards}{batch})")
+
+
+async def bench():
+    main.wg_key_pool.start()
+    await main.db_write_all(main.init_db)
+    await asyncio.gather(*(main.db_write_on(i, main.ipams[i].load) for i in range(main.DB_SHARDS)))
+    await run("before", before, 1_000_000)
+    await run("single", after, 2_000_000, group_max=1)
+    await run("group", after, 3_000_000, group_max=args.group_max)
+    main.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,68 @@
+"""
+Бенчмарк генерации WireGuard-ключей: ключей в секунду.
+
+  python bench/wg_keys.py [-n 2000]
+
+Сравнивает:
+  - subprocess: прежний путь (wg genkey + echo + wg pubkey), если установлен wireguard-tools;
+  - x25519 (cryptography) / x25519 (python) — генерация в процессе;
+  - pool.take() — выдача готовой пары из WGKeyPool.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def subprocess_keypair():
+    # копия старого generate_wg_keypair — для сравнения
+    p = subprocess.run(["wg", "genkey"], capture_output=True, check=True, text=True, timeout=3)
+    priv = p.stdout.strip()
+    subprocess.run(["echo", priv], capture_output=True, text=True)
+    p2 = subprocess.Popen(["wg", "pubkey"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, text=True)
+    out, _ = p2.communicate(priv + "\n", timeout=3)
+    return priv, out.strip()
+
+
+def python_keypair():
+    priv = main._x25519_clamp(os.urandom(32))
+    return priv, main._x25519_base_py(priv)
+
+
+def bench(name, fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    dt = time.perf_counter() - t0
+    print(f"{name:<28} {n / dt:>12.0f} keys/s   ({dt / n * 1e6:.1f} us/key)")
+
+
+def run():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=2000)
+    args = ap.parse_args()
+
+    if shutil.which("wg"):
+        bench("subprocess (wg)", subprocess_keypair, max(1, args.n // 20))
+    else:
+        print(f"{'subprocess (wg)':<28} {'skip':>12}   (wireguard-tools не установлены)")
+    if main.X25519PrivateKey is not None:
+        bench("x25519 (cryptography)", main._new_wg_keypair, args.n)
+    bench("x25519 (python)", python_keypair, max(1, args.n // 10))
+
+    pool = main.WGKeyPool(args.n)
+    pool.start()
+    while len(pool) < args.n:
+        time.sleep(0.01)
+    bench("pool.take()", pool.take, args.n)
+
+
+if __name__ == "__main__":
+    run()
@@ -4,8 +4,8 @@ bot.py — расширенный aiogram VPN-bot (всё в одном файл
 Требования (пример):
   pip install aiogram aiohttp PyJWT python-dotenv
 
-Опционально (для настоящих WireGuard ключей и графиков):
-  sudo apt install wireguard-tools   # для wg genkey / wg pubkey
+Опционально (быстрая генерация WireGuard-ключей и графики):
+  pip install cryptography   # без неё X25519 считается на чистом Python (медленнее, но ключи те же)
   pip install matplotlib
 
 Настройки — замените константы ниже:
@@ -18,27 +18,79 @@ bot.py — расширенный aiogram VPN-bot (всё в одном файл
 import asyncio
 import sqlite3
 import secrets
+import signal
+import sys
 import datetime
-import subprocess
+import base64
+import cProfile
 import io
+import ipaddress
 import csv
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import math
+import marshal
+import multiprocessing
+import multiprocessing.connection
 import os
+import pstats
+import tempfile
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from aiohttp import web
 import jwt  # PyJWT
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
-    Message, CallbackQuery, InputFile
+    Message, CallbackQuery, InputFile, BufferedInputFile, ChatMemberUpdated
+)
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:  # cryptography не установлена — используем реализацию на Python
+    X25519PrivateKey = None
+try:
+    from matplotlib.figure import Figure
+except ImportError:  # matplotlib не установлена — вместо графиков трафика текстовая сводка
+    Figure = None
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError,
+    TelegramNetworkError, TelegramServerError, TelegramAPIError
 )
-from aiogram.filters import Command
-from aiogram.exceptions import TelegramBadRequest
 
 # -------------------------
 #  НАСТРОЙКИ — ЗАМЕНИТЕ
 # -------------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8238322781:AAHQjNqlWO5ILeqArXHNodmF1j2sdvZm3m0")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер (напр. фейковый из bench/), пусто — api.telegram.org
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook (апдейты приходят на тот же aiohttp-сервер, что и /redeem)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес сервера, напр. "https://bot.example.com"
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+# секрет в заголовке X-Telegram-Bot-Api-Secret-Token; одинаковый у всех воркеров, по умолчанию — из BOT_TOKEN
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # соединений Telegram к вебхуку
+WORKERS = int(os.getenv("WORKERS", "1"))  # процессов на одном порту (SO_REUSEPORT), только для webhook
+# где хранить состояние хендлеров (FSM): memory — в процессе, db — в SQLite, общее для воркеров
+FSM_STORAGE = os.getenv("FSM_STORAGE") or ("db" if WORKERS > 1 else "memory")
+ADMIN_FLOW_TTL = int(os.getenv("ADMIN_FLOW_TTL", "600"))  # сек на ввод в админском диалоге, потом он сбрасывается
 REQUIRED_CHANNEL = os.getenv("REQUIRED_CHANNEL", "@grapevpnn")  # пример "@vpn_ch"
 DB_PATH = os.getenv("DB_PATH", "vpn_full.db")
 TOKEN_LIFETIME_HOURS = int(os.getenv("TOKEN_LIFETIME_HOURS", "24"))
@@ -47,26 +99,625 @@ REF_REWARD = int(os.getenv("REF_REWARD", "1"))  # сколько токенов
 ADMIN_IDS = set(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()) or {6979133757}
 JWT_SECRET = os.getenv("JWT_SECRET", "super_jwt_secret_change_me")  # для подписи JWT
 JWT_ALGO = "HS256"
+# ключи подписи для ротации: "kid1:secret1,kid2:secret2"; подписываем JWT_ACTIVE_KID, проверяем любым из списка.
+# JWT без kid (выданные до ротации) проверяются JWT_SECRET.
+JWT_KEYS = dict(
+    item.strip().split(":", 1) for item in os.getenv("JWT_KEYS", "").split(",") if ":" in item
+) or {"default": JWT_SECRET}
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID") or next(iter(JWT_KEYS))
+JWT_LIFETIME_HOURS = int(os.getenv("JWT_LIFETIME_HOURS", "24"))
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "1024"))  # проверенных JWT в кэше
+JWT_CACHE_MAX_TTL = int(os.getenv("JWT_CACHE_MAX_TTL", "3600"))  # сек, даже если exp дальше
 WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")  # имя интерфейса в конфиге (инфо-текст)
 HOST_PUBLIC_IP = os.getenv("HOST_PUBLIC_IP", "vpn.example.com")  # адрес VPN сервера
 WG_LISTEN_PORT = int(os.getenv("WG_LISTEN_PORT", "51820"))
 SERVER_PUBLIC_KEY = os.getenv("SERVER_PUBLIC_KEY", "")  # если уже есть
 DEFAULT_TOKEN_BYTES = 32
+WG_KEY_POOL_SIZE = int(os.getenv("WG_KEY_POOL_SIZE", "256"))  # заранее сгенерированных пар ключей
+WG_CLIENT_SUBNET = os.getenv("WG_CLIENT_SUBNET", "10.66.0.0/16")  # адреса клиентов (пусто — без IPv4)
+WG_CLIENT_SUBNET6 = os.getenv("WG_CLIENT_SUBNET6", "")  # напр. "fd66:66:66::/64" (пусто — без IPv6)
+IPAM_MAX_HOSTS = int(os.getenv("IPAM_MAX_HOSTS", "65536"))  # предел для IPv6-only подсети
+REDEEM_BATCH_MAX = int(os.getenv("REDEEM_BATCH_MAX", "1000"))  # токенов в одном /redeem_batch
+# фильтр живых токенов перед /redeem: неизвестные отсекаются без запроса к БД (0 — выключен)
+REDEEM_FILTER_CAPACITY = int(os.getenv("REDEEM_FILTER_CAPACITY", "1000000"))  # токенов; при загрузке — не меньше 2x
+REDEEM_FILTER_FP = float(os.getenv("REDEEM_FILTER_FP", "0.01"))  # доля ложных "есть" — они идут в БД
+REDEEM_FILTER_CATCHUP_MS = float(os.getenv("REDEEM_FILTER_CATCHUP_MS", "100"))  # WORKERS > 1: догрузка не чаще
+REDEEM_IP_RATE = float(os.getenv("REDEEM_IP_RATE", "20"))  # /redeem в секунду с одного IP (0 — без лимита) ...
+REDEEM_IP_BURST = float(os.getenv("REDEEM_IP_BURST", "100"))  # ... и запас на всплеск
+REDEEM_JWT_RATE = float(os.getenv("REDEEM_JWT_RATE", "50"))  # /redeem в секунду по одному JWT (sub) ...
+REDEEM_JWT_BURST = float(os.getenv("REDEEM_JWT_BURST", "200"))
+REDEEM_THROTTLE_KEYS = int(os.getenv("REDEEM_THROTTLE_KEYS", "100000"))  # клиентов в памяти лимитера
+PEERS_PAGE = int(os.getenv("PEERS_PAGE", "5000"))  # изменений пиров из одного шарда в ответе /peers
+PEERS_MAX_WAIT = float(os.getenv("PEERS_MAX_WAIT", "60"))  # сек, предел long-poll в /peers
+PEERS_POLL_INTERVAL = float(os.getenv("PEERS_POLL_INTERVAL", "1"))  # сек, перечитывать журнал в long-poll
+PEER_LOG_DAYS = int(os.getenv("PEER_LOG_DAYS", "7"))  # сколько хранить журнал пиров; отставшие серверы получат снимок
+TRAFFIC_MINUTE_HOURS = int(os.getenv("TRAFFIC_MINUTE_HOURS", "48"))  # поминутный трафик, старше — в часовые точки
+TRAFFIC_HOUR_DAYS = int(os.getenv("TRAFFIC_HOUR_DAYS", "30"))  # часовые точки, старше — в суточные
+TRAFFIC_DAY_DAYS = int(os.getenv("TRAFFIC_DAY_DAYS", "400"))  # суточные точки, старше — удаляются
+TRAFFIC_SNAPSHOTS_MAX = int(os.getenv("TRAFFIC_SNAPSHOTS_MAX", "100"))  # снимков `wg show dump` в одном POST /traffic
+TRAFFIC_KEYS_CACHE = int(os.getenv("TRAFFIC_KEYS_CACHE", "100000"))  # публичных ключей -> user_id в кэше
+TRAFFIC_MAX_BODY = int(os.getenv("TRAFFIC_MAX_BODY", str(32 * 1024 * 1024)))  # байт в теле POST /traffic (после gzip)
+CHART_CACHE_TTL = int(os.getenv("CHART_CACHE_TTL", "600"))  # сек; новые данные трафика сбрасывают график раньше
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "60"))  # сек между проходами чистильщика
+SWEEP_BATCH = int(os.getenv("SWEEP_BATCH", "500"))  # строк за одну транзакцию
+SWEEP_MODE = os.getenv("SWEEP_MODE", "archive")  # archive — перенести в *_archive, purge — удалить
+SWEEP_GRACE_HOURS = int(os.getenv("SWEEP_GRACE_HOURS", "24"))  # сколько истёкший токен ещё виден пользователю
+REF_ARCHIVE_DAYS = int(os.getenv("REF_ARCHIVE_DAYS", "0"))  # архивировать начисленные рефералы старше N дней (0 — нет)
+# больше приглашённых за час / за сутки — награда пригласившему задерживается до /refrelease (0 — без предела)
+REF_VELOCITY_HOUR = int(os.getenv("REF_VELOCITY_HOUR", "20"))
+REF_VELOCITY_DAY = int(os.getenv("REF_VELOCITY_DAY", "100"))
+REF_TREE_MAX_DEPTH = int(os.getenv("REF_TREE_MAX_DEPTH", "32"))  # уровней, учитываемых в размере/глубине дерева
+REF_LEADERBOARD_SIZE = int(os.getenv("REF_LEADERBOARD_SIZE", "20"))
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "2000"))  # строк за один fetchmany
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))  # лимит документа Telegram — 50 МБ
+EXPORT_SPOOL_MEM = int(os.getenv("EXPORT_SPOOL_MEM", str(8 * 1024 * 1024)))  # больше — временный файл на диске
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "25"))  # строк на странице админских списков
+USER_PAGE_SIZE = int(os.getenv("USER_PAGE_SIZE", "5"))  # токенов на странице "Мои токены"
+FLOOD_LIMIT = int(os.getenv("FLOOD_LIMIT", "5"))  # событий от пользователя ...
+FLOOD_WINDOW = float(os.getenv("FLOOD_WINDOW", "3"))  # ... за столько секунд, остальное отбрасываем
+CALLBACK_DEBOUNCE = float(os.getenv("CALLBACK_DEBOUNCE", "1"))  # сек, повтор той же кнопки игнорируется
+FLOOD_REDIS_URL = os.getenv("FLOOD_REDIS_URL", "")  # общий лимитер для нескольких воркеров (pip install redis)
+# memory | db (COUNT в БД, общий для воркеров); у нескольких воркеров память своя — только db
+TOKEN_QUOTA_BACKEND = os.getenv("TOKEN_QUOTA_BACKEND", "memory") if WORKERS == 1 else "db"
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", "5001"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # если задан — /metrics требует "Authorization: Bearer <token>"
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))  # файлов SQLite: шард 0 — DB_PATH, остальные — <имя>.shardN.db
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))  # потоков для чтения из БД
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_SLOW_WAIT_MS = int(os.getenv("DB_SLOW_WAIT_MS", "200"))  # предупреждать, если запрос ждал в очереди дольше
+GROUP_COMMIT_MAX = int(os.getenv("GROUP_COMMIT_MAX", "256"))  # регистраций/выдач токенов в одной транзакции
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2"))  # сколько первая операция ждёт попутчиков
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", "5000"))  # строк за одну транзакцию при backfill
+TG_CACHE_SIZE = int(os.getenv("TG_CACHE_SIZE", "100000"))  # записей в кэше данных Telegram
+SUB_CACHE_TTL_POS = int(os.getenv("SUB_CACHE_TTL_POS", "600"))  # сек, "подписан"
+SUB_CACHE_TTL_NEG = int(os.getenv("SUB_CACHE_TTL_NEG", "30"))  # сек, "не подписан"
+TG_CACHE_TTL = int(os.getenv("TG_CACHE_TTL", "3600"))  # сек, редко меняющиеся данные (get_me и т.п.)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений/сек суммарно (лимит Telegram ~30)
+BROADCAST_PER_CHAT_RATE = float(os.getenv("BROADCAST_PER_CHAT_RATE", "1"))  # сообщений/сек в один чат
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # одновременных send_message
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))  # получателей между сохранениями прогресса
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))  # повторов при сетевых/5xx ошибках
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # сек между обновлениями прогресса
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "30"))  # длительность /profile по умолчанию
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))  # период снятия стеков в режиме sample
+PROFILE_SLOW_CALLBACK_MS = float(os.getenv("PROFILE_SLOW_CALLBACK_MS", "50"))  # шаг event loop дольше — в отчёт
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))  # функций в сводке
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG, INFO, WARNING, ERROR
 
 # -------------------------
 #  Инициализация бота
 # -------------------------
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+# диагностика — через logging, а не print: пишут и потоки БД, строки не перемешиваются, уровень настраивается
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s")
+log = logging.getLogger("grapevpn")
+
+if TELEGRAM_API_URL:
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(BOT_TOKEN)
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_state: состояние видно всем воркерам и переживает рестарт.
+    Строка без состояния и без данных удаляется, поэтому таблица хранит только активные диалоги.
+    Диалоги FSM есть только у админов: ключи остальных пользователей — в MemoryStorage воркера,
+    иначе каждое их сообщение стоило бы запроса к БД ради фильтра по состоянию.
+    """
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.local = MemoryStorage()
+
+    async def set_state(self, key, state=None):
+        if key.user_id not in ADMIN_IDS:
+            return await self.local.set_state(key, state)
+        state = state.state if isinstance(state, State) else state
+        await db_write(fsm_save, self.key_builder.build(key), "state", state)
+
+    async def get_state(self, key):
+        if key.user_id not in ADMIN_IDS:
+            return await self.local.get_state(key)
+        row = await db_read(fsm_load, self.key_builder.build(key))
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        if key.user_id not in ADMIN_IDS:
+            return await self.local.set_data(key, data)
+        await db_write(fsm_save, self.key_builder.build(key), "data",
+                       json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def get_data(self, key):
+        if key.user_id not in ADMIN_IDS:
+            return await self.local.get_data(key)
+        row = await db_read(fsm_load, self.key_builder.build(key))
+        return json.loads(row[1]) if row and row[1] else {}
+
+    async def close(self):
+        await self.local.close()  # соединения с БД закрывает close_db()
+
+dp = Dispatcher(storage=SQLiteStorage() if FSM_STORAGE == "db" else None)
+
+# -------------------------
+#  Метрики (формат Prometheus)
+# -------------------------
+# Все метрики создаются заранее и лежат в словарях по значению метки: на горячем пути —
+# только поиск в dict и пара сложений, без аллокаций. Рендер текста — только при запросе /metrics.
+METRICS = []  # в порядке регистрации
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _fmt_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for k, v in labels.items()) + "}"
+
+class Counter:
+    kind = "counter"
+    __slots__ = ("name", "help", "labels", "value")
+
+    def __init__(self, name: str, help: str, labels: Optional[dict] = None):
+        self.name, self.help, self.labels, self.value = name, help, _fmt_labels(labels or {}), 0
+        METRICS.append(self)
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def render(self):
+        yield f"{self.name}{self.labels} {self.value}"
+
+class GaugeFunc:
+    """Значение снимается функцией в момент /metrics (размер пула, hit-ы кэша и т.п.)."""
+    __slots__ = ("name", "help", "labels", "fn", "kind")
+
+    def __init__(self, name: str, help: str, fn, labels: Optional[dict] = None, kind: str = "gauge"):
+        self.name, self.help, self.labels, self.fn = name, help, _fmt_labels(labels or {}), fn
+        self.kind = kind
+        METRICS.append(self)
+
+    def render(self):
+        yield f"{self.name}{self.labels} {self.fn()}"
+
+class DictCounter:
+    """Счётчики из готового dict {значение метки: число} — для меток, которые заранее не известны (sub сервера)."""
+    kind = "counter"
+    __slots__ = ("name", "help", "label", "source")
+
+    def __init__(self, name: str, help: str, label: str, source: dict):
+        self.name, self.help, self.label, self.source = name, help, label, source
+        METRICS.append(self)
+
+    def render(self):
+        for value, n in list(self.source.items()):
+            yield f"{self.name}{_fmt_labels({self.label: value})} {n}"
+
+class Histogram:
+    kind = "histogram"
+    __slots__ = ("name", "help", "labels", "buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, name: str, help: str, labels: Optional[dict] = None, buckets=DEFAULT_BUCKETS,
+                 threaded: bool = False):
+        self.name, self.help, self.labels = name, help, labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # из нескольких потоков += теряет обновления — для таких гистограмм берём lock
+        self._lock = threading.Lock() if threaded else None
+        METRICS.append(self)
+
+    def observe(self, value: float):
+        if self._lock is None:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            return
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        acc = 0
+        for bound, n in zip(self.buckets, self.counts):
+            acc += n
+            yield f"{self.name}_bucket{_fmt_labels({**self.labels, 'le': bound})} {acc}"
+        yield f"{self.name}_bucket{_fmt_labels({**self.labels, 'le': '+Inf'})} {self.count}"
+        yield f"{self.name}_sum{_fmt_labels(self.labels)} {self.sum}"
+        yield f"{self.name}_count{_fmt_labels(self.labels)} {self.count}"
+
+def render_metrics() -> str:
+    # все серии одного семейства должны идти подряд — группируем по имени
+    families = {}
+    for m in METRICS:
+        families.setdefault(m.name, []).append(m)
+    lines = []
+    for name, members in families.items():
+        lines.append(f"# HELP {name} {members[0].help}")
+        lines.append(f"# TYPE {name} {members[0].kind}")
+        for m in members:
+            lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+# семейства с метками: значение метки -> метрика
+HANDLER_SECONDS = {}
+HANDLER_ERRORS = {}
+API_SECONDS = {}
+API_RESPONSES = {}  # (route, "2xx"|"4xx"|"5xx") -> Counter
+TG_API_SECONDS = {}
+TG_API_ERRORS = {}
+DB_QUERY_SECONDS = {k: Histogram("db_query_seconds", "SQL execution time in executor threads", {"kind": k})
+                    for k in ("read", "write")}
+DB_QUEUE_SECONDS = {k: Histogram("db_queue_wait_seconds", "Time a DB call waited for an executor thread",
+                                 {"kind": k}) for k in ("read", "write")}
+GROUP_COMMIT_OPS = Histogram("db_group_commit_ops", "Operations per group-commit transaction",
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+WG_KEYGEN_SECONDS = Histogram("wg_keygen_seconds", "X25519 keypair generation time",
+                              buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01), threaded=True)
+BROADCAST_MESSAGES = {r: Counter("broadcast_messages_total", "Broadcast sends by result", {"result": r})
+                      for r in ("delivered", "blocked", "failed")}
+REDEEM_REJECTED = {r: Counter("redeem_rejected_total", "Redeem lookups rejected before the database", {"reason": r})
+                   for r in ("filter", "ip_throttle", "jwt_throttle")}
+TRAFFIC_SAMPLES = {r: Counter("traffic_samples_total", "Per-peer samples from POST /traffic by result", {"result": r})
+                   for r in ("stored", "unknown_peer", "stale")}
+
+def _handler_metrics(name: str):
+    if name not in HANDLER_SECONDS:
+        HANDLER_SECONDS[name] = Histogram("bot_handler_seconds", "aiogram handler latency", {"handler": name})
+        HANDLER_ERRORS[name] = Counter("bot_handler_errors_total", "aiogram handler exceptions", {"handler": name})
+    return HANDLER_SECONDS[name], HANDLER_ERRORS[name]
+
+def _api_metrics(route: str):
+    if route not in API_SECONDS:
+        API_SECONDS[route] = Histogram("api_request_seconds", "HTTP API latency", {"route": route})
+        for cls in ("2xx", "4xx", "5xx"):
+            API_RESPONSES[(route, cls)] = Counter("api_responses_total", "HTTP API responses by status class",
+                                                  {"route": route, "status": cls})
+    return API_SECONDS[route]
+
+def _tg_metrics(method: str):
+    if method not in TG_API_SECONDS:
+        TG_API_SECONDS[method] = Histogram("telegram_api_seconds", "Telegram Bot API call latency", {"method": method})
+        TG_API_ERRORS[method] = Counter("telegram_api_errors_total", "Telegram Bot API call errors", {"method": method})
+    return TG_API_SECONDS[method], TG_API_ERRORS[method]
+
+for _method in ("GetUpdates", "GetChatMember", "GetMe", "SendMessage", "SendDocument", "SendPhoto",
+                "EditMessageText", "AnswerCallbackQuery"):
+    _tg_metrics(_method)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        hist, errors = _tg_metrics(type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            hist.observe(time.perf_counter() - started)
+
+bot.session.middleware(TelegramMetricsMiddleware())
 
 # -------------------------
 #  Работа с базой SQLite
 # -------------------------
-def get_conn():
-    return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+# Все запросы выполняются вне event loop:
+#   - чтение — в пуле потоков _db_read_pool (WAL позволяет читать параллельно с записью);
+#   - запись — в потоке-писателе своего шарда (_db_write_pools), поэтому писатели одного файла не дерутся за lock.
+# У каждого потока долгоживущие соединения (thread-local, по одному на шард), новые не открываются на каждый запрос.
+#
+# Шардирование: данные пользователя (users, referrals, tokens, ip_allocations, трафик, архивы) живут в шарде
+# user_shard(user_id); общие таблицы (broadcasts, fsm_state) — в шарде 0; журнал пиров (peer_events) у каждого
+# шарда свой. Пользователь попадает в один из SHARD_BUCKETS виртуальных бакетов, бакет — в шард bucket % DB_SHARDS.
+# Номер бакета — префикс токена ("517.xxxx"), поэтому /redeem сразу идёт в нужный файл,
+# и после решардинга (reshard.py) префиксы остаются верными.
+SHARD_BUCKETS = 1024  # не менять: записан в выданных токенах
+# таблица -> колонка с user_id, по которой строка относится к шарду; остальные таблицы — только в шарде 0
+SHARD_ROUTING = {
+    "users": "user_id",
+    "referrals": "new_user",
+    "referrals_archive": "new_user",
+    "referral_credits": "ref_by",
+    "tokens": "user_id",
+    "tokens_archive": "user_id",
+    "ip_allocations": "user_id",
+    "traffic_counters": "user_id",
+    "traffic": "user_id",
+}
+# журналы, которые ведёт каждый шард сам для себя: при решардинге не переносятся, их версии начинаются заново
+SHARD_LOCAL_TABLES = ("peer_events",)
+_db_local = threading.local()
+_db_conns = []
+_db_conns_lock = threading.Lock()
+_db_read_pool = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+_db_write_pools = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-write-{i}") for i in range(DB_SHARDS)]
+
+def shard_path(shard: int, base: str = DB_PATH) -> str:
+    if shard == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{shard}{ext or '.db'}"
+
+def user_bucket(user_id: int) -> int:
+    # мультипликативный хэш (Фибоначчи): старшие 10 бит 64-битного произведения
+    return ((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 54
+
+def user_shard(user_id: int) -> int:
+    return user_bucket(user_id) % DB_SHARDS
+
+def token_shards(token: str) -> list:
+    """Шарды, где может лежать токен: один по префиксу; все — для старых токенов без префикса."""
+    bucket, dot, _ = token.partition(".")
+    if not dot:
+        return list(range(DB_SHARDS))
+    if not bucket.isdigit() or int(bucket) >= SHARD_BUCKETS:
+        return []
+    return [int(bucket) % DB_SHARDS]
+
+# статистика ожидания в очереди executor-а: kind -> [кол-во, суммарно сек, максимум сек]
+DB_QUEUE_STATS = {"read": [0, 0.0, 0.0], "write": [0, 0.0, 0.0]}
+_db_stats_lock = threading.Lock()
+
+def _configure_conn(conn: sqlite3.Connection):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # в WAL безопасно, fsync только на checkpoint
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+
+def get_conn(shard: Optional[int] = None):
+    """
+    Соединение текущего потока с шардом (по умолчанию — с тем, для которого вызван db_read_on/db_write_on).
+    Создаётся один раз и переиспользуется, закрывать его не нужно.
+    """
+    if shard is None:
+        shard = getattr(_db_local, "shard", 0)
+    conns = getattr(_db_local, "conns", None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    conn = conns.get(shard)
+    if conn is None:
+        conn = sqlite3.connect(shard_path(shard), detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               check_same_thread=False)
+        _configure_conn(conn)
+        conns[shard] = conn
+        with _db_conns_lock:
+            _db_conns.append(conn)
+    return conn
+
+def current_shard() -> int:
+    return getattr(_db_local, "shard", 0)
+
+def close_db():
+    _db_read_pool.shutdown(wait=True)
+    for pool in _db_write_pools:
+        pool.shutdown(wait=True)
+    with _db_conns_lock:
+        for conn in _db_conns:
+            conn.close()
+        _db_conns.clear()
+
+def _record_db_wait(kind: str, waited: float):
+    with _db_stats_lock:
+        st = DB_QUEUE_STATS[kind]
+        st[0] += 1
+        st[1] += waited
+        if waited > st[2]:
+            st[2] = waited
+    if waited * 1000 >= DB_SLOW_WAIT_MS:
+        log.warning("[db] %s-запрос ждал в очереди %.0f мс", kind, waited * 1000)
+
+async def _run_db(pool: ThreadPoolExecutor, kind: str, shard: int, fn, *args):
+    submitted = time.perf_counter()
+    timing = [0.0, 0.0]  # ожидание в очереди, выполнение — гистограммы пишем уже в event loop
+
+    def call():
+        started = time.perf_counter()
+        timing[0] = started - submitted
+        _record_db_wait(kind, timing[0])
+        _db_local.shard = shard
+        try:
+            res = fn(*args)
+            if getattr(_db_local, "after_commit", None) and not get_conn().in_transaction:
+                _effects_apply()
+            return res
+        except BaseException:
+            # соединение долгоживущее: не оставляем висящую транзакцию следующему запросу
+            get_conn().rollback()
+            _effects_rollback()
+            raise
+        finally:
+            timing[1] = time.perf_counter() - started
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, call)
+    finally:
+        DB_QUEUE_SECONDS[kind].observe(timing[0])
+        DB_QUERY_SECONDS[kind].observe(timing[1])
+
+async def db_read(fn, *args):
+    """Выполнить синхронную функцию чтения fn(*args) в пуле читателей (шард 0 — общие таблицы)."""
+    return await _run_db(_db_read_pool, "read", 0, fn, *args)
+
+async def db_write(fn, *args):
+    """Выполнить синхронную функцию записи fn(*args) в потоке-писателе шарда 0 (общие таблицы)."""
+    return await _run_db(_db_write_pools[0], "write", 0, fn, *args)
+
+async def db_read_on(shard: int, fn, *args):
+    return await _run_db(_db_read_pool, "read", shard, fn, *args)
+
+async def db_write_on(shard: int, fn, *args):
+    return await _run_db(_db_write_pools[shard], "write", shard, fn, *args)
+
+async def db_read_all(fn, *args) -> list:
+    """fn(*args) на каждом шарде параллельно; результаты — в порядке шардов."""
+    return await asyncio.gather(*(db_read_on(i, fn, *args) for i in range(DB_SHARDS)))
 
-def init_db():
+async def db_write_all(fn, *args) -> list:
+    return await asyncio.gather(*(db_write_on(i, fn, *args) for i in range(DB_SHARDS)))
+
+def on_commit(fn, *args):
+    """
+    Отложить изменение памяти (фильтр токенов, квота, реф-граф) до COMMIT текущей транзакции потока-писателя.
+    Применяется после commit в _run_group или по возвращении функции из _run_db, если транзакция закрыта;
+    откат (ROLLBACK TO в _run_group и SAVEPOINT-ах, исключение в _run_db) его отменяет и вызывает on_rollback.
+    """
+    _effects_add(fn, args, False)
+
+def on_rollback(fn, *args):
+    """
+    Обратное к изменению памяти, уже сделанному внутри транзакции (адрес, занятый в карте IPAM):
+    вызывается, если откатится эта транзакция или SAVEPOINT, иначе после COMMIT просто забывается.
+    """
+    _effects_add(fn, args, True)
+
+def _effects_add(fn, args: tuple, undo: bool):
+    pending = getattr(_db_local, "after_commit", None)
+    if pending is None:
+        pending = _db_local.after_commit = []
+    pending.append((fn, args, undo))
+
+def pending_effects(fn) -> list:
+    """Аргументы ещё не применённых on_commit(fn, ...) этого потока — чтобы операции пачки видели друг друга."""
+    return [args for f, args, undo in getattr(_db_local, "after_commit", ()) if f == fn and not undo]
+
+def _effects_mark() -> int:
+    return len(getattr(_db_local, "after_commit", ()))
+
+def _effects_rollback(mark: int = 0):
+    pending = getattr(_db_local, "after_commit", None)
+    if not pending:
+        return
+    dropped = pending[mark:]
+    del pending[mark:]
+    for fn, args, undo in reversed(dropped):
+        if undo:
+            fn(*args)
+
+def _effects_apply():
+    pending = getattr(_db_local, "after_commit", None)
+    while pending:
+        fn, args, undo = pending.pop(0)
+        if not undo:
+            fn(*args)
+
+def _begin_immediate(conn: sqlite3.Connection):
+    """
+    Транзакция с блокировкой записи сразу. Отложенный BEGIN, прочитав, а потом записав, при нескольких
+    процессах получает SQLITE_BUSY мгновенно, мимо busy_timeout; BEGIN IMMEDIATE ждёт блокировку как положено.
+    """
+    if conn.in_transaction:  # незакоммиченное от прошлого вызова в этом потоке — уходит отдельным COMMIT
+        conn.commit()
+        _effects_apply()
+    conn.execute("BEGIN IMMEDIATE")
+
+def _run_group(ops: list) -> list:
+    """Пачка операций fn(conn, *args) одной транзакцией; у каждой свой SAVEPOINT. [(ok, результат или ошибка)]."""
     conn = get_conn()
+    _begin_immediate(conn)
+    results = []
+    for fn, args in ops:
+        mark = _effects_mark()
+        conn.execute("SAVEPOINT group_op")
+        try:
+            results.append((True, fn(conn, *args)))
+        except Exception as e:
+            conn.execute("ROLLBACK TO group_op")
+            _effects_rollback(mark)
+            results.append((False, e))
+        conn.execute("RELEASE group_op")
+    try:
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _effects_rollback()
+        raise
+    _effects_apply()
+    return results
+
+class GroupCommitter:
+    """
+    Write-behind для частых мелких записей шарда (регистрация, выдача токена): вместо транзакции на
+    каждую — одна на пачку. Операции копятся в очереди event loop-а и уходят в поток-писатель вместе,
+    когда наберётся GROUP_COMMIT_MAX или пройдёт GROUP_COMMIT_WINDOW_MS с первой; пока писатель занят
+    прошлой пачкой, следующая копится сама. Ошибка операции откатывает только её SAVEPOINT.
+    Вызывающий получает результат после COMMIT пачки: его строки атомарны и видны другим соединениям,
+    но при synchronous=NORMAL переживут сбой питания только после checkpoint WAL. Пачка экономит
+    накладные расходы транзакции и передачи в поток, а не fsync.
+    """
+
+    def __init__(self, shard: int):
+        self.shard = shard
+        self._pending = deque()  # (fn, args, future)
+        self._wakeup = None
+        self._full = None
+        self._task = None
+
+    async def submit(self, fn, *args):
+        """fn(conn, *args) в транзакции пачки (fn не делает commit). Исключение fn пробрасывается сюда."""
+        if self._task is None or self._task.done():
+            # первая операция (или новый event loop): события и задача создаются в текущем loop-е
+            self._wakeup, self._full = asyncio.Event(), asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((fn, args, fut))
+        self._wakeup.set()
+        if len(self._pending) >= GROUP_COMMIT_MAX:
+            self._full.set()
+        return await fut
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if len(self._pending) < GROUP_COMMIT_MAX and GROUP_COMMIT_WINDOW_MS > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), GROUP_COMMIT_WINDOW_MS / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [self._pending.popleft() for _ in range(min(GROUP_COMMIT_MAX, len(self._pending)))]
+            if not self._pending:
+                self._wakeup.clear()
+            if len(self._pending) < GROUP_COMMIT_MAX:
+                self._full.clear()
+            GROUP_COMMIT_OPS.observe(len(batch))
+            try:
+                results = await db_write_on(self.shard, _run_group, [(fn, args) for fn, args, _ in batch])
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            for (_, _, fut), (ok, value) in zip(batch, results):
+                if fut.done():  # вызывающий отменён
+                    continue
+                if ok:
+                    fut.set_result(value)
+                else:
+                    fut.set_exception(value)
+
+group_committers = [GroupCommitter(i) for i in range(DB_SHARDS)]
+
+async def db_write_grouped(shard: int, fn, *args):
+    """fn(conn, *args) в шарде через групповой коммит; см. GroupCommitter."""
+    return await group_committers[shard].submit(fn, *args)
+
+def db_queue_stats() -> dict:
+    """Сводка ожидания в очереди: {kind: {"count", "avg_ms", "max_ms"}}."""
+    with _db_stats_lock:
+        return {
+            kind: {"count": n, "avg_ms": (total / n * 1000) if n else 0.0, "max_ms": mx * 1000}
+            for kind, (n, total, mx) in DB_QUEUE_STATS.items()
+        }
+
+# -------------------------
+#  Миграции схемы
+# -------------------------
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция применяется один раз,
+# по порядку; уже существующая vpn_full.db (user_version=0) обновляется на месте.
+def _migrate_1_base(conn: sqlite3.Connection):
     c = conn.cursor()
     # users: ref_by — кто пригласил; paid — пометка оплаты
     c.execute("""
@@ -98,105 +749,479 @@ def init_db():
             created_at TEXT
         )
     """)
+
+def _migrate_2_token_epochs(conn: sqlite3.Connection):
+    """
+    Целочисленные epoch-колонки для tokens и индексы под горячие запросы.
+    Текстовые created_at/expires_at остаются (для отображения и для старой версии бота,
+    пока она ещё работает), сравнения и сортировки идут только по *_ts.
+    """
+    c = conn.cursor()
+    cols = {row[1] for row in c.execute("PRAGMA table_info(tokens)")}
+    # ADD COLUMN в SQLite не переписывает таблицу — выполняется мгновенно
+    if "created_ts" not in cols:
+        c.execute("ALTER TABLE tokens ADD COLUMN created_ts INTEGER")
+    if "expires_ts" not in cols:
+        c.execute("ALTER TABLE tokens ADD COLUMN expires_ts INTEGER")
+    # строки, вставленные старой версией кода, заполняем триггером
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS tokens_fill_ts AFTER INSERT ON tokens
+        WHEN NEW.created_ts IS NULL OR NEW.expires_ts IS NULL
+        BEGIN
+            UPDATE tokens SET
+                created_ts = CAST(strftime('%s', NEW.created_at) AS INTEGER),
+                expires_ts = CAST(strftime('%s', NEW.expires_at) AS INTEGER)
+            WHERE rowid = NEW.rowid;
+        END
+    """)
     conn.commit()
-    conn.close()
+    # backfill небольшими транзакциями, чтобы не держать write-lock надолго
+    while True:
+        c.execute("""
+            UPDATE tokens SET
+                created_ts = CAST(strftime('%s', created_at) AS INTEGER),
+                expires_ts = CAST(strftime('%s', expires_at) AS INTEGER)
+            WHERE rowid IN (SELECT rowid FROM tokens WHERE created_ts IS NULL OR expires_ts IS NULL LIMIT ?)
+        """, (MIGRATION_BATCH,))
+        conn.commit()
+        if c.rowcount < MIGRATION_BATCH:
+            break
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tokens_user_created ON tokens(user_id, created_ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tokens_expires_used ON tokens(expires_ts, used)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tokens_created ON tokens(created_ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_referrals_ref_by ON referrals(ref_by)")
+
+def _migrate_3_broadcasts(conn: sqlite3.Connection):
+    # задания рассылки; last_user_id — курсор: все user_id <= него уже обработаны
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            text TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_ts INTEGER,
+            finished_ts INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+def _migrate_4_ipam(conn: sqlite3.Connection):
+    # host — смещение адреса в подсети; PRIMARY KEY не даёт выдать один адрес дважды
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ip_allocations (
+            host INTEGER PRIMARY KEY,
+            token TEXT UNIQUE,
+            user_id INTEGER,
+            expires_ts INTEGER,
+            allocated_ts INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ip_allocations_expires ON ip_allocations(expires_ts)")
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(tokens)")}
+    if "client_ip" not in cols:
+        conn.execute("ALTER TABLE tokens ADD COLUMN client_ip TEXT")
+    if "revoked" not in cols:
+        conn.execute("ALTER TABLE tokens ADD COLUMN revoked INTEGER DEFAULT 0")
+
+def _migrate_5_archive(conn: sqlite3.Connection):
+    # архив истёкших токенов: без приватного ключа, он больше никому не нужен
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tokens_archive (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER,
+            created_ts INTEGER,
+            expires_ts INTEGER,
+            used INTEGER,
+            revoked INTEGER,
+            wg_public TEXT,
+            client_ip TEXT,
+            archived_ts INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tokens_archive_user ON tokens_archive(user_id, created_ts)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referrals_archive (
+            new_user INTEGER PRIMARY KEY,
+            ref_by INTEGER,
+            credited INTEGER,
+            created_at TEXT,
+            archived_ts INTEGER
+        )
+    """)
+
+def _migrate_6_keyset_indexes(conn: sqlite3.Connection):
+    # индексы под keyset-пагинацию: полный ключ сортировки, без дозаборки строк по rowid
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tokens_created_token ON tokens(created_ts, token)")
+    conn.execute("DROP INDEX IF EXISTS idx_tokens_created")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_joined_user ON users(joined_at, user_id)")
+    conn.execute("DROP INDEX IF EXISTS idx_users_joined")
+
+def _migrate_7_fsm_state(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_ts INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+def _migrate_8_referral_credits(conn: sqlite3.Connection):
+    # начисления за рефералов из другого шарда — в шарде пригласившего; PRIMARY KEY не даёт начислить дважды
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_credits (
+            new_user INTEGER PRIMARY KEY,
+            ref_by INTEGER NOT NULL,
+            credited_ts INTEGER NOT NULL
+        )
+    """)
+
+def _migrate_9_peer_events(conn: sqlite3.Connection):
+    # журнал добавлений и удалений пиров для /peers; AUTOINCREMENT — версии не переиспользуются после чистки
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS peer_events (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            token TEXT NOT NULL,
+            wg_public TEXT,
+            client_ip TEXT,
+            expires_ts INTEGER,
+            ts INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_peer_events_ts ON peer_events(ts)")
+
+def _migrate_10_traffic(conn: sqlite3.Connection):
+    # последние счётчики `wg show dump` по (сервер, пир) — из них считаются приросты
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS traffic_counters (
+            server TEXT NOT NULL,
+            wg_public TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            rx INTEGER NOT NULL,
+            tx INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (server, wg_public)
+        ) WITHOUT ROWID
+    """)
+    # приросты по корзинам: resolution 60 / 3600 / 86400 сек, старые корзины сворачиваются в более крупные
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS traffic (
+            user_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket_ts INTEGER NOT NULL,
+            wg_public TEXT NOT NULL,
+            rx INTEGER NOT NULL,
+            tx INTEGER NOT NULL,
+            PRIMARY KEY (user_id, resolution, bucket_ts, wg_public)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_resolution_bucket ON traffic(resolution, bucket_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tokens_wg_public ON tokens(wg_public)")
+
+MIGRATIONS = [
+    (1, _migrate_1_base),
+    (2, _migrate_2_token_epochs),
+    (3, _migrate_3_broadcasts),
+    (4, _migrate_4_ipam),
+    (5, _migrate_5_archive),
+    (6, _migrate_6_keyset_indexes),
+    (7, _migrate_7_fsm_state),
+    (8, _migrate_8_referral_credits),
+    (9, _migrate_9_peer_events),
+    (10, _migrate_10_traffic),
+]
+
+def init_db(shard: Optional[int] = None):
+    """Миграции одного шарда; схема у всех шардов одинаковая."""
+    conn = get_conn(shard)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        migrate(conn)
+        conn.execute(f"PRAGMA user_version={target}")
+        conn.commit()
+        log.info("[db] %s: схема обновлена до версии %d",
+                 os.path.basename(shard_path(current_shard() if shard is None else shard)), target)
 
 # -------------------------
 #  Вспомогательные функции
 # -------------------------
-def register_user(user_id: int, ref_by: Optional[int]):
+def fsm_load(key: str):
+    return get_conn().execute("SELECT state, data FROM fsm_state WHERE key=?", (key,)).fetchone()
+
+def fsm_save(key: str, column: str, value):
+    """column — "state" или "data"; строка без того и другого удаляется."""
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    if c.fetchone():
-        conn.close()
-        return False
+    with conn:
+        _begin_immediate(conn)
+        conn.execute(f"INSERT INTO fsm_state (key, {column}, updated_ts) VALUES (?, ?, ?)"
+                     f" ON CONFLICT(key) DO UPDATE SET {column}=excluded.{column}, updated_ts=excluded.updated_ts",
+                     (key, value, int(time.time())))
+        if value is None:
+            conn.execute("DELETE FROM fsm_state WHERE key=? AND state IS NULL AND data IS NULL", (key,))
+
+def fsm_prune(cutoff: int) -> int:
+    conn = get_conn()
+    with conn:
+        return conn.execute("DELETE FROM fsm_state WHERE updated_ts < ?", (cutoff,)).rowcount
+
+def _register_user_tx(conn: sqlite3.Connection, user_id: int, ref_by: Optional[int]) -> bool:
+    """Регистрация внутри текущей транзакции (без commit). False — пользователь уже есть."""
     now = datetime.datetime.utcnow().isoformat()
     # защита: не позволяем self-ref
     if ref_by == user_id:
         ref_by = None
-    # вставка пользователя
-    c.execute("INSERT INTO users (user_id, ref_by, refs_count, joined_at) VALUES (?, ?, ?, ?)",
-              (user_id, ref_by, 0, now))
-    # если есть реф, добавляем запись в referrals и увеличиваем счётчик приглашений (но начисление награды отдельно)
+    # вставка пользователя; OR IGNORE + rowcount вместо отдельного SELECT
+    cur = conn.execute("INSERT OR IGNORE INTO users (user_id, ref_by, refs_count, joined_at) VALUES (?, ?, ?, ?)",
+                       (user_id, ref_by, 0, now))
+    if not cur.rowcount:
+        return False
+    # если есть реф, добавляем запись в referrals (начисление награды отдельно)
     if ref_by:
-        c.execute("INSERT OR IGNORE INTO referrals (new_user, ref_by, credited, created_at) VALUES (?, ?, 0, ?)",
-                  (user_id, ref_by, now))
-    conn.commit()
-    conn.close()
+        conn.execute("INSERT OR IGNORE INTO referrals (new_user, ref_by, credited, created_at) VALUES (?, ?, 0, ?)",
+                     (user_id, ref_by, now))
+        on_commit(referral_graph.add, user_id, ref_by, time.time())
     return True
 
-def credit_referral_for(new_user: int):
+def _credit_referral_tx(conn: sqlite3.Connection, new_user: int, force: bool = False):
     """
     Попытаться начислить награду рефералу, с защитой от накрутки:
       - начисляем только один раз за каждого new_user
       - ref_by должен существовать в users
       - self-ref запрещён уже при регистрации
+      - у слишком быстро приглашающего награда задерживается (referral_graph, без SQL); force — выдать всё равно
+    Выполняется внутри текущей транзакции (без commit): счётчик, отметка и REF_REWARD токенов
+    либо записываются вместе, либо не записываются вовсе.
     Возвращает (credited: bool, ref_by_id or None)
     """
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT ref_by, credited FROM referrals WHERE new_user=?", (new_user,))
-    row = c.fetchone()
+    row = conn.execute("SELECT ref_by, credited FROM referrals WHERE new_user=?", (new_user,)).fetchone()
     if not row:
-        conn.close()
         return False, None
     ref_by, credited = row
     if credited:
-        conn.close()
         return False, ref_by
     # проверка существования пригласителя
-    c.execute("SELECT user_id FROM users WHERE user_id=?", (ref_by,))
-    if not c.fetchone():
-        conn.close()
+    if not conn.execute("SELECT 1 FROM users WHERE user_id=?", (ref_by,)).fetchone():
         return False, ref_by
-    # защита: не начисляем, если у пригласителя уже слишком много рефов? (опционально) — можно добавить порог
-    # начисляем: просто увеличим refs_count и добавим токены наградой (реализовано как создание токенов)
-    c.execute("UPDATE users SET refs_count = refs_count + 1 WHERE user_id=?", (ref_by,))
-    # создаём REF_REWARD токенов для ref_by (можно ужать, чтобы каждый токен был помечен как "реф")
-    for _ in range(REF_REWARD):
-        token, exp, priv, pub = _create_token_db(ref_by, generate_wg_keys=True)
-        # пометка: wg keys и т.д. (уже внутри)
-    c.execute("UPDATE referrals SET credited=1 WHERE new_user=?", (new_user,))
-    conn.commit()
-    conn.close()
+    if not force and referral_graph.should_hold(ref_by):
+        return False, ref_by
+    conn.execute("UPDATE referrals SET credited=1 WHERE new_user=?", (new_user,))
+    conn.execute("UPDATE users SET refs_count = refs_count + 1 WHERE user_id=?", (ref_by,))
+    # REF_REWARD токенов для ref_by — одним executemany
+    _insert_tokens(conn, ref_by, REF_REWARD)
     return True, ref_by
 
+def _credit_referral_savepoint(conn: sqlite3.Connection, new_user: int, force: bool = False):
+    # нехватка адресов откатывает только начисление, а не всю транзакцию вызывающего
+    mark = _effects_mark()
+    conn.execute("SAVEPOINT credit_referral")
+    try:
+        res = _credit_referral_tx(conn, new_user, force)
+    except IPAMExhausted:
+        conn.execute("ROLLBACK TO credit_referral")
+        _effects_rollback(mark)
+        log.warning("[ipam] адреса закончились: награда за %s не начислена, осталась в задержанных", new_user)
+        res = False, None
+    conn.execute("RELEASE credit_referral")
+    return res
+
+def register_user(user_id: int, ref_by: Optional[int]):
+    conn = get_conn()
+    with conn:
+        return _register_user_tx(conn, user_id, ref_by)
+
+def credit_referral_for(new_user: int, force: bool = False):
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        return _credit_referral_savepoint(conn, new_user, force)
+
+def _register_and_credit_tx(conn: sqlite3.Connection, user_id: int, ref_by: Optional[int]):
+    """
+    /start целиком внутри текущей транзакции (без commit): регистрация + реф-награда.
+    Вызывается в шарде user_id. Если пригласивший в другом шарде, награду начисляет signup().
+    Возвращает (new: bool, credited: bool, ref_by_id or None)
+    """
+    if not _register_user_tx(conn, user_id, ref_by):
+        return False, False, None
+    if ref_by and ref_by != user_id and user_shard(ref_by) != current_shard():
+        return True, False, ref_by
+    credited, ref_id = _credit_referral_savepoint(conn, user_id)
+    return True, credited, ref_id
+
+def credit_referrer(new_user: int, ref_by: int, force: bool = False) -> bool:
+    """
+    Награда пригласившему из другого шарда — в его шарде, одной транзакцией.
+    Повтор безопасен: referral_credits пропустит уже начисленного new_user.
+    """
+    conn = get_conn()
+    mark = _effects_mark()
+    try:
+        with conn:
+            _begin_immediate(conn)
+            if not conn.execute("SELECT 1 FROM users WHERE user_id=?", (ref_by,)).fetchone():
+                return False
+            if not force and referral_graph.should_hold(ref_by):
+                return False
+            cur = conn.execute("INSERT OR IGNORE INTO referral_credits (new_user, ref_by, credited_ts) VALUES (?, ?, ?)",
+                               (new_user, ref_by, int(time.time())))
+            if not cur.rowcount:
+                return True
+            conn.execute("UPDATE users SET refs_count = refs_count + 1 WHERE user_id=?", (ref_by,))
+            _insert_tokens(conn, ref_by, REF_REWARD)
+    except IPAMExhausted:
+        _effects_rollback(mark)
+        log.warning("[ipam] адреса закончились: награда %s за %s не начислена, осталась в задержанных",
+                    ref_by, new_user)
+        return False
+    return True
+
+def held_referrals(ref_by: int) -> list:
+    """Приглашённые ref_by, за которых награда ещё не выдана (задержана или пригласивший тогда не существовал)."""
+    return [r[0] for r in get_conn().execute(
+        "SELECT new_user FROM referrals WHERE ref_by=? AND credited=0", (ref_by,))]
+
+def mark_referral_credited(new_user: int):
+    conn = get_conn()
+    conn.execute("UPDATE referrals SET credited=1 WHERE new_user=?", (new_user,))
+    conn.commit()
+
+async def signup(user_id: int, ref_by: Optional[int]):
+    """
+    Регистрация с наградой в шарде пользователя — групповым коммитом вместе с другими /start;
+    при пригласившем из другого шарда — ещё два коротких захода.
+    """
+    shard = user_shard(user_id)
+    new, credited, ref_id = await db_write_grouped(shard, _register_and_credit_tx, user_id, ref_by)
+    if new and ref_id and not credited and user_shard(ref_id) != shard:
+        # сначала начисление (идемпотентно), потом отметка: сбой между ними не даст двойной награды
+        credited = await db_write_on(user_shard(ref_id), credit_referrer, user_id, ref_id)
+        if credited:
+            await db_write_on(shard, mark_referral_credited, user_id)
+    return new, credited, ref_id
+
 def user_tokens_last_24h_count(user_id: int) -> int:
     conn = get_conn()
     c = conn.cursor()
-    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(hours=24)).isoformat()
-    c.execute("SELECT COUNT(*) FROM tokens WHERE user_id=? AND created_at >= ?", (user_id, cutoff))
+    cutoff = int(time.time()) - 24 * 3600
+    c.execute("SELECT COUNT(*) FROM tokens WHERE user_id=? AND created_ts >= ?", (user_id, cutoff))
     n = c.fetchone()[0]
-    conn.close()
     return n
 
 # -------------------------
 #  WireGuard key/gen & config
 # -------------------------
+# X25519 (RFC 7748) — тот же алгоритм, что у `wg genkey` / `wg pubkey`
+_X25519_P = 2 ** 255 - 19
+_X25519_A24 = 121665
+
+def _x25519_clamp(k: bytes) -> bytes:
+    k = bytearray(k)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    return bytes(k)
+
+def _x25519_base_py(k: bytes) -> bytes:
+    """Публичный ключ для приватного k: умножение на базовую точку u=9 (Montgomery ladder)."""
+    p = _X25519_P
+    n = int.from_bytes(_x25519_clamp(k), "little")
+    x1 = 9
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        bit = (n >> t) & 1
+        swap ^= bit
+        if swap:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = bit
+        a = x2 + z2
+        aa = a * a
+        b = x2 - z2
+        bb = b * b
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % p
+        cb = c * b % p
+        x3 = (da + cb) ** 2 % p
+        z3 = x1 * (da - cb) ** 2 % p
+        x2 = aa * bb % p
+        z2 = e * (aa + _X25519_A24 * e) % p
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, p - 2, p) % p).to_bytes(32, "little")
+
+def _new_wg_keypair():
+    started = time.perf_counter()
+    priv = _x25519_clamp(secrets.token_bytes(32))
+    if X25519PrivateKey is not None:
+        pub = X25519PrivateKey.from_private_bytes(priv).public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    else:
+        pub = _x25519_base_py(priv)
+    WG_KEYGEN_SECONDS.observe(time.perf_counter() - started)
+    return base64.b64encode(priv).decode(), base64.b64encode(pub).decode()
+
+class WGKeyPool:
+    """
+    Пул заранее сгенерированных пар ключей. take() отдаёт готовую пару за O(1);
+    фоновый поток доливает пул, когда в нём остаётся меньше половины.
+    take() можно вызывать из любого потока (deque.append/popleft атомарны).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._keys = deque()
+        self._wake = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self._thread is None and self.size > 0:
+            self._thread = threading.Thread(target=self._run, name="wg-key-pool", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            while len(self._keys) < self.size:
+                self._keys.append(_new_wg_keypair())
+            self._wake.wait()
+
+    def take(self):
+        try:
+            pair = self._keys.popleft()
+            self.hits += 1
+        except IndexError:
+            pair = _new_wg_keypair()
+            self.misses += 1
+        if len(self._keys) < self.size // 2:
+            self._wake.set()
+        return pair
+
+    def __len__(self):
+        return len(self._keys)
+
+wg_key_pool = WGKeyPool(WG_KEY_POOL_SIZE)
+
 def generate_wg_keypair():
     """
-    Попытка получить реальный ключ через wg genkey / wg pubkey.
-    Если эти утилиты недоступны — используем безопасный fallback (псевдоключи, основанные на случайных байтах).
-    Возвращает (private_key, public_key, used_real_tools_bool)
+    Пара ключей WireGuard (base64, как у wg genkey / wg pubkey), берётся из пула.
+    Возвращает (private_key, public_key, used_real_tools_bool) — ключи всегда настоящие X25519.
     """
-    try:
-        p = subprocess.run(["wg", "genkey"], capture_output=True, check=True, text=True, timeout=3)
-        priv = p.stdout.strip()
-        q = subprocess.run(["echo", priv], capture_output=True, text=True)
-        # get pubkey via pipe to wg pubkey
-        p2 = subprocess.Popen(["wg", "pubkey"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        out, err = p2.communicate(priv + "\n", timeout=3)
-        pub = out.strip()
-        if priv and pub:
-            return priv, pub, True
-    except Exception:
-        # fallback
-        raw = secrets.token_bytes(DEFAULT_TOKEN_BYTES)
-        priv = secrets.token_urlsafe(32)
-        # public placeholder: base64-like
-        pub = secrets.token_urlsafe(32)
-        return priv, pub, False
+    priv, pub = wg_key_pool.take()
+    return priv, pub, True
 
 def generate_wg_config(client_public_key: str, client_ip: str = "10.66.66.2/32"):
     """
@@ -218,96 +1243,1174 @@ PersistentKeepalive = 25
     # note: we will replace <client_private_key_replace_on_server> with actual private when giving true keys
     return cfg
 
-def _create_token_db(user_id: int, generate_wg_keys: bool = True):
+# -------------------------
+#  IPAM: адреса клиентов
+# -------------------------
+class IPAMExhausted(Exception):
+    pass
+
+class IPAM:
     """
-    Внутренний: создаёт запись токена в БД и (опционально) генерирует wg-ключи.
-    Возвращает (token, expires_iso, private_key, public_key)
+    Выдача адресов клиентам из WG_CLIENT_SUBNET (и парного адреса из WG_CLIENT_SUBNET6).
+    Адрес задаётся смещением host в подсети (1 — сервер, клиенты с 2).
+    Таблица ip_allocations — источник истины; в памяти битовая карта занятых и очередь свободных,
+    поэтому выдача за O(1). Методы вызываются в потоке-писателе своего шарда, внутри его транзакции.
+    Освобождение адреса погашенного токена — это удаление пира: оно пишется в журнал peer_events.
+    У каждого шарда свой IPAM и своя доля адресов (host % shards == shard), поэтому шарды не выдают
+    один адрес дважды. Занятыми при загрузке считаются адреса всех шардов: после решардинга
+    в шарде могут оказаться чужие адреса, а свои — в других шардах.
     """
-    conn = get_conn()
-    c = conn.cursor()
-    token = secrets.token_urlsafe(16)
-    now = datetime.datetime.utcnow()
+
+    def __init__(self, subnet4: str, subnet6: str, max_hosts: int, shard: int = 0, shards: int = 1):
+        self.net4 = ipaddress.ip_network(subnet4) if subnet4 else None
+        self.net6 = ipaddress.ip_network(subnet6) if subnet6 else None
+        if not self.net4 and not self.net6:
+            raise ValueError("нужна хотя бы одна подсеть: WG_CLIENT_SUBNET или WG_CLIENT_SUBNET6")
+        sizes = [max_hosts]
+        if self.net4:
+            sizes.append(self.net4.num_addresses - 1)  # без broadcast
+        if self.net6:
+            sizes.append(self.net6.num_addresses)
+        self.end = min(sizes)  # host в диапазоне [2, end)
+        self.shard = shard
+        self.shards = shards
+        self.capacity = len(range(2 + (shard - 2) % shards, self.end, shards))
+        self._bitmap = bytearray((self.end + 7) // 8)
+        self._free = deque()
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.exhausted = 0  # отказов в адресе: подсеть заполнена
+
+    def _is_set(self, host: int) -> bool:
+        return bool(self._bitmap[host >> 3] & (1 << (host & 7)))
+
+    def _set(self, host: int):
+        self._bitmap[host >> 3] |= 1 << (host & 7)
+
+    def _own(self, host: int) -> bool:
+        return host % self.shards == self.shard
+
+    def _clear(self, host: int):
+        self._bitmap[host >> 3] &= ~(1 << (host & 7)) & 0xFF
+        if self._own(host):  # чужой адрес (остался после решардинга) выдаёт только его шард
+            self._free.append(host)
+
+    def address(self, host: int) -> str:
+        """Строка для Address/AllowedIPs: "10.66.66.5/32" или "10.66.66.5/32, fd66::5/128"."""
+        parts = []
+        if self.net4:
+            parts.append(f"{self.net4[host]}/32")
+        if self.net6:
+            parts.append(f"{self.net6[host]}/128")
+        return ", ".join(parts)
+
+    def load(self):
+        with self._lock:
+            self._bitmap = bytearray(len(self._bitmap))
+            for shard in range(self.shards):
+                for (host,) in get_conn(shard).execute("SELECT host FROM ip_allocations"):
+                    if 2 <= host < self.end:
+                        self._set(host)
+            self._free = deque(h for h in range(2, self.end) if self._own(h) and not self._is_set(h))
+            self._loaded = True
+
+    def _reclaim_expired_locked(self, now: int) -> int:
+        conn = get_conn(self.shard)
+        rows = conn.execute(
+            "DELETE FROM ip_allocations WHERE expires_ts < ? RETURNING host, token", (now,)).fetchall()
+        for host, _ in rows:
+            if 2 <= host < self.end:
+                self._clear(host)
+        log_peer_removals(conn, [token for _, token in rows])
+        return len(rows)
+
+    def allocate(self, token: str, user_id: int, expires_ts: int) -> tuple:
+        """Занять адрес под токен. Возвращает (host, address). Бросает IPAMExhausted."""
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            conn = get_conn(self.shard)
+            reclaimed = reloaded = False
+            while True:
+                if not self._free:
+                    if reloaded:
+                        self.exhausted += 1
+                        raise IPAMExhausted()
+                    if not reclaimed:
+                        reclaimed = True
+                        if self._reclaim_expired_locked(int(time.time())):
+                            continue
+                    # адреса могли освободить другие воркеры — у каждого своя карта в памяти
+                    self.load()
+                    reloaded = True
+                    continue
+                host = self._free.popleft()
+                if self._is_set(host):
+                    continue
+                try:
+                    conn.execute(
+                        "INSERT INTO ip_allocations (host, token, user_id, expires_ts, allocated_ts) VALUES (?, ?, ?, ?, ?)",
+                        (host, token, user_id, expires_ts, int(time.time())))
+                except sqlite3.IntegrityError:
+                    self._set(host)  # адрес занял другой процесс
+                    continue
+                self._set(host)
+                on_rollback(self.forget, host)
+                return host, self.address(host)
+
+    def forget(self, host: int):
+        """Вернуть адрес в память после отката транзакции, в которой он был выдан."""
+        with self._lock:
+            if self._is_set(host):
+                self._clear(host)
+
+    def release_tokens(self, tokens) -> int:
+        """Освободить адреса указанных токенов (отзыв, удаление). Строки tokens должны быть ещё на месте."""
+        tokens = list(tokens)
+        if not tokens:
+            return 0
+        released = []
+        with self._lock:
+            conn = get_conn(self.shard)
+            for token in tokens:
+                row = conn.execute("DELETE FROM ip_allocations WHERE token=? RETURNING host", (token,)).fetchone()
+                if not row:
+                    continue
+                if 2 <= row[0] < self.end:  # адрес вне карты (сменилась подсеть) — но пир всё равно удаляется
+                    self._clear(row[0])
+                released.append(token)
+            log_peer_removals(conn, released)
+        return len(released)
+
+    def reclaim_expired(self) -> int:
+        with self._lock:
+            return self._reclaim_expired_locked(int(time.time()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"capacity": self.capacity, "free": len(self._free)}
+
+ipams = [IPAM(WG_CLIENT_SUBNET, WG_CLIENT_SUBNET6, IPAM_MAX_HOSTS, i, DB_SHARDS) for i in range(DB_SHARDS)]
+
+def current_ipam() -> IPAM:
+    """IPAM шарда, в потоке которого идёт запрос."""
+    return ipams[current_shard()]
+
+def ipam_stats() -> dict:
+    stats = [i.stats() for i in ipams]
+    return {"capacity": sum(st["capacity"] for st in stats), "free": sum(st["free"] for st in stats)}
+
+def _insert_tokens(conn: sqlite3.Connection, user_id: int, count: int, generate_wg_keys: bool = True) -> list:
+    """
+    Внутренний: count токенов для user_id одним executemany внутри текущей транзакции (без commit),
+    каждому — адрес из IPAM и (опционально) wg-ключи.
+    Возвращает [(token, expires_iso, private_key, public_key, client_ip), ...]
+    """
+    now_ts = time.time()
+    now = datetime.datetime.utcfromtimestamp(now_ts)
     expires = now + datetime.timedelta(hours=TOKEN_LIFETIME_HOURS)
-    priv, pub = None, None
-    used_real = False
-    if generate_wg_keys:
-        priv, pub, used_real = generate_wg_keypair()
-    c.execute(
-        "INSERT INTO tokens (token, user_id, created_at, expires_at, used, wg_private, wg_public) VALUES (?, ?, ?, ?, 0, ?, ?)",
-        (token, user_id, now.isoformat(), expires.isoformat(), priv or "", pub or "")
-    )
-    conn.commit()
-    conn.close()
-    return token, expires.isoformat(), priv, pub
+    created_ts = int(now_ts)
+    expires_ts = created_ts + TOKEN_LIFETIME_HOURS * 3600
+    rows, out = [], []
+    # занятые адреса вернёт в карту откат транзакции (IPAM.allocate регистрирует on_rollback)
+    for _ in range(count):
+        token = f"{user_bucket(user_id)}.{secrets.token_urlsafe(16)}"
+        priv, pub = None, None
+        if generate_wg_keys:
+            priv, pub, used_real = generate_wg_keypair()
+        host, client_ip = current_ipam().allocate(token, user_id, expires_ts)
+        rows.append((token, user_id, now.isoformat(), expires.isoformat(), priv or "", pub or "",
+                     created_ts, expires_ts, client_ip))
+        out.append((token, expires.isoformat(), priv, pub, client_ip))
+    conn.executemany(
+        "INSERT INTO tokens (token, user_id, created_at, expires_at, used, wg_private, wg_public, created_ts,"
+        " expires_ts, client_ip) VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?)", rows)
+    # в фильтр — после commit, но до того, как токен уйдёт владельцу: _run_group применяет до возврата
+    on_commit(token_filter.add, [row[0] for row in rows], created_ts)
+    on_commit(token_quota.record, user_id, created_ts, count)
+    return out
 
-def create_token_for_user(user_id: int):
+def _create_token_tx(conn: sqlite3.Connection, user_id: int):
     """
-    Основная функция для создания токена (с учётом лимита 1 в сутки).
+    Создание токена (с учётом лимита 1 в сутки) внутри текущей транзакции (без commit).
     Возвращает (ok:bool, message_or_dict)
     """
     # лимит в день
-    if user_tokens_last_24h_count(user_id) >= TOKENS_PER_DAY_LIMIT:
+    if token_quota.count(user_id) >= TOKENS_PER_DAY_LIMIT:
         return False, f"Лимит токенов за 24 часа достигнут ({TOKENS_PER_DAY_LIMIT})."
 
-    token, expires, priv, pub = _create_token_db(user_id, generate_wg_keys=True)
+    try:
+        token, expires, priv, pub, client_ip = _insert_tokens(conn, user_id, 1, generate_wg_keys=True)[0]
+    except IPAMExhausted:
+        return False, "Свободные адреса VPN закончились, попробуйте позже."
     # сформируем клиентский конфиг: заполним приватный ключ клиента (priv) в шаблоне
-    client_ip_base = "10.66.66."  # очень простое распределение — можно улучшить
-    # count tokens for user to assign IP suffix
-    cnt = user_tokens_last_24h_count(user_id)
-    suffix = 2 + cnt  # простая логика, можно улучшить
-    client_ip = f"10.66.66.{suffix}/32"
     cfg = generate_wg_config(pub or "<pubkey>", client_ip)
     # вставляем реальный private в [Interface] при возможности (если priv есть)
     if priv:
         cfg = cfg.replace("<client_private_key_replace_on_server>", priv)
-    return True, {"token": token, "expires": expires, "wg_config": cfg, "priv": priv, "pub": pub}
+    return True, {"token": token, "expires": expires, "wg_config": cfg, "priv": priv, "pub": pub,
+                  "client_ip": client_ip}
 
-def list_user_tokens(user_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT token, created_at, expires_at, used, wg_public FROM tokens WHERE user_id=? ORDER BY created_at DESC", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+async def create_token_for_user(user_id: int):
+    """Основная функция для создания токена: _create_token_tx в шарде пользователя, групповым коммитом."""
+    return await db_write_grouped(user_shard(user_id), _create_token_tx, user_id)
 
-def redeem_token_api(token: str):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT token, user_id, expires_at, used, wg_private, wg_public FROM tokens WHERE token=?", (token,))
+def get_refs_count(user_id: int) -> int:
+    c = get_conn().cursor()
+    c.execute("SELECT refs_count FROM users WHERE user_id=?", (user_id,))
     row = c.fetchone()
+    return row[0] if row else 0
+
+def get_user(user_id: int):
+    c = get_conn().cursor()
+    c.execute("SELECT user_id, ref_by, refs_count, joined_at, paid FROM users WHERE user_id=?", (user_id,))
+    return c.fetchone()
+
+def find_tokens_by_prefix(prefix: str, limit: int):
+    # диапазон по PRIMARY KEY вместо LIKE — поиск по индексу, а не скан
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    c = get_conn().cursor()
+    c.execute("SELECT token, user_id, created_at, expires_at, used FROM tokens WHERE token >= ? AND token < ?"
+              " ORDER BY token LIMIT ?", (prefix, upper, limit))
+    return c.fetchall()
+
+# -------------------------
+#  Постраничные списки (keyset)
+# -------------------------
+# Страницы выбираются по ключу сортировки граничной строки, а не OFFSET: каждая страница — LIMIT по индексу.
+# Ключ (значения колонок keys) передаётся в callback_data кнопок "Новее"/"Старее": "<list>|<n|p>|<k1>|<k2>".
+# list -> (SELECT, колонки ключа, типы ключа, условие WHERE для scope, размер страницы, только для админов)
+LISTINGS = {
+    "au": ("SELECT joined_at, user_id, ref_by, refs_count, paid FROM users",
+           ("joined_at", "user_id"), (str, int), None, ADMIN_PAGE_SIZE, True),
+    "at": ("SELECT created_ts, token, user_id, created_at, expires_at, used FROM tokens",
+           ("created_ts", "token"), (int, str), None, ADMIN_PAGE_SIZE, True),
+    "ut": ("SELECT created_ts, token, user_id, created_at, expires_at, used FROM tokens",
+           ("created_ts", "token"), (int, str), "user_id=?", ADMIN_PAGE_SIZE, True),
+    "mt": ("SELECT created_ts, token, created_at, expires_at, used, wg_public, client_ip FROM tokens",
+           ("created_ts", "token"), (int, str), "user_id=?", USER_PAGE_SIZE, False),
+}
+
+def fetch_page(listing: str, scope: Optional[int], cursor: Optional[tuple], direction: str = "n"):
+    """
+    Страница списка по убыванию ключа. direction "n" — строки старее cursor, "p" — новее.
+    Возвращает (rows, has_more): rows всегда от новых к старым, has_more — есть ли ещё строки в том же направлении.
+    """
+    select, keys, _, scope_where, size, _ = LISTINGS[listing]
+    where, args = [], []
+    if scope_where:
+        where.append(scope_where)
+        args.append(scope)
+    if cursor:
+        where.append(f"({', '.join(keys)}) {'<' if direction == 'n' else '>'} ({', '.join('?' * len(keys))})")
+        args.extend(cursor)
+    order = "DESC" if direction == "n" else "ASC"
+    sql = select + (" WHERE " + " AND ".join(where) if where else "")
+    sql += " ORDER BY " + ", ".join(f"{k} {order}" for k in keys) + " LIMIT ?"
+    rows = get_conn().execute(sql, (*args, size + 1)).fetchall()
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if direction == "p":
+        rows.reverse()
+    return rows, has_more
+
+async def read_page(listing: str, scope: Optional[int], cursor: Optional[tuple], direction: str = "n"):
+    """
+    fetch_page с учётом шардов: список одного пользователя — из его шарда; общие списки — страница
+    с каждого шарда и слияние по ключу (ключ — первые колонки SELECT), лишнее отбрасывается.
+    """
+    if scope is not None:
+        return await db_read_on(user_shard(scope), fetch_page, listing, scope, cursor, direction)
+    pages = await db_read_all(fetch_page, listing, scope, cursor, direction)
+    if len(pages) == 1:
+        return pages[0]
+    nkeys, size = len(LISTINGS[listing][1]), LISTINGS[listing][4]
+    rows = sorted((row for page, _ in pages for row in page), key=lambda row: row[:nkeys], reverse=True)
+    has_more = len(rows) > size or any(more for _, more in pages)
+    # "n" — ближайшие к курсору самые новые из старых, "p" — самые старые из новых
+    return (rows[:size] if direction == "n" else rows[-size:]), has_more
+
+# статус погашения -> HTTP-подобный код для /redeem_batch
+REDEEM_STATUS_CODES = {"ok": 200, "bad_token": 400, "not_found": 404, "already_used": 409,
+                       "expired": 410, "revoked": 410}
+
+def _redeem_one(conn: sqlite3.Connection, token: str, now: int):
+    """
+    Погашение одним условным UPDATE ... RETURNING: два сервера не могут погасить один токен дважды.
+    Причину отказа выясняем отдельным SELECT только на неуспешном пути. Коммит — на вызывающем.
+    Погашенный токен с ключом и адресом IPAM — новый пир: пишется в журнал peer_events той же транзакцией.
+    """
+    rows = conn.execute(
+        "UPDATE tokens SET used=1 WHERE token=? AND used=0 AND revoked=0 AND expires_ts >= ?"
+        " RETURNING user_id, wg_private, wg_public, expires_at, client_ip, expires_ts",
+        (token, now)).fetchall()
+    if rows:
+        user_id, wg_priv, wg_pub, expires_at, client_ip, expires_ts = rows[0]
+        if wg_pub:
+            # только пиры с адресом в ip_allocations: их "remove" пишет IPAM, и они же попадают в снимок
+            conn.execute("INSERT INTO peer_events (op, token, wg_public, client_ip, expires_ts, ts)"
+                         " SELECT 'add', ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM ip_allocations WHERE token=?)",
+                         (token, wg_pub, client_ip, expires_ts, now, token))
+        return True, "ok", {"user_id": user_id, "wg_private": wg_priv, "wg_public": wg_pub,
+                            "expires_at": expires_at, "client_ip": client_ip}
+    row = conn.execute("SELECT used, revoked FROM tokens WHERE token=?", (token,)).fetchone()
     if not row:
-        conn.close()
         return False, "not_found", None
-    token_v, user_id, expires_at, used, wg_priv, wg_pub = row
-    exp = datetime.datetime.fromisoformat(expires_at)
-    now = datetime.datetime.utcnow()
+    used, revoked = row
+    if revoked:
+        return False, "revoked", None
     if used:
-        conn.close()
         return False, "already_used", None
-    if now > exp:
-        conn.close()
-        return False, "expired", None
-    # пометка как использован
-    c.execute("UPDATE tokens SET used=1 WHERE token=?", (token,))
+    return False, "expired", None
+
+def redeem_token_api(token: str):
+    conn = get_conn()
+    res = _redeem_one(conn, token, int(time.time()))
     conn.commit()
-    conn.close()
-    return True, "ok", {"user_id": user_id, "wg_private": wg_priv, "wg_public": wg_pub, "expires_at": expires_at}
+    return res
 
-# -------------------------
-#  Проверка подписки
-# -------------------------
-async def check_subscription(user_id: int) -> bool:
-    try:
-        mem = await bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        return mem.status in ("member", "administrator", "creator")
-    except TelegramBadRequest:
+def redeem_tokens_batch(tokens: list):
+    """Погасить список токенов в одной транзакции. Возвращает [(token, ok, code, info), ...]."""
+    conn = get_conn()
+    now = int(time.time())
+    out = []
+    for token in tokens:
+        if not isinstance(token, str) or not token:
+            out.append((token, False, "bad_token", None))
+            continue
+        out.append((token, *_redeem_one(conn, token, now)))
+    conn.commit()
+    return out
+
+def revoke_token(token: str) -> bool:
+    conn = get_conn()
+    cur = conn.execute("UPDATE tokens SET revoked=1 WHERE token=? AND revoked=0", (token,))
+    if not cur.rowcount:
         return False
+    current_ipam().release_tokens([token])
+    conn.commit()
+    return True
 
-def sub_keyboard():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Подписаться 📢", url=f"https://t.me/{REQUIRED_CHANNEL[1:]}")],
-        [InlineKeyboardButton(text="Проверить 🔄", callback_data="check_sub")]
-    ])
+async def redeem_token(token: str):
+    """redeem_token_api в шарде токена; старые токены без префикса ищутся по всем шардам."""
+    res = (False, "not_found", None)
+    if not await token_maybe_live(token):
+        REDEEM_REJECTED["filter"].inc()
+        return res
+    for shard in token_shards(token):
+        res = await db_write_on(shard, redeem_token_api, token)
+        if res[1] != "not_found":
+            break
+    if res[0]:
+        notify_peers()
+    return res
+
+async def redeem_batch(tokens: list):
+    """
+    redeem_tokens_batch по шардам: одна транзакция на шард, шарды параллельно.
+    Старые токены без префикса, не найденные в очередном шарде, пробуются в следующем.
+    Результаты — в порядке входного списка.
+    """
+    out = [None] * len(tokens)
+    # не-строки и пустые — сразу bad_token, ни фильтр, ни база их не видят
+    valid = [isinstance(t, str) and bool(t) for t in tokens]
+    for i, ok in enumerate(valid):
+        if not ok:
+            out[i] = (tokens[i], False, "bad_token", None)
+    candidates = [token_shards(t) if ok else [] for t, ok in zip(tokens, valid)]
+    # неизвестные фильтру — сразу not_found; догрузка из соседних воркеров — одна на весь запрос
+    unknown = [i for i, t in enumerate(tokens) if valid[i] and not token_filter.might_contain(t)]
+    if unknown and token_filter.shared:
+        await token_filter_catch_up()
+        unknown = [i for i in unknown if not token_filter.might_contain(tokens[i])]
+    for i in unknown:
+        candidates[i] = []
+    REDEEM_REJECTED["filter"].inc(len(unknown))
+    pending = range(len(tokens))
+    for attempt in range(DB_SHARDS):
+        by_shard = {}
+        for i in pending:
+            if attempt < len(candidates[i]):
+                by_shard.setdefault(candidates[i][attempt], []).append(i)
+        if not by_shard:
+            break
+        results = await asyncio.gather(*(db_write_on(shard, redeem_tokens_batch, [tokens[i] for i in idx])
+                                         for shard, idx in by_shard.items()))
+        pending = []
+        for idx, res in zip(by_shard.values(), results):
+            for i, r in zip(idx, res):
+                out[i] = r
+                if r[2] == "not_found":
+                    pending.append(i)
+    if any(r and r[1] for r in out):
+        notify_peers()
+    return [r or (tokens[i], False, "not_found", None) for i, r in enumerate(out)]
+
+async def revoke(token: str) -> bool:
+    for shard in token_shards(token):
+        if await db_write_on(shard, revoke_token, token):
+            notify_peers()
+            return True
+    return False
+
+async def find_tokens(prefix: str, limit: int) -> list:
+    chunks = await asyncio.gather(*(db_read_on(shard, find_tokens_by_prefix, prefix, limit)
+                                    for shard in token_shards(prefix)))
+    return list(heapq.merge(*chunks))[:limit]
+
+def shard_counts() -> tuple:
+    conn = get_conn()
+    return (conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0])
+
+# -------------------------
+#  Лента пиров (/peers)
+# -------------------------
+# VPN-серверы синхронизируют список пиров по журналу peer_events: "add" пишется при погашении токена,
+# "remove" — когда IPAM освобождает адрес погашенного токена (отзыв, истечение, чистка).
+# Версия у каждого шарда своя, курсор клиента — версии всех шардов через дефис: "120-87-3".
+# Курсор, которого нет в журнале (почищен, другое число шардов, база после reshard.py), — полный снимок.
+_peers_changed = asyncio.Event()  # будит long-poll; изменения из других воркеров видны по опросу журнала
+peers_waiting = 0  # клиентов /peers в long-poll
+
+def notify_peers():
+    global _peers_changed
+    _peers_changed.set()
+    _peers_changed = asyncio.Event()
+
+def log_peer_removals(conn: sqlite3.Connection, tokens: list):
+    """Записать удаление пиров погашенных токенов; вызывается из IPAM в его транзакции."""
+    now = int(time.time())
+    for i in range(0, len(tokens), 500):
+        chunk = tokens[i:i + 500]
+        conn.execute(
+            "INSERT INTO peer_events (op, token, wg_public, client_ip, expires_ts, ts)"
+            " SELECT 'remove', token, wg_public, client_ip, expires_ts, ? FROM tokens"
+            f" WHERE token IN ({','.join('?' * len(chunk))}) AND used=1 AND wg_public != ''", (now, *chunk))
+
+def _peer_log_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='peer_events'").fetchone()
+    return row[0] if row else 0
+
+def peer_changes(since: int, limit: int):
+    """
+    Записи журнала шарда после версии since: (версия, строки, есть_ещё).
+    None — since вне журнала (почищен или из другой базы), клиенту нужен снимок.
+    """
+    conn = get_conn()
+    last = _peer_log_version(conn)
+    first = conn.execute("SELECT MIN(version) FROM peer_events").fetchone()[0] or last + 1
+    if not first - 1 <= since <= last:
+        return None
+    rows = conn.execute(
+        "SELECT version, op, token, wg_public, client_ip, expires_ts FROM peer_events"
+        " WHERE version > ? ORDER BY version LIMIT ?", (since, limit)).fetchall()
+    return (rows[-1][0] if rows else since), rows, len(rows) == limit
+
+def peer_snapshot():
+    """Все пиры шарда и версия журнала, на которой снят снимок (одна транзакция чтения)."""
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        version = _peer_log_version(conn)
+        rows = conn.execute(
+            "SELECT t.token, t.wg_public, t.client_ip, t.expires_ts FROM ip_allocations a"
+            " JOIN tokens t ON t.token = a.token WHERE t.used=1 AND t.revoked=0 AND t.wg_public != ''").fetchall()
+    finally:
+        conn.commit()
+    return version, rows
+
+def prune_peer_events(limit: int) -> int:
+    """Одна пачка записей журнала пиров старше PEER_LOG_DAYS."""
+    conn = get_conn()
+    cutoff = int(time.time()) - PEER_LOG_DAYS * 86400
+    n = conn.execute(
+        "DELETE FROM peer_events WHERE version IN (SELECT version FROM peer_events WHERE ts < ? LIMIT ?)",
+        (cutoff, limit)).rowcount
+    conn.commit()
+    return n
+
+def parse_peers_cursor(raw: Optional[str]) -> Optional[list]:
+    """"120-87-3" -> [120, 87, 3]; None — курсора нет или он от другого числа шардов."""
+    parts = raw.split("-") if raw else []
+    if len(parts) != DB_SHARDS or not all(p.isdigit() for p in parts):
+        return None
+    return [int(p) for p in parts]
+
+def _peer_json(public_key, allowed_ips, expires_ts=None) -> dict:
+    peer = {"public_key": public_key, "allowed_ips": allowed_ips}
+    if expires_ts is not None:
+        peer["expires_ts"] = expires_ts
+    return peer
+
+async def peers_feed(cursor: Optional[list]) -> dict:
+    """
+    Изменения пиров после cursor или полный снимок ("reset": true).
+    По каждому пиру остаётся последнее действие; добавленный и удалённый после cursor не попадает никуда.
+    "more": true — в журнале есть ещё, клиент сразу запрашивает с новой версией.
+    """
+    if cursor is not None:
+        results = await asyncio.gather(*(db_read_on(i, peer_changes, since, PEERS_PAGE)
+                                         for i, since in enumerate(cursor)))
+        if all(r is not None for r in results):
+            added, removed = {}, {}
+            for _, rows, _ in results:
+                for _, op, token, wg_public, client_ip, expires_ts in rows:
+                    if op == "add":
+                        added[token] = _peer_json(wg_public, client_ip, expires_ts)
+                    elif added.pop(token, None) is None:
+                        removed[token] = _peer_json(wg_public, client_ip)
+            return {"version": "-".join(str(r[0]) for r in results), "reset": False,
+                    "more": any(r[2] for r in results),
+                    "add": list(added.values()), "remove": list(removed.values())}
+    snapshots = await db_read_all(peer_snapshot)
+    return {"version": "-".join(str(version) for version, _ in snapshots), "reset": True, "more": False,
+            "add": [_peer_json(*row[1:]) for _, rows in snapshots for row in rows], "remove": []}
+
+async def wait_peers(cursor: list, wait: float) -> dict:
+    """peers_feed, но если изменений нет — ждать их до wait сек (long-poll)."""
+    global peers_waiting
+    deadline = time.monotonic() + wait
+    peers_waiting += 1
+    try:
+        while True:
+            changed = _peers_changed  # до чтения журнала, чтобы не пропустить notify между ними
+            feed = await peers_feed(cursor)
+            left = deadline - time.monotonic()
+            if feed["reset"] or feed["version"] != "-".join(map(str, cursor)) or left <= 0:
+                return feed
+            try:
+                await asyncio.wait_for(changed.wait(), min(left, PEERS_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        peers_waiting -= 1
+
+# -------------------------
+#  Кэш
+# -------------------------
+class TTLCache:
+    """
+    Ограниченный по размеру LRU-кэш, у каждой записи свой TTL.
+    Не потокобезопасен — используется только из event loop.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_monotonic, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_ratio": self.hits / total if total else 0.0}
+
+# общий кэш для ответов Telegram API: ("sub", user_id) -> bool, ("me",) -> User
+tg_cache = TTLCache(TG_CACHE_SIZE)
+
+# -------------------------
+#  Экспорт (потоковый, gzip)
+# -------------------------
+# набор данных -> (SELECT, колонки, колонка даты для фильтра from/to, дата в epoch?)
+EXPORT_DATASETS = {
+    "users": ("SELECT user_id, ref_by, refs_count, joined_at, paid FROM users",
+              ["user_id", "ref_by", "refs_count", "joined_at", "paid"], "joined_at", False),
+    "tokens": ("SELECT token, user_id, created_at, expires_at, used, revoked, client_ip FROM tokens",
+               ["token", "user_id", "created_at", "expires_at", "used", "revoked", "client_ip"], "created_ts", True),
+}
+
+class SpooledInputFile(InputFile):
+    """Документ для Telegram, который читается из временного файла кусками, а не целиком в память."""
+
+    def __init__(self, fileobj, filename: str):
+        super().__init__(filename=filename)
+        self.fileobj = fileobj
+
+    async def read(self, bot):
+        self.fileobj.seek(0)
+        while chunk := self.fileobj.read(self.chunk_size):
+            yield chunk
+
+def _export_query(dataset: str, date_from: Optional[datetime.date], date_to: Optional[datetime.date],
+                  active: bool):
+    sql, _, date_col, epoch = EXPORT_DATASETS[dataset]
+    where, params = [], []
+    for bound, op in ((date_from, ">="), (date_to, "<")):
+        if bound is None:
+            continue
+        if op == "<":
+            bound = bound + datetime.timedelta(days=1)  # to= включительно
+        dt = datetime.datetime.combine(bound, datetime.time())
+        where.append(f"{date_col} {op} ?")
+        params.append(int(dt.replace(tzinfo=datetime.timezone.utc).timestamp()) if epoch else dt.isoformat())
+    if active and dataset == "tokens":
+        where.append("used=0 AND revoked=0 AND expires_ts >= ?")
+        params.append(int(time.time()))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params
+
+def export_dataset(dataset: str, fmt: str, date_from=None, date_to=None, active: bool = False):
+    """
+    Выгрузить набор данных в gzip (csv или ndjson), читая курсор по EXPORT_CHUNK строк.
+    Результат — список частей [(spooled_file, rows)], каждая не больше ~EXPORT_PART_BYTES.
+    Шарды выгружаются друг за другом в те же части. Файлы закрывает вызывающий.
+    """
+    sql, params = _export_query(dataset, date_from, date_to, active)
+    columns = EXPORT_DATASETS[dataset][1]
+    cursors = deque(get_conn(shard).execute(sql, params) for shard in range(DB_SHARDS))
+    parts = []
+    spool = text = writer = None
+    rows_in_part = 0
+
+    def close_part():
+        text.close()  # закрывает gzip (дописывает trailer), сам spool остаётся открытым
+        parts.append((spool, rows_in_part))
+
+    while True:
+        rows = cursors[0].fetchmany(EXPORT_CHUNK)
+        if not rows and len(cursors) > 1:
+            cursors.popleft()
+            continue
+        if spool is None and (rows or not parts):
+            spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MEM)
+            text = io.TextIOWrapper(gzip.GzipFile(fileobj=spool, mode="wb"), encoding="utf-8", newline="")
+            rows_in_part = 0
+            if fmt == "csv":
+                writer = csv.writer(text)
+                writer.writerow(columns)
+        if not rows:
+            break
+        if fmt == "csv":
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                text.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+        rows_in_part += len(rows)
+        text.flush()
+        if spool.tell() >= EXPORT_PART_BYTES:
+            close_part()
+            spool = None
+    if spool is not None:
+        close_part()
+    return parts
+
+def _parse_export_args(args: list):
+    """[users|tokens|all] [csv|ndjson] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [active]"""
+    datasets, fmt, date_from, date_to, active = list(EXPORT_DATASETS), "csv", None, None, False
+    for arg in args:
+        if arg in EXPORT_DATASETS:
+            datasets = [arg]
+        elif arg in ("csv", "ndjson"):
+            fmt = arg
+        elif arg == "active":
+            active = True
+        elif arg.startswith("from="):
+            date_from = datetime.date.fromisoformat(arg[5:])
+        elif arg.startswith("to="):
+            date_to = datetime.date.fromisoformat(arg[3:])
+        elif arg != "all":
+            raise ValueError(arg)
+    return datasets, fmt, date_from, date_to, active
+
+async def send_export(message: Message, datasets, fmt, date_from, date_to, active):
+    for dataset in datasets:
+        parts = await db_read(export_dataset, dataset, fmt, date_from, date_to, active)
+        try:
+            for i, (spool, rows) in enumerate(parts, 1):
+                suffix = f".part{i}" if len(parts) > 1 else ""
+                await message.answer_document(
+                    SpooledInputFile(spool, f"export_{dataset}{suffix}.{fmt}.gz"),
+                    caption=f"{dataset}: {rows} строк" + (f" (часть {i}/{len(parts)})" if len(parts) > 1 else ""))
+        finally:
+            for spool, _ in parts:
+                spool.close()
+
+# -------------------------
+#  Чистильщик истёкших токенов
+# -------------------------
+# последний проход и накопленные итоги — для /dbstats и метрик
+SWEEP_STATS = {"runs": 0, "tokens_last": 0, "tokens_total": 0, "referrals_last": 0, "referrals_total": 0,
+               "ips_reclaimed_total": 0, "last_duration": 0.0, "last_run_ts": 0}
+
+def sweep_expired_tokens(limit: int) -> int:
+    """Одна пачка: до limit истёкших токенов -> архив (или удаление), их адреса освобождаются."""
+    conn = get_conn()
+    cutoff = int(time.time()) - SWEEP_GRACE_HOURS * 3600
+    tokens = [r[0] for r in conn.execute(
+        "SELECT token FROM tokens WHERE expires_ts < ? LIMIT ?", (cutoff, limit))]
+    if not tokens:
+        return 0
+    marks = ",".join("?" * len(tokens))
+    if SWEEP_MODE == "archive":
+        conn.execute(
+            "INSERT OR REPLACE INTO tokens_archive (token, user_id, created_ts, expires_ts, used, revoked, wg_public,"
+            " client_ip, archived_ts) SELECT token, user_id, created_ts, expires_ts, used, revoked, wg_public,"
+            f" client_ip, ? FROM tokens WHERE token IN ({marks})", (int(time.time()), *tokens))
+    current_ipam().release_tokens(tokens)  # до DELETE: журналу пиров нужны ключи из tokens
+    conn.execute(f"DELETE FROM tokens WHERE token IN ({marks})", tokens)
+    conn.commit()
+    token_filter.remove(tokens)  # только после commit: иначе откат оставил бы живой токен вне фильтра
+    return len(tokens)
+
+def sweep_old_referrals(limit: int) -> int:
+    """Одна пачка начисленных рефералов старше REF_ARCHIVE_DAYS -> referrals_archive."""
+    conn = get_conn()
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=REF_ARCHIVE_DAYS)).isoformat()
+    users = [r[0] for r in conn.execute(
+        "SELECT new_user FROM referrals WHERE credited=1 AND created_at < ? LIMIT ?", (cutoff, limit))]
+    if not users:
+        return 0
+    marks = ",".join("?" * len(users))
+    if SWEEP_MODE == "archive":
+        conn.execute(
+            "INSERT OR REPLACE INTO referrals_archive (new_user, ref_by, credited, created_at, archived_ts)"
+            f" SELECT new_user, ref_by, credited, created_at, ? FROM referrals WHERE new_user IN ({marks})",
+            (int(time.time()), *users))
+    conn.execute(f"DELETE FROM referrals WHERE new_user IN ({marks})", users)
+    conn.commit()
+    return len(users)
+
+def reclaim_expired_ips() -> int:
+    """Адреса истёкших токенов шарда -> свободные (и удаления пиров в журнал)."""
+    n = current_ipam().reclaim_expired()
+    get_conn().commit()
+    return n
+
+async def _sweep_shard(shard: int, fn) -> int:
+    # каждая пачка — отдельная короткая транзакция; между ними в очередь писателя успевают другие запросы
+    total = 0
+    while True:
+        n = await db_write_on(shard, fn, SWEEP_BATCH)
+        total += n
+        if n < SWEEP_BATCH:
+            return total
+
+async def _sweep_all(fn) -> int:
+    # у каждого шарда свой писатель — чистим параллельно
+    return sum(await asyncio.gather(*(_sweep_shard(i, fn) for i in range(DB_SHARDS))))
+
+async def expiry_sweeper():
+    while True:
+        started = time.perf_counter()
+        try:
+            tokens = await _sweep_all(sweep_expired_tokens)
+            refs = await _sweep_all(sweep_old_referrals) if REF_ARCHIVE_DAYS > 0 else 0
+            ips = sum(await db_write_all(reclaim_expired_ips))
+            if tokens or ips:
+                notify_peers()
+            await _sweep_all(prune_peer_events)
+            await _sweep_all(rollup_traffic)
+            token_quota.prune()
+            referral_graph.prune()
+            await prune_admin_flows()
+        except Exception:
+            log.exception("[sweeper] ошибка")
+        else:
+            SWEEP_STATS["runs"] += 1
+            SWEEP_STATS["tokens_last"] = tokens
+            SWEEP_STATS["tokens_total"] += tokens
+            SWEEP_STATS["referrals_last"] = refs
+            SWEEP_STATS["referrals_total"] += refs
+            SWEEP_STATS["ips_reclaimed_total"] += ips
+            SWEEP_STATS["last_duration"] = time.perf_counter() - started
+            SWEEP_STATS["last_run_ts"] = int(time.time())
+            if tokens or refs:
+                log.info("[sweeper] токенов: %d, рефералов: %d, за %.2f c", tokens, refs, SWEEP_STATS["last_duration"])
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+# -------------------------
+#  Антифлуд и дневная квота
+# -------------------------
+class SlidingWindowLimiter:
+    """
+    Не больше limit событий за window секунд на ключ (скользящее окно).
+    Окна хранятся в TTLCache: ключи без активности вытесняются сами.
+    """
+
+    def __init__(self, limit: int, window: float, maxsize: int = 100000):
+        self.limit = limit
+        self.window = window
+        self._hits = TTLCache(maxsize)
+        self.dropped = 0
+
+    async def allow(self, key) -> bool:
+        now = time.monotonic()
+        q = self._hits.get(key)
+        if q is None:
+            q = deque()
+        while q and q[0] <= now - self.window:
+            q.popleft()
+        allowed = len(q) < self.limit
+        if allowed:
+            q.append(now)
+        else:
+            self.dropped += 1
+        self._hits.set(key, q, self.window)
+        return allowed
+
+class RedisSlidingWindowLimiter:
+    """То же окно в Redis (sorted set на ключ) — лимит общий для всех воркеров бота."""
+
+    def __init__(self, url: str, limit: int, window: float):
+        import redis.asyncio as aioredis
+        self._redis = aioredis.from_url(url)
+        self.limit = limit
+        self.window = window
+        self.dropped = 0
+
+    async def allow(self, key) -> bool:
+        now = time.time()
+        rkey = f"flood:{key}"
+        try:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(rkey, 0, now - self.window)
+                pipe.zadd(rkey, {f"{now}:{secrets.token_hex(4)}": now})
+                pipe.zcard(rkey)
+                pipe.expire(rkey, int(self.window) + 1)
+                _, _, n, _ = await pipe.execute()
+        except Exception:
+            return True  # хранилище недоступно — пользователей не блокируем
+        if n > self.limit:
+            self.dropped += 1
+            return False
+        return True
+
+class TokenQuota:
+    """
+    Сколько токенов выдано пользователю за последние 24 часа — в памяти, вместо SQL COUNT на каждый клик.
+    Заполняется из БД при старте (warm) и пополняется при каждой вставке токена.
+    С TOKEN_QUOTA_BACKEND=db считает через БД (нужно, когда воркеров несколько).
+    """
+
+    WINDOW = 24 * 3600
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._issued = {}  # user_id -> deque[created_ts]
+        self._lock = threading.Lock()
+
+    def warm(self):
+        if self.backend != "memory":
+            return
+        cutoff = int(time.time()) - self.WINDOW
+        rows = []
+        for shard in range(DB_SHARDS):  # пользователь целиком в одном шарде — порядок по created_ts сохраняется
+            rows += get_conn(shard).execute(
+                "SELECT user_id, created_ts FROM tokens WHERE created_ts >= ? ORDER BY created_ts", (cutoff,)).fetchall()
+        with self._lock:
+            self._issued.clear()
+            for user_id, ts in rows:
+                self._issued.setdefault(user_id, deque()).append(ts)
+
+    def record(self, user_id: int, ts: int, n: int = 1):
+        if self.backend != "memory":
+            return
+        with self._lock:
+            self._issued.setdefault(user_id, deque()).extend([ts] * n)
+
+    def count(self, user_id: int) -> int:
+        """Для backend=db вызывать только из потока БД."""
+        if self.backend != "memory":
+            return user_tokens_last_24h_count(user_id)
+        cutoff = int(time.time()) - self.WINDOW
+        # выдачи этой же пачки ещё не закоммичены — record() для них придёт после commit
+        pending = sum(args[2] for args in pending_effects(self.record) if args[0] == user_id)
+        with self._lock:
+            q = self._issued.get(user_id)
+            if not q:
+                return pending
+            while q and q[0] < cutoff:
+                q.popleft()
+            if not q:
+                del self._issued[user_id]
+            return len(q) + pending
+
+    def exhausted(self, user_id: int) -> bool:
+        """Быстрая проверка из event loop; для backend=db ответ даёт только _create_token_tx."""
+        return self.backend == "memory" and self.count(user_id) >= TOKENS_PER_DAY_LIMIT
+
+    def prune(self):
+        cutoff = int(time.time()) - self.WINDOW
+        with self._lock:
+            for user_id in [u for u, q in self._issued.items() if not q or q[-1] < cutoff]:
+                del self._issued[user_id]
+
+token_quota = TokenQuota(TOKEN_QUOTA_BACKEND)
+flood_limiter = (RedisSlidingWindowLimiter(FLOOD_REDIS_URL, FLOOD_LIMIT, FLOOD_WINDOW) if FLOOD_REDIS_URL
+                 else SlidingWindowLimiter(FLOOD_LIMIT, FLOOD_WINDOW))
+_recent_callbacks = TTLCache(100000)  # (user_id, data) -> True на CALLBACK_DEBOUNCE секунд
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Outer-middleware: отбрасывает повторные нажатия той же кнопки и всё сверх FLOOD_LIMIT за FLOOD_WINDOW
+    до того, как хендлер пойдёт в Telegram API и БД. Админов не ограничивает.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            key = (user.id, event.data)
+            if _recent_callbacks.get(key):
+                await event.answer()
+                return None
+            _recent_callbacks.set(key, True, CALLBACK_DEBOUNCE)
+        if not await flood_limiter.allow(user.id):
+            if isinstance(event, CallbackQuery):
+                await event.answer("Слишком часто, подождите немного")
+            return None
+        return await handler(event, data)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время и ошибки каждого хендлера (метка — имя функции)."""
+
+    async def __call__(self, handler, event, data):
+        hist, errors = _handler_metrics(data["handler"].callback.__name__)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            hist.observe(time.perf_counter() - started)
+
+dp.message.outer_middleware(AntiFloodMiddleware())
+dp.callback_query.outer_middleware(AntiFloodMiddleware())
+for _observer in (dp.message, dp.callback_query, dp.chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+
+# -------------------------
+#  Реферальный граф и накрутка
+# -------------------------
+class ReferralGraph:
+    """
+    Граф приглашений в памяти: строится один раз из users.ref_by всех шардов (пользователи не удаляются,
+    так что чистильщик в режиме purge историю графа не теряет),
+    дальше пополняется при регистрации по реф-ссылке. Запросы админки и проверка при начислении — без SQL:
+      - top(): лидеры по числу приглашённых — готовый отсортированный список, правится на месте за O(N);
+      - tree(): размер и глубина дерева приглашённых — счётчики на предках, запрос O(1);
+      - score(): скорость приглашений за час и сутки относительно REF_VELOCITY_*, O(log n); > 1 — подозрительно.
+    Дерево считается на REF_TREE_MAX_DEPTH уровней: регистрация обновляет не больше стольких предков,
+    а длинная цепочка приглашений сама по себе признак накрутки.
+    Пополняется из потоков-писателей шардов — под lock. У каждого воркера свой граф: при WORKERS > 1
+    скорость видна по регистрациям этого воркера, остальное — после рестарта.
+    """
+    HOUR = 3600
+    DAY = 86400
+
+    def __init__(self, top_size: int):
+        self.top_size = top_size
+        self._lock = threading.Lock()
+        self._parent = {}  # new_user -> ref_by
+        self._invited = {}  # ref_by -> приглашённых
+        self._size = {}  # user -> размер дерева под ним
+        self._height = {}  # user -> глубина дерева под ним
+        self._recent = {}  # ref_by -> [ts приглашений за сутки] по возрастанию
+        self._top = []  # [(-invited, user_id)] по возрастанию
+        self.held = 0  # задержанных начислений
+
+    def _add_locked(self, new_user: int, ref_by: int, ts: Optional[float]):
+        if new_user == ref_by or new_user in self._parent:
+            return
+        self._parent[new_user] = ref_by
+        invited = self._invited.get(ref_by, 0) + 1
+        self._invited[ref_by] = invited
+        self._bump_top(ref_by, invited)
+        if ts is not None:
+            insort(self._recent.setdefault(ref_by, []), ts)
+        # поддерево new_user (если оно пришло раньше него при загрузке) целиком добавляется предкам
+        size = self._size.get(new_user, 0) + 1
+        height = self._height.get(new_user, 0) + 1
+        node = ref_by
+        for dist in range(REF_TREE_MAX_DEPTH):
+            if node is None or node == new_user:
+                break
+            self._size[node] = self._size.get(node, 0) + size
+            if height + dist > self._height.get(node, 0):
+                self._height[node] = height + dist
+            node = self._parent.get(node)
+
+    def _bump_top(self, user_id: int, invited: int):
+        # число приглашённых только растёт, поэтому войти в топ можно лишь через этот вызов — список точный
+        top = self._top
+        if len(top) >= self.top_size and -invited > top[-1][0]:
+            return
+        for i, (_, u) in enumerate(top):
+            if u == user_id:
+                del top[i]
+                break
+        insort(top, (-invited, user_id))
+        del top[self.top_size:]
+
+    def add(self, new_user: int, ref_by: int, ts: float):
+        with self._lock:
+            self._add_locked(new_user, ref_by, ts)
+
+    def warm(self):
+        """Загрузка из всех шардов (вызывать из потока БД). Время нужно только приглашениям за последние сутки."""
+        cutoff = time.time() - self.DAY
+        cutoff_iso = datetime.datetime.utcfromtimestamp(cutoff).isoformat()
+        with self._lock:
+            for shard in range(DB_SHARDS):
+                # joined_at совпадает с referrals.created_at: обе строки пишет _register_user_tx
+                cur = get_conn(shard).execute("SELECT user_id, ref_by, joined_at FROM users WHERE ref_by IS NOT NULL")
+                while rows := cur.fetchmany(MIGRATION_BATCH):
+                    for new_user, ref_by, created_at in rows:
+                        ts = None
+                        if created_at and created_at >= cutoff_iso:
+                            ts = datetime.datetime.fromisoformat(created_at).replace(
+                                tzinfo=datetime.timezone.utc).timestamp()
+                        self._add_locked(new_user, ref_by, ts)
+        log.info("[referrals] граф: %d приглашений, %d пригласивших", len(self._parent), len(self._invited))
+
+    def _score_locked(self, user_id: int, now: float, pending: int = 0) -> float:
+        recent = self._recent.get(user_id)
+        if not recent and not pending:
+            return 0.0
+        if recent:
+            del recent[:bisect_left(recent, now - self.DAY)]
+        hour = len(recent or ()) - bisect_left(recent or [], now - self.HOUR) + pending
+        day = len(recent or ()) + pending
+        return max(hour / REF_VELOCITY_HOUR if REF_VELOCITY_HOUR else 0.0,
+                   day / REF_VELOCITY_DAY if REF_VELOCITY_DAY else 0.0)
+
+    def score(self, user_id: int) -> float:
+        with self._lock:
+            return self._score_locked(user_id, time.time())
+
+    def should_hold(self, ref_by: int) -> bool:
+        """Задержать ли награду ref_by: приглашает быстрее лимита (текущее приглашение уже учтено)."""
+        # приглашения этой же транзакции попадут в граф только после commit (on_commit)
+        pending = sum(1 for args in pending_effects(self.add) if args[1] == ref_by)
+        with self._lock:
+            if self._score_locked(ref_by, time.time(), pending) <= 1.0:
+                return False
+            self.held += 1
+            return True
+
+    def suspicious(self) -> list:
+        """[(score, user_id)] пригласивших быстрее лимита, по убыванию."""
+        now = time.time()
+        with self._lock:
+            scores = [(self._score_locked(u, now), u) for u in list(self._recent)]
+        return sorted(((sc, u) for sc, u in scores if sc > 1.0), reverse=True)
+
+    def top(self, n: Optional[int] = None) -> list:
+        """[(user_id, приглашённых)] по убыванию."""
+        with self._lock:
+            return [(u, -neg) for neg, u in self._top[:n]]
+
+    def tree(self, user_id: int) -> dict:
+        with self._lock:
+            chain, node = [], self._parent.get(user_id)
+            while node is not None and len(chain) < REF_TREE_MAX_DEPTH:
+                chain.append(node)
+                node = self._parent.get(node)
+            return {"invited": self._invited.get(user_id, 0), "size": self._size.get(user_id, 0),
+                    "depth": self._height.get(user_id, 0), "invited_by": chain}
+
+    def prune(self):
+        cutoff = time.time() - self.DAY
+        with self._lock:
+            for user_id in [u for u, r in self._recent.items() if not r or r[-1] < cutoff]:
+                del self._recent[user_id]
+
+    def __len__(self):
+        return len(self._parent)
+
+referral_graph = ReferralGraph(REF_LEADERBOARD_SIZE)
+
+async def release_referrals(ref_by: int) -> int:
+    """Выдать задержанные награды ref_by (решение админа). Возвращает, за скольких приглашённых выдано."""
+    ref_shard = user_shard(ref_by)
+    credited = 0
+    for shard, users in enumerate(await db_read_all(held_referrals, ref_by)):
+        for new_user in users:
+            if shard == ref_shard:
+                ok, _ = await db_write_on(shard, credit_referral_for, new_user, True)
+            else:
+                ok = await db_write_on(ref_shard, credit_referrer, new_user, ref_by, True)
+                if ok:
+                    await db_write_on(shard, mark_referral_credited, new_user)
+            credited += bool(ok)
+    return credited
+
+# -------------------------
+#  Проверка подписки
+# -------------------------
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+async def check_subscription(user_id: int, force: bool = False) -> bool:
+    """
+    Проверка подписки на REQUIRED_CHANNEL. Результат кэшируется: положительный на SUB_CACHE_TTL_POS,
+    отрицательный на SUB_CACHE_TTL_NEG. force=True — игнорировать кэш (кнопка "Проверить").
+    """
+    key = ("sub", user_id)
+    if not force:
+        cached = tg_cache.get(key)
+        if cached is not None:
+            return cached
+    try:
+        mem = await bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
+        ok = mem.status in SUBSCRIBED_STATUSES
+    except TelegramBadRequest:
+        ok = False
+    tg_cache.set(key, ok, SUB_CACHE_TTL_POS if ok else SUB_CACHE_TTL_NEG)
+    return ok
+
+async def get_bot_me():
+    me = tg_cache.get(("me",))
+    if me is None:
+        me = await bot.get_me()
+        tg_cache.set(("me",), me, TG_CACHE_TTL)
+    return me
+
+def _is_required_channel(chat) -> bool:
+    if REQUIRED_CHANNEL.startswith("@"):
+        return (chat.username or "").lower() == REQUIRED_CHANNEL[1:].lower()
+    return str(chat.id) == REQUIRED_CHANNEL
+
+def sub_keyboard():
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подписаться 📢", url=f"https://t.me/{REQUIRED_CHANNEL[1:]}")],
+        [InlineKeyboardButton(text="Проверить 🔄", callback_data="check_sub")]
+    ])
     return kb
 
 def main_menu():
@@ -315,6 +2418,7 @@ def main_menu():
         [InlineKeyboardButton(text="Получить токен 🔐", callback_data="get_token")],
         [InlineKeyboardButton(text="Мои токены 📄", callback_data="my_tokens")],
         [InlineKeyboardButton(text="Реферальная панель 👥", callback_data="ref_panel")],
+        [InlineKeyboardButton(text="Трафик 📈", callback_data="traffic")],
         [InlineKeyboardButton(text="Помощь ❓", callback_data="help")]
     ])
     return kb
@@ -335,11 +2439,9 @@ async def cmd_start(message: Message):
         except Exception:
             ref_by = None
 
-    new = register_user(user_id, ref_by)
-    # если регистрация новая — попробуем начислить реф-награду
-    if new:
-        credited, ref_id = credit_referral_for(user_id)
-        # credited True/False — не обязательно что-то писать пользователю здесь
+    # регистрация и (если она новая) реф-награда — одной транзакцией
+    new, credited, ref_id = await signup(user_id, ref_by)
+    # credited True/False — не обязательно что-то писать пользователю здесь
 
     # подписка
     if not await check_subscription(user_id):
@@ -349,7 +2451,7 @@ async def cmd_start(message: Message):
 
 @dp.callback_query(F.data == "check_sub")
 async def cb_check_sub(query: CallbackQuery):
-    if await check_subscription(query.from_user.id):
+    if await check_subscription(query.from_user.id, force=True):
         await query.message.answer("Вы подписаны ✔", reply_markup=main_menu())
     else:
         await query.message.answer("❌ Вы не подписаны", reply_markup=sub_keyboard())
@@ -357,10 +2459,15 @@ async def cb_check_sub(query: CallbackQuery):
 @dp.callback_query(F.data == "get_token")
 async def cb_get_token(query: CallbackQuery):
     uid = query.from_user.id
+    # лимит известен из памяти — не тратим запрос get_chat_member и заход в БД
+    if token_quota.exhausted(uid):
+        await query.message.answer(f"Лимит токенов за 24 часа достигнут ({TOKENS_PER_DAY_LIMIT}).",
+                                   reply_markup=main_menu())
+        return
     if not await check_subscription(uid):
         await query.message.answer("Сначала подпишитесь на канал", reply_markup=sub_keyboard())
         return
-    ok, res = create_token_for_user(uid)
+    ok, res = await create_token_for_user(uid)
     if not ok:
         await query.message.answer(res, reply_markup=main_menu())
         return
@@ -371,31 +2478,71 @@ async def cb_get_token(query: CallbackQuery):
     )
     # отправим конфиг как файл
     cfg_bytes = res["wg_config"].encode("utf-8")
-    bio = io.BytesIO(cfg_bytes)
-    bio.name = f"wg_{res['token']}.conf"
-    await query.message.answer_document(InputFile(bio))
+    await query.message.answer_document(BufferedInputFile(cfg_bytes, filename=f"wg_{res['token']}.conf"))
 
 @dp.callback_query(F.data == "my_tokens")
 async def cb_my_tokens(query: CallbackQuery):
-    uid = query.from_user.id
-    rows = list_user_tokens(uid)
-    if not rows:
+    text, kb = await render_page("mt", query.from_user.id, None, "n")
+    if text is None:
         await query.message.answer("У вас нет токенов.", reply_markup=main_menu())
         return
-    text = "Ваши токены:\n\n"
-    for token, created, expires, used, wg_pub in rows:
-        text += f"`{token}`\nСоздан: {created}\nИстекает: {expires}\nИспользован: {'да' if used else 'нет'}\nWG pub: {wg_pub or '-'}\n\n"
-    await query.message.answer(text, parse_mode="Markdown")
+    await query.message.answer(text, parse_mode="Markdown", reply_markup=kb)
+
+def _render_rows(listing: str, rows) -> str:
+    if listing == "mt":
+        text = "Ваши токены:\n\n"
+        for _, token, created, expires, used, wg_pub, client_ip in rows:
+            text += (f"`{token}`\nСоздан: {created}\nИстекает: {expires}\nИспользован: {'да' if used else 'нет'}\n"
+                     f"Адрес: {client_ip or '-'}\nWG pub: {wg_pub or '-'}\n\n")
+        return text
+    if listing == "au":
+        text = "Пользователи:\n\n"
+        for joined, u, r, cnt, paid in rows:
+            text += f"{u} | ref_by={r} | refs={cnt} | joined={joined} | paid={paid}\n"
+        return text
+    text = "Токены:\n\n"
+    for _, t, u, created, exp, used in rows:
+        text += f"{t} | user={u} | created={created} | exp={exp} | used={used}\n"
+    return text
+
+async def render_page(listing: str, scope: Optional[int], cursor: Optional[tuple], direction: str):
+    """Текст страницы и клавиатура навигации; (None, None), если список пуст."""
+    rows, has_more = await read_page(listing, scope, cursor, direction)
+    if not rows:
+        return None, None
+    head = listing if scope is None or listing == "mt" else f"{listing}:{scope}"
+    newest, oldest = rows[0][:2], rows[-1][:2]
+    # "новее" есть, если пришли листанием вглубь или есть ещё строки при листании назад
+    has_newer = (direction == "n" and cursor is not None) or (direction == "p" and has_more)
+    has_older = (direction == "n" and has_more) or direction == "p"
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"{head}|p|{newest[0]}|{newest[1]}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"{head}|n|{oldest[0]}|{oldest[1]}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return _render_rows(listing, rows), kb
+
+@dp.callback_query(F.data.regexp(r"^(au|at|ut:\d+|mt)\|[np]\|"))
+async def cb_page(query: CallbackQuery):
+    head, direction, k1, k2 = query.data.split("|", 3)
+    listing, _, scope = head.partition(":")
+    admin_only, key_types = LISTINGS[listing][5], LISTINGS[listing][2]
+    if admin_only and query.from_user.id not in ADMIN_IDS:
+        return
+    scope = query.from_user.id if listing == "mt" else (int(scope) if scope else None)
+    cursor = (key_types[0](k1), key_types[1](k2))
+    text, kb = await render_page(listing, scope, cursor, direction)
+    if text is None:
+        await query.answer("Больше ничего нет")
+        return
+    await query.message.edit_text(text, parse_mode="Markdown" if listing == "mt" else None, reply_markup=kb)
 
 @dp.callback_query(F.data == "ref_panel")
 async def cb_ref_panel(query: CallbackQuery):
     uid = query.from_user.id
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT refs_count FROM users WHERE user_id=?", (uid,))
-    row = c.fetchone()
-    refs = row[0] if row else 0
-    link = f"https://t.me/{(await bot.get_me()).username}?start=ref{uid}"
+    refs = await db_read_on(user_shard(uid), get_refs_count, uid)
+    link = f"https://t.me/{(await get_bot_me()).username}?start=ref{uid}"
     await query.message.answer(f"Ваша реферальная ссылка:\n`{link}`\nПриглашено: {refs}\nНаграда: {REF_REWARD} токен(ов)",
                                parse_mode="Markdown")
 
@@ -406,11 +2553,247 @@ async def cb_help(query: CallbackQuery):
         "- Подпишитесь на канал -> получите токен\n"
         "- Токен действителен ограниченное время\n"
         "- Админ может вручную выдать токены/пометить оплату\n"
-        "- Рефералы дают награду (автоматически создаются токены для пригласителя)\n\n"
-        "Команды для админа: /admin"
+        "- Рефералы дают награду (автоматически создаются токены для пригласителя)\n"
+        "- /traffic [day|week|month|year] — график вашего трафика\n\n"
+        "Команды для админа: /admin, /find, /dbstats, /cachestats, /apistats, /revoke, /jwt, /export, "
+        "/traffic <период> <user_id|all>, /referrals, /refrelease, /profile"
     )
     await query.message.answer(text)
 
+@dp.chat_member()
+async def on_chat_member(update: ChatMemberUpdated):
+    # приходит, только если бот — админ канала; обновляем кэш без запроса к API
+    if not _is_required_channel(update.chat):
+        return
+    ok = update.new_chat_member.status in SUBSCRIBED_STATUSES
+    tg_cache.set(("sub", update.new_chat_member.user.id), ok, SUB_CACHE_TTL_POS if ok else SUB_CACHE_TTL_NEG)
+
+# -------------------------
+#  Рассылка (broadcast)
+# -------------------------
+class TokenBucket:
+    """
+    Token bucket: rate токенов в секунду, не больше capacity в запасе.
+    pause() блокирует выдачу на заданное время (ответ RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n: float = 1) -> bool:
+        """n больше capacity проходит только при полном ведре и уводит его в минус: следующие ждут погашения."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= min(n, self.capacity):
+            self.tokens -= n
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+# chat_id -> TokenBucket; живут недолго, поэтому держим в том же TTL-кэше
+_chat_buckets = TTLCache(10000)
+_broadcast_tasks = {}  # job_id -> asyncio.Task
+_broadcast_cancel_requested = set()  # job_id, остановленные админом (а не завершением процесса)
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    b = _chat_buckets.get(chat_id)
+    if b is None:
+        b = TokenBucket(BROADCAST_PER_CHAT_RATE, 1)
+        _chat_buckets.set(chat_id, b, 60)
+    return b
+
+def count_users() -> int:
+    return get_conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+def create_broadcast(admin_id: int, text: str, total: int) -> int:
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("INSERT INTO broadcasts (admin_id, text, total, created_ts) VALUES (?, ?, ?, ?)",
+              (admin_id, text, total, int(time.time())))
+    conn.commit()
+    return c.lastrowid
+
+def get_broadcast(job_id: int):
+    c = get_conn().cursor()
+    c.execute("SELECT id, admin_id, text, status, last_user_id, total, delivered, blocked, failed,"
+              " progress_chat_id, progress_message_id FROM broadcasts WHERE id=?", (job_id,))
+    return c.fetchone()
+
+def list_running_broadcasts():
+    c = get_conn().cursor()
+    c.execute("SELECT id FROM broadcasts WHERE status='running'")
+    return [r[0] for r in c.fetchall()]
+
+def set_broadcast_progress_message(job_id: int, chat_id: int, message_id: int):
+    conn = get_conn()
+    conn.execute("UPDATE broadcasts SET progress_chat_id=?, progress_message_id=? WHERE id=?",
+                 (chat_id, message_id, job_id))
+    conn.commit()
+
+def fetch_broadcast_chunk(last_user_id: int, limit: int):
+    c = get_conn().cursor()
+    c.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_user_id, limit))
+    return [r[0] for r in c.fetchall()]
+
+async def fetch_broadcast_recipients(last_user_id: int, limit: int) -> list:
+    # первые limit id с каждого шарда — среди них точно есть limit наименьших по всем шардам
+    chunks = await db_read_all(fetch_broadcast_chunk, last_user_id, limit)
+    return list(heapq.merge(*chunks))[:limit]
+
+def save_broadcast_progress(job_id: int, last_user_id: int, delivered: int, blocked: int, failed: int) -> str:
+    """Сохранить курсор и счётчики; возвращает текущий статус (задание могли отменить из другого воркера)."""
+    conn = get_conn()
+    # статус не трогаем: задание могли отменить, пока шла пачка
+    row = conn.execute("UPDATE broadcasts SET last_user_id=?, delivered=?, blocked=?, failed=? WHERE id=?"
+                       " RETURNING status", (last_user_id, delivered, blocked, failed, job_id)).fetchone()
+    conn.commit()
+    return row[0] if row else "cancelled"
+
+def finish_broadcast(job_id: int, status: str) -> bool:
+    conn = get_conn()
+    cur = conn.execute("UPDATE broadcasts SET status=?, finished_ts=? WHERE id=? AND status='running'",
+                       (status, int(time.time()), job_id))
+    conn.commit()
+    return cur.rowcount > 0
+
+async def _broadcast_send(chat_id: int, text: str) -> str:
+    """Отправить одно сообщение с учётом лимитов. Возвращает "delivered" | "blocked" | "failed"."""
+    attempt = 0
+    flood_waits = 0
+    while True:
+        await broadcast_bucket.acquire()
+        await _chat_bucket(chat_id).acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return "delivered"
+        except TelegramRetryAfter as e:
+            # флуд-лимит общий для бота — приостанавливаем всю рассылку, а не только этот чат
+            broadcast_bucket.pause(e.retry_after)
+            flood_waits += 1
+            if flood_waits > 10:
+                return "failed"
+        except TelegramForbiddenError:
+            return "blocked"  # бот заблокирован или аккаунт удалён
+        except (TelegramNetworkError, TelegramServerError):
+            attempt += 1
+            if attempt > BROADCAST_MAX_RETRIES:
+                return "failed"
+            await asyncio.sleep(min(30.0, 2 ** attempt) + secrets.randbelow(1000) / 1000)
+        except TelegramAPIError:
+            return "failed"
+
+def _broadcast_progress_text(job_id, status, done, total, delivered, blocked, failed) -> str:
+    title = {"running": "идёт", "done": "завершена", "cancelled": "отменена"}.get(status, status)
+    return (f"Рассылка #{job_id} {title}: {done}/{total}\n"
+            f"Доставлено: {delivered}\nЗаблокировали бота: {blocked}\nОшибок: {failed}")
+
+def _broadcast_cancel_kb(job_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Остановить ⛔", callback_data=f"bc_cancel:{job_id}")]
+    ])
+
+async def _update_broadcast_progress(job_id, chat_id, message_id, text, final=False):
+    if not chat_id or not message_id:
+        return
+    kb = None if final else _broadcast_cancel_kb(job_id)
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=kb)
+    except TelegramAPIError:
+        pass  # "message is not modified" и т.п. — прогресс не критичен
+
+async def run_broadcast(job_id: int):
+    """
+    Выполнить (или продолжить после рестарта) задание рассылки.
+    Получатели берутся пачками по user_id, курсор и счётчики сохраняются после каждой пачки,
+    поэтому после рестарта повторно могут уйти не больше BROADCAST_CHUNK сообщений.
+    """
+    row = await db_read(get_broadcast, job_id)
+    if not row or row[3] != "running":
+        return
+    _, admin_id, text, status, last_uid, total, delivered, blocked, failed, p_chat, p_msg = row
+    counters = {"delivered": delivered, "blocked": blocked, "failed": failed}
+    body = f"📣 Сообщение от админа:\n\n{text}"
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = 0.0
+
+    async def send_one(uid):
+        async with sem:
+            result = await _broadcast_send(uid, body)
+            counters[result] += 1
+            BROADCAST_MESSAGES[result].inc()
+
+    try:
+        status = "done"
+        while True:
+            chunk = await fetch_broadcast_recipients(last_uid, BROADCAST_CHUNK)
+            if not chunk:
+                break
+            await asyncio.gather(*(send_one(uid) for uid in chunk))
+            last_uid = chunk[-1]
+            if await db_write(save_broadcast_progress, job_id, last_uid, counters["delivered"],
+                              counters["blocked"], counters["failed"]) != "running":
+                status = "cancelled"  # остановлена кнопкой в другом воркере
+                break
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                done = sum(counters.values())
+                await _update_broadcast_progress(
+                    job_id, p_chat, p_msg, _broadcast_progress_text(job_id, "running", done, total, **counters))
+    except asyncio.CancelledError:
+        if job_id not in _broadcast_cancel_requested:
+            raise  # остановка процесса: задание остаётся running и продолжится после рестарта
+        status = "cancelled"
+    finally:
+        _broadcast_tasks.pop(job_id, None)
+        _broadcast_cancel_requested.discard(job_id)
+    await db_write(finish_broadcast, job_id, status)
+    done = sum(counters.values())
+    await _update_broadcast_progress(
+        job_id, p_chat, p_msg, _broadcast_progress_text(job_id, status, done, total, **counters), final=True)
+
+def _spawn_broadcast(job_id: int):
+    _broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(job_id))
+
+async def start_broadcast(admin_id: int, chat_id: int, text: str) -> int:
+    total = sum(await db_read_all(count_users))
+    job_id = await db_write(create_broadcast, admin_id, text, total)
+    msg = await bot.send_message(chat_id, _broadcast_progress_text(job_id, "running", 0, total, 0, 0, 0),
+                                 reply_markup=_broadcast_cancel_kb(job_id))
+    await db_write(set_broadcast_progress_message, job_id, chat_id, msg.message_id)
+    _spawn_broadcast(job_id)
+    return job_id
+
+async def resume_broadcasts():
+    for job_id in await db_read(list_running_broadcasts):
+        log.info("[broadcast] продолжаем рассылку #%s", job_id)
+        _spawn_broadcast(job_id)
+
 # -------------------------
 #  Админ: панель и фичи
 # -------------------------
@@ -419,183 +2802,1291 @@ async def cmd_admin(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Пользователи 🧑‍💻", callback_data="adm_users"),
-         InlineKeyboardButton("Токены 🔐", callback_data="adm_tokens")],
-        [InlineKeyboardButton("Разослать всем ✉️", callback_data="adm_broadcast")],
-        [InlineKeyboardButton("Выдать токен пользователю", callback_data="adm_give_token")],
-        [InlineKeyboardButton("Выдать JWT для серверов", callback_data="adm_issue_jwt")],
-        [InlineKeyboardButton("Экспорт CSV", callback_data="adm_export")]
+        [InlineKeyboardButton(text="Пользователи 🧑‍💻", callback_data="adm_users"),
+         InlineKeyboardButton(text="Токены 🔐", callback_data="adm_tokens")],
+        [InlineKeyboardButton(text="Разослать всем ✉️", callback_data="adm_broadcast")],
+        [InlineKeyboardButton(text="Выдать токен пользователю", callback_data="adm_give_token")],
+        [InlineKeyboardButton(text="Выдать JWT для серверов", callback_data="adm_issue_jwt")],
+        [InlineKeyboardButton(text="Экспорт CSV", callback_data="adm_export"),
+         InlineKeyboardButton(text="Рефералы 🏆", callback_data="adm_referrals")],
+        [InlineKeyboardButton(text="Профилирование 🔬", callback_data="adm_profile")]
     ])
     await message.answer("Админ-панель", reply_markup=kb)
 
+@dp.message(Command("dbstats"))
+async def cmd_dbstats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    text = "Ожидание в очереди БД:\n\n"
+    for kind, st in db_queue_stats().items():
+        text += f"{kind}: запросов={st['count']} | среднее={st['avg_ms']:.1f} мс | макс={st['max_ms']:.1f} мс\n"
+    text += (f"\nЧистильщик ({SWEEP_MODE}): проходов={SWEEP_STATS['runs']} | "
+             f"токенов за последний={SWEEP_STATS['tokens_last']} | всего={SWEEP_STATS['tokens_total']} | "
+             f"рефералов всего={SWEEP_STATS['referrals_total']} | "
+             f"адресов освобождено={SWEEP_STATS['ips_reclaimed_total']}\n")
+    ip = ipam_stats()
+    text += f"IPAM: свободно {ip['free']} из {ip['capacity']}\n"
+    if DB_SHARDS > 1:
+        counts = await db_read_all(shard_counts)
+        text += "Шарды: " + " | ".join(f"#{i}: users={u} tokens={t}" for i, (u, t) in enumerate(counts)) + "\n"
+    text += f"Антифлуд: отброшено событий {flood_limiter.dropped}\n"
+    await message.answer(text)
+
+@dp.message(Command("cachestats"))
+async def cmd_cachestats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    st = tg_cache.stats()
+    await message.answer(
+        f"Кэш Telegram: записей={st['size']} | hits={st['hits']} | misses={st['misses']} | "
+        f"вытеснено={st['evictions']} | hit ratio={st['hit_ratio']:.1%}"
+    )
+
+@dp.message(Command("revoke"))
+async def cmd_revoke(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) != 2:
+        await message.answer("Использование: /revoke <токен>")
+        return
+    if await revoke(args[1]):
+        await message.answer("Токен отозван, адрес освобождён.")
+    else:
+        await message.answer("Токен не найден или уже отозван.")
+
 @dp.callback_query(F.data == "adm_users")
 async def cb_adm_users(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         return
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, ref_by, refs_count, joined_at, paid FROM users ORDER BY joined_at DESC")
-    rows = c.fetchall()
-    conn.close()
-    text = "Пользователи:\n\n"
-    for u, r, cnt, joined, paid in rows[:200]:
-        text += f"{u} | ref_by={r} | refs={cnt} | joined={joined} | paid={paid}\n"
-    await query.message.answer(text[:4000])
+    text, kb = await render_page("au", None, None, "n")
+    await query.message.answer(text or "Пользователей нет.", reply_markup=kb)
 
 @dp.callback_query(F.data == "adm_tokens")
 async def cb_adm_tokens(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         return
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT token, user_id, created_at, expires_at, used FROM tokens ORDER BY created_at DESC")
-    rows = c.fetchall()
-    conn.close()
+    text, kb = await render_page("at", None, None, "n")
+    await query.message.answer(text or "Токенов нет.", reply_markup=kb)
+
+@dp.message(Command("find"))
+async def cmd_find(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) != 2:
+        await message.answer("Использование: /find <user_id или начало токена>")
+        return
+    q = args[1]
+    # число — и user_id, и начало токена (старые токены бывают из одних цифр); user_id — INTEGER SQLite
+    user = None
+    if q.isdigit() and int(q) < 1 << 63:
+        user = await db_read_on(user_shard(int(q)), get_user, int(q))
+    if user:
+        u, r, cnt, joined, paid = user
+        text, kb = await render_page("ut", u, None, "n")
+        await message.answer(f"{u} | ref_by={r} | refs={cnt} | joined={joined} | paid={paid}\n\n{text or 'Токенов нет.'}",
+                             reply_markup=kb)
+    if len(q) < 4:
+        if not user:
+            await message.answer("Пользователь не найден." if q.isdigit() else "Начало токена — минимум 4 символа.")
+        return
+    rows = await find_tokens(q, ADMIN_PAGE_SIZE)
+    if not rows:
+        if not user:
+            await message.answer("Пользователь или токены не найдены." if q.isdigit() else "Токены не найдены.")
+        return
     text = "Токены:\n\n"
-    for t, u, created, exp, used in rows[:200]:
+    for t, u, created, exp, used in rows:
         text += f"{t} | user={u} | created={created} | exp={exp} | used={used}\n"
-    await query.message.answer(text[:4000])
+    await message.answer(text)
 
-@dp.callback_query(F.data == "adm_broadcast")
-async def cb_adm_broadcast(query: CallbackQuery):
+@dp.callback_query(F.data.startswith("bc_cancel:"))
+async def cb_broadcast_cancel(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         return
-    await query.message.answer("Введите сообщение для рассылки (админ). Отправьте /cancel чтобы отменить.")
-    # простейший state-machine без state — чтение следующего сообщения от этого админа
-    @dp.message()
-    async def accept_broadcast(msg: Message):
-        if msg.from_user.id not in ADMIN_IDS:
-            return
-        if msg.text == "/cancel":
-            await msg.answer("Рассылка отменена.")
-            dp.message_handlers.unregister(accept_broadcast)
-            return
-        text = msg.text
-        # рассылка всем пользователям (внимание: большое количество — потребует очередей и пауз)
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users")
-        rows = c.fetchall()
-        conn.close()
-        success = 0
-        for (uid,) in rows:
-            try:
-                await bot.send_message(uid, f"📣 Сообщение от админа:\n\n{text}")
-                success += 1
-            except Exception:
-                pass
-        await msg.answer(f"Рассылка завершена. Отправлено примерно: {success}")
-        dp.message_handlers.unregister(accept_broadcast)
-
-@dp.callback_query(F.data == "adm_give_token")
-async def cb_adm_give_token(query: CallbackQuery):
-    if query.from_user.id not in ADMIN_IDS:
+    job_id = int(query.data.split(":", 1)[1])
+    task = _broadcast_tasks.get(job_id)
+    if task is None:
+        # рассылка может идти в другом воркере — он увидит статус после текущей пачки
+        if await db_write(finish_broadcast, job_id, "cancelled"):
+            await query.answer("Рассылка останавливается")
+        else:
+            await query.answer("Рассылка уже завершена")
         return
-    await query.message.answer("Отправьте ID пользователя, которому дать токен (или /cancel).")
-    @dp.message()
-    async def accept_uid(msg: Message):
-        if msg.from_user.id not in ADMIN_IDS:
-            return
-        if msg.text == "/cancel":
-            await msg.answer("Отмена.")
-            dp.message_handlers.unregister(accept_uid)
-            return
-        try:
-            uid = int(msg.text.strip())
-        except:
-            await msg.answer("Неправильный ID. Попробуйте ещё раз или /cancel")
-            return
-        tok, exp, priv, pub = _create_token_db(uid, generate_wg_keys=True)
-        await msg.answer(f"Токен выдан: `{tok}` (user {uid})", parse_mode="Markdown")
-        dp.message_handlers.unregister(accept_uid)
+    _broadcast_cancel_requested.add(job_id)
+    task.cancel()
+    await query.answer("Рассылка останавливается")
 
 @dp.callback_query(F.data == "adm_issue_jwt")
 async def cb_adm_issue_jwt(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         return
-    # выдаём JWT для сервера, срок 24 часа
-    now = datetime.datetime.utcnow()
-    payload = {"iss": "vpn_bot", "iat": int(now.timestamp()), "exp": int((now + datetime.timedelta(hours=24)).timestamp())}
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGO)
-    await query.message.answer(f"JWT (валиден 24ч):\n`{token}`", parse_mode="Markdown")
+    # выдаём JWT для сервера; sub — имя сервера для атрибуции запросов
+    sub = f"srv-{secrets.token_hex(3)}"
+    token = issue_server_jwt(sub)
+    await query.message.answer(
+        f"JWT для `{sub}` (валиден {JWT_LIFETIME_HOURS}ч):\n`{token}`\n\nИменной JWT: /jwt <имя сервера>",
+        parse_mode="Markdown")
+
+@dp.message(Command("jwt"))
+async def cmd_jwt(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) != 2:
+        await message.answer("Использование: /jwt <имя сервера>")
+        return
+    token = issue_server_jwt(args[1])
+    await message.answer(f"JWT для `{args[1]}` (валиден {JWT_LIFETIME_HOURS}ч):\n`{token}`", parse_mode="Markdown")
+
+@dp.message(Command("apistats"))
+async def cmd_apistats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    st = jwt_cache.stats()
+    text = (f"Кэш JWT: записей={st['size']} | hits={st['hits']} | misses={st['misses']}\n"
+            f"Активный kid: {JWT_ACTIVE_KID} (всего ключей: {len(JWT_KEYS)})\n\nЗапросы по серверам:\n")
+    for sub, n in sorted(api_requests_by_sub.items(), key=lambda kv: -kv[1]):
+        text += f"{sub}: {n}\n"
+    await message.answer(text[:4000])
+
+def _referrals_text(user_id: Optional[int] = None) -> str:
+    if user_id is not None:
+        t = referral_graph.tree(user_id)
+        chain = " <- ".join(map(str, t["invited_by"])) or "—"
+        return (f"{user_id}: приглашено={t['invited']} | дерево={t['size']} | глубина={t['depth']} | "
+                f"скорость={referral_graph.score(user_id):.2f}\nПригласили: {chain}")
+    text = f"Топ пригласивших (всего приглашений {len(referral_graph)}):\n\n"
+    for i, (u, n) in enumerate(referral_graph.top(), 1):
+        t = referral_graph.tree(u)
+        text += f"{i}. {u} | приглашено={n} | дерево={t['size']} | глубина={t['depth']} | " \
+                f"скорость={referral_graph.score(u):.2f}\n"
+    suspicious = referral_graph.suspicious()
+    if suspicious:
+        text += "\nПодозрительные (награды задерживаются, выдать — /refrelease <user_id>):\n"
+        text += "\n".join(f"{u} | скорость={sc:.2f}" for sc, u in suspicious[:REF_LEADERBOARD_SIZE])
+    text += f"\nЗадержано начислений: {referral_graph.held}"
+    return text
+
+@dp.callback_query(F.data == "adm_referrals")
+async def cb_adm_referrals(query: CallbackQuery):
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    await query.message.answer(_referrals_text())
+
+@dp.message(Command("referrals"))
+async def cmd_referrals(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await message.answer("Использование: /referrals [user_id]")
+        return
+    await message.answer(_referrals_text(int(args[1]) if len(args) == 2 else None))
+
+@dp.message(Command("refrelease"))
+async def cmd_refrelease(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) != 2 or not args[1].isdigit():
+        await message.answer("Использование: /refrelease <user_id>")
+        return
+    credited = await release_referrals(int(args[1]))
+    await message.answer(f"Выдано наград за приглашённых: {credited}.")
 
 @dp.callback_query(F.data == "adm_export")
 async def cb_adm_export(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         return
-    # экспорт пользователей и токенов в CSV и отправка админу
+    # экспорт пользователей и токенов в CSV (gzip); срезы — командой /export
+    await send_export(query.message, list(EXPORT_DATASETS), "csv", None, None, False)
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        datasets, fmt, date_from, date_to, active = _parse_export_args(message.text.split()[1:])
+    except ValueError:
+        await message.answer("Использование: /export [users|tokens|all] [csv|ndjson] "
+                             "[from=YYYY-MM-DD] [to=YYYY-MM-DD] [active]")
+        return
+    await send_export(message, datasets, fmt, date_from, date_to, active)
+
+# -------------------------
+#  Админ: диалоги (FSM)
+# -------------------------
+# Ввод после кнопки — состояние FSM на (чат, админ), а не новый @dp.message() на каждое нажатие:
+# хендлеры зарегистрированы один раз, фильтр по состоянию — поиск в хранилище по ключу.
+# Повторное нажатие просто перезаписывает состояние. Незаконченный диалог истекает через ADMIN_FLOW_TTL:
+# проверяется при следующем сообщении, брошенные записи удаляет чистильщик (prune_admin_flows).
+class AdminFlow(StatesGroup):
+    broadcast_text = State()
+    give_token_uid = State()
+
+async def _start_admin_flow(state: FSMContext, flow: State):
+    await state.set_state(flow)
+    await state.set_data({"expires": int(time.time()) + ADMIN_FLOW_TTL})
+
+async def _admin_flow_expired(msg: Message, state: FSMContext) -> bool:
+    if (await state.get_data()).get("expires", 0) >= time.time():
+        return False
+    await state.clear()
+    await msg.answer("Время ввода истекло, нажмите кнопку в /admin ещё раз.")
+    return True
+
+async def prune_admin_flows():
+    """Удалить брошенные диалоги из хранилища FSM (вызывается чистильщиком)."""
+    storage = dp.fsm.storage
+    now = int(time.time())
+    if isinstance(storage, SQLiteStorage):
+        await db_write(fsm_prune, now - ADMIN_FLOW_TTL)
+    elif isinstance(storage, MemoryStorage):
+        # MemoryStorage заводит пустую запись на каждого, у кого читали состояние, — их тоже убираем
+        for key, record in list(storage.storage.items()):
+            if record.state is None and not record.data or record.data.get("expires", now) < now:
+                del storage.storage[key]
+
+@dp.callback_query(F.data == "adm_broadcast")
+async def cb_adm_broadcast(query: CallbackQuery, state: FSMContext):
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    await _start_admin_flow(state, AdminFlow.broadcast_text)
+    await query.message.answer("Введите сообщение для рассылки (админ). Отправьте /cancel чтобы отменить.")
+
+@dp.callback_query(F.data == "adm_give_token")
+async def cb_adm_give_token(query: CallbackQuery, state: FSMContext):
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    await _start_admin_flow(state, AdminFlow.give_token_uid)
+    await query.message.answer("Отправьте ID пользователя, которому дать токен (или /cancel).")
+
+@dp.message(Command("cancel"), StateFilter(AdminFlow))
+async def cmd_cancel_admin_flow(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer("Отмена.")
+
+# команды во время диалога обрабатываются как обычно, ввод — только текст без "/"
+@dp.message(AdminFlow.broadcast_text, F.text, ~F.text.startswith("/"))
+async def accept_broadcast(msg: Message, state: FSMContext):
+    if msg.from_user.id not in ADMIN_IDS or await _admin_flow_expired(msg, state):
+        return
+    await state.clear()
+    # рассылка идёт в фоне; прогресс — в отдельном сообщении, которое обновляется
+    await start_broadcast(msg.from_user.id, msg.chat.id, msg.text)
+
+@dp.message(AdminFlow.give_token_uid, F.text, ~F.text.startswith("/"))
+async def accept_uid(msg: Message, state: FSMContext):
+    if msg.from_user.id not in ADMIN_IDS or await _admin_flow_expired(msg, state):
+        return
+    try:
+        uid = int(msg.text.strip())
+    except ValueError:
+        await msg.answer("Неправильный ID. Попробуйте ещё раз или /cancel")
+        return
+    await state.clear()
+    try:
+        tok, exp, priv, pub, client_ip = (await db_write_grouped(user_shard(uid), _insert_tokens, uid, 1))[0]
+    except IPAMExhausted:
+        await msg.answer("Свободные адреса VPN закончились.")
+        return
+    await msg.answer(f"Токен выдан: `{tok}` (user {uid}, {client_ip})", parse_mode="Markdown")
+
+# -------------------------
+#  Трафик: сбор и графики
+# -------------------------
+# VPN-серверы присылают в POST /traffic снимки `wg show <iface> dump`. Прирост счётчиков пира с прошлого
+# снимка того же сервера ложится в минутную корзину; чистильщик сворачивает старые корзины в часовые,
+# часовые — в суточные, поэтому на пира хранится ограниченное число строк. Графики рисуются из корзин
+# и кэшируются до прихода новых данных по пользователю (или до CHART_CACHE_TTL — данные мог принять другой воркер).
+TRAFFIC_LEVELS = (  # (разрешение, во что сворачивается, через сколько сек)
+    (60, 3600, TRAFFIC_MINUTE_HOURS * 3600),
+    (3600, 86400, TRAFFIC_HOUR_DAYS * 86400),
+)
+CHART_PERIODS = {  # период -> (длина, шаг точки графика), сек
+    "day": (86400, 900),
+    "week": (7 * 86400, 3600),
+    "month": (30 * 86400, 6 * 3600),
+    "year": (365 * 86400, 86400),
+}
+CHART_PERIOD_NAMES = {  # период -> (кнопка, "трафик за ...")
+    "day": ("Сутки", "сутки"),
+    "week": ("Неделя", "неделю"),
+    "month": ("Месяц", "месяц"),
+    "year": ("Год", "год"),
+}
+peer_owners = TTLCache(TRAFFIC_KEYS_CACHE)  # публичный ключ -> user_id (None — ключ не наш)
+chart_cache = TTLCache(1024)  # (user_id или "all", период) -> [png, подпись, file_id]
+
+TRAFFIC_COUNTER_MAX = 1 << 62  # больше не сохранить: INTEGER SQLite — 64 бита со знаком, а приросты ещё суммируются
+
+def parse_wg_dump(text: str) -> list:
+    """
+    Пиры из `wg show <iface> dump` (или `wg show all dump`): [(public_key, rx, tx), ...].
+    Строка интерфейса (4/5 полей) пропускается.
+    """
+    peers = []
+    for line in text.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 9:  # all dump: первое поле — имя интерфейса
+            fields = fields[1:]
+        if len(fields) != 8:
+            continue
+        try:
+            rx, tx = int(fields[5]), int(fields[6])
+        except ValueError:
+            continue
+        if 0 <= rx < TRAFFIC_COUNTER_MAX and 0 <= tx < TRAFFIC_COUNTER_MAX:
+            peers.append((fields[0], rx, tx))
+    return peers
+
+def find_peer_owners(keys: list) -> list:
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, ref_by, refs_count, joined_at, paid FROM users")
-    users = c.fetchall()
-    c.execute("SELECT token, user_id, created_at, expires_at, used FROM tokens")
-    tokens = c.fetchall()
-    conn.close()
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["user_id", "ref_by", "refs_count", "joined_at", "paid"])
-    for row in users:
-        w.writerow(row)
-    w.writerow([])
-    w.writerow(["token", "user_id", "created_at", "expires_at", "used"])
-    for row in tokens:
-        w.writerow(row)
-    buf.seek(0)
-    bio = io.BytesIO(buf.read().encode("utf-8"))
-    bio.name = "export_vpn.csv"
-    await query.message.answer_document(InputFile(bio))
-
-# -------------------------
-#  API: /redeem + /verify_jwt
+    out = []
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        out += conn.execute(f"SELECT wg_public, user_id FROM tokens WHERE wg_public IN ({marks})", chunk).fetchall()
+    return out
+
+async def resolve_peer_owners(keys) -> dict:
+    """Публичный ключ -> user_id; ключ навсегда принадлежит одному токену, поэтому кэш долгий."""
+    owners, missing = {}, []
+    for key in keys:
+        cached = peer_owners.get(key, ())
+        if cached == ():
+            missing.append(key)
+        elif cached is not None:
+            owners[key] = cached
+    if missing:
+        found = {}
+        for rows in await db_read_all(find_peer_owners, missing):
+            found.update(rows)
+        for key in missing:
+            user_id = found.get(key)
+            # чужой ключ перепроверяем через минуту: токен могли выдать позже снимка
+            peer_owners.set(key, user_id, 86400 if user_id is not None else 60)
+            if user_id is not None:
+                owners[key] = user_id
+    return owners
+
+def ingest_traffic(server: str, samples: list) -> tuple:
+    """
+    Снимки одного сервера в шарде: samples — [(ts, public_key, user_id, rx, tx), ...] по возрастанию ts.
+    Первый снимок пира только запоминает счётчики; счётчик меньше прошлого — рестарт интерфейса, прирост с нуля.
+    Возвращает (записано, устаревших, {user_id, у кого появились данные}).
+    """
+    conn = get_conn()
+    last = {key: (rx, tx, ts) for key, rx, tx, ts in conn.execute(
+        "SELECT wg_public, rx, tx, ts FROM traffic_counters WHERE server=?", (server,))}
+    buckets = {}
+    stale = 0
+    for ts, key, user_id, rx, tx in samples:
+        prev = last.get(key)
+        if prev and ts <= prev[2]:
+            stale += 1  # повтор или опоздавший снимок
+            continue
+        last[key] = (rx, tx, ts)
+        if prev is None:
+            continue
+        d_rx = rx - prev[0] if rx >= prev[0] else rx
+        d_tx = tx - prev[1] if tx >= prev[1] else tx
+        if d_rx or d_tx:
+            acc = buckets.setdefault((user_id, ts // 60 * 60, key), [0, 0])
+            acc[0] += d_rx
+            acc[1] += d_tx
+    owner = {key: user_id for _, key, user_id, _, _ in samples}
+    conn.executemany(
+        "INSERT INTO traffic_counters (server, wg_public, user_id, rx, tx, ts) VALUES (?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(server, wg_public) DO UPDATE SET rx=excluded.rx, tx=excluded.tx, ts=excluded.ts",
+        [(server, key, owner[key], rx, tx, ts) for key, (rx, tx, ts) in last.items() if key in owner])
+    _add_traffic(conn, 60, [(u, b, k, rx, tx) for (u, b, k), (rx, tx) in buckets.items()])
+    conn.commit()
+    return len(samples) - stale, stale, {u for u, _, _ in buckets}
+
+def _add_traffic(conn: sqlite3.Connection, resolution: int, rows: list):
+    conn.executemany(
+        "INSERT INTO traffic (user_id, resolution, bucket_ts, wg_public, rx, tx) VALUES (?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(user_id, resolution, bucket_ts, wg_public) DO UPDATE SET rx=rx+excluded.rx, tx=tx+excluded.tx",
+        [(u, resolution, b, k, rx, tx) for u, b, k, rx, tx in rows])
+
+def rollup_traffic(limit: int) -> int:
+    """
+    Одна пачка: до limit старых корзин -> в корзины следующего разрешения (суммы складываются, поэтому
+    пачками можно переносить любую часть), суточные старше TRAFFIC_DAY_DAYS и заброшенные счётчики — удалить.
+    """
+    conn = get_conn()
+    now = int(time.time())
+    done = 0
+    for resolution, coarser, keep in TRAFFIC_LEVELS:
+        rows = conn.execute(
+            "SELECT user_id, bucket_ts, wg_public, rx, tx FROM traffic WHERE resolution=? AND bucket_ts < ? LIMIT ?",
+            (resolution, now - keep, limit - done)).fetchall()
+        if rows:
+            _add_traffic(conn, coarser, [(u, b // coarser * coarser, k, rx, tx) for u, b, k, rx, tx in rows])
+            conn.executemany("DELETE FROM traffic WHERE user_id=? AND resolution=? AND bucket_ts=? AND wg_public=?",
+                             [(u, resolution, b, k) for u, b, k, _, _ in rows])
+            done += len(rows)
+        if done >= limit:
+            conn.commit()
+            return done
+    done += conn.execute(
+        "DELETE FROM traffic WHERE (user_id, resolution, bucket_ts, wg_public) IN (SELECT user_id, resolution,"
+        " bucket_ts, wg_public FROM traffic WHERE resolution=86400 AND bucket_ts < ? LIMIT ?)",
+        (now - TRAFFIC_DAY_DAYS * 86400, limit - done)).rowcount
+    if done < limit:
+        done += conn.execute(
+            "DELETE FROM traffic_counters WHERE (server, wg_public) IN"
+            " (SELECT server, wg_public FROM traffic_counters WHERE ts < ? LIMIT ?)",
+            (now - TRAFFIC_MINUTE_HOURS * 3600, limit - done)).rowcount
+    conn.commit()
+    return done
+
+async def store_traffic(server: str, snapshots: list) -> dict:
+    """Разобрать снимки сервера, отнести пиров к пользователям и записать приросты по шардам."""
+    now = int(time.time())
+    parsed = []
+    for snap in snapshots:
+        ts = min(int(snap.get("ts") or now), now)  # Infinity -> OverflowError, NaN -> ValueError
+        if ts <= 0:
+            raise ValueError(f"bad ts: {ts}")
+        parsed.append((ts, parse_wg_dump(snap.get("dump") or "")))
+    parsed.sort(key=lambda p: p[0])
+    owners = await resolve_peer_owners({key for _, peers in parsed for key, _, _ in peers})
+    by_shard = {}
+    unknown = 0
+    for ts, peers in parsed:
+        for key, rx, tx in peers:
+            user_id = owners.get(key)
+            if user_id is None:
+                unknown += 1
+                continue
+            by_shard.setdefault(user_shard(user_id), []).append((ts, key, user_id, rx, tx))
+    results = await asyncio.gather(*(db_write_on(shard, ingest_traffic, server, samples)
+                                     for shard, samples in by_shard.items()))
+    stored = sum(r[0] for r in results)
+    stale = sum(r[1] for r in results)
+    users = set().union(*(r[2] for r in results))
+    TRAFFIC_SAMPLES["stored"].inc(stored)
+    TRAFFIC_SAMPLES["stale"].inc(stale)
+    TRAFFIC_SAMPLES["unknown_peer"].inc(unknown)
+    if users:
+        for user_id in users:
+            for period in CHART_PERIODS:
+                chart_cache.pop((user_id, period))
+        for period in CHART_PERIODS:
+            chart_cache.pop(("all", period))
+    return {"stored": stored, "stale": stale, "unknown": unknown, "users": len(users)}
+
+def traffic_series(user_id: Optional[int], since: int, step: int) -> list:
+    """[(начало точки, rx, tx), ...] из корзин всех разрешений; без user_id — по всем пользователям шарда."""
+    conn = get_conn()
+    if user_id is not None:
+        return conn.execute(
+            "SELECT bucket_ts / ? * ? AS b, SUM(rx), SUM(tx) FROM traffic WHERE user_id=? AND bucket_ts >= ?"
+            " GROUP BY b ORDER BY b", (step, step, user_id, since)).fetchall()
+    return conn.execute(
+        "SELECT bucket_ts / ? * ? AS b, SUM(rx), SUM(tx) FROM traffic WHERE resolution IN (60, 3600, 86400)"
+        " AND bucket_ts >= ? GROUP BY b ORDER BY b", (step, step, since)).fetchall()
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "Б" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ТБ"
+
+def render_traffic_chart(series: list, since: int, step: int, title: str) -> bytes:
+    """PNG с двумя линиями (скачано / отдано клиентом); вызывается в потоке, не в event loop."""
+    points = {b: (rx, tx) for b, rx, tx in series}
+    xs = list(range(since // step * step, int(time.time()) + 1, step))
+    peak = max([max(rx, tx) for rx, tx in points.values()] + [1])
+    scale, unit = 1, "Б"
+    for bigger in ("КБ", "МБ", "ГБ", "ТБ"):
+        if peak < scale * 1024:
+            break
+        scale, unit = scale * 1024, bigger
+    fig = Figure(figsize=(8, 3.5), dpi=100)
+    ax = fig.add_subplot()
+    dates = [datetime.datetime.utcfromtimestamp(x) for x in xs]
+    # с точки зрения сервера rx — от клиента, tx — клиенту
+    ax.plot(dates, [points.get(x, (0, 0))[1] / scale for x in xs], label="скачано")
+    ax.plot(dates, [points.get(x, (0, 0))[0] / scale for x in xs], label="отдано")
+    ax.set_title(title)
+    ax.set_ylabel(f"{unit} за {step // 60} мин" if step < 3600 else f"{unit} за {step // 3600} ч")
+    ax.legend(loc="upper left")
+    ax.grid(alpha=0.3)
+    fig.autofmt_xdate()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    return buf.getvalue()
+
+async def traffic_chart(user_id: Optional[int], period: str) -> list:
+    """[png или None, подпись, file_id] из кэша или свежий; без matplotlib png = None."""
+    key = (user_id if user_id is not None else "all", period)
+    cached = chart_cache.get(key)
+    if cached is not None:
+        return cached
+    length, step = CHART_PERIODS[period]
+    since = int(time.time()) - length
+    if user_id is not None:
+        series = await db_read_on(user_shard(user_id), traffic_series, user_id, since, step)
+    else:
+        merged = {}
+        for rows in await db_read_all(traffic_series, None, since, step):
+            for b, rx, tx in rows:
+                acc = merged.setdefault(b, [0, 0])
+                acc[0] += rx
+                acc[1] += tx
+        series = [(b, rx, tx) for b, (rx, tx) in sorted(merged.items())]
+    rx_total = sum(r[1] for r in series)
+    tx_total = sum(r[2] for r in series)
+    who = f"пользователь {user_id}" if user_id is not None else "все пользователи"
+    caption = (f"Трафик за {CHART_PERIOD_NAMES[period][1]} ({who}): "
+               f"скачано {_fmt_bytes(tx_total)}, отдано {_fmt_bytes(rx_total)}")
+    png = None
+    if Figure is not None and series:
+        png = await asyncio.get_running_loop().run_in_executor(
+            None, render_traffic_chart, series, since, step, f"Трафик за {CHART_PERIOD_NAMES[period][1]}")
+    entry = [png, caption, None]
+    chart_cache.set(key, entry, CHART_CACHE_TTL)
+    return entry
+
+async def send_traffic_chart(message: Message, user_id: Optional[int], period: str, reply_markup=None):
+    entry = await traffic_chart(user_id, period)
+    png, caption, file_id = entry
+    if png is None:
+        await message.answer(caption if Figure is not None else f"{caption}\n(графики: pip install matplotlib)",
+                             reply_markup=reply_markup)
+        return
+    # повторно отправляем уже загруженную в Telegram картинку по file_id
+    sent = await message.answer_photo(file_id or BufferedInputFile(png, filename=f"traffic_{period}.png"),
+                                      caption=caption, reply_markup=reply_markup)
+    if file_id is None and sent.photo:
+        entry[2] = sent.photo[-1].file_id
+
+def traffic_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=button, callback_data=f"traffic:{period}")
+        for period, (button, _) in CHART_PERIOD_NAMES.items()
+    ]])
+
+@dp.callback_query(F.data == "traffic")
+async def cb_traffic(query: CallbackQuery):
+    await send_traffic_chart(query.message, query.from_user.id, "day", traffic_keyboard())
+
+@dp.callback_query(F.data.startswith("traffic:"))
+async def cb_traffic_period(query: CallbackQuery):
+    period = query.data.split(":", 1)[1]
+    if period not in CHART_PERIODS:
+        return
+    await send_traffic_chart(query.message, query.from_user.id, period, traffic_keyboard())
+
+@dp.message(Command("traffic"))
+async def cmd_traffic(message: Message):
+    """/traffic [day|week|month|year] — свой трафик; админ: /traffic [период] [user_id|all]."""
+    args = message.text.split()[1:]
+    period = args[0] if args and args[0] in CHART_PERIODS else "day"
+    user_id = message.from_user.id
+    if message.from_user.id in ADMIN_IDS and len(args) > 1:
+        if args[1] == "all":
+            user_id = None
+        elif args[1].isdigit():
+            user_id = int(args[1])
+    await send_traffic_chart(message, user_id, period, traffic_keyboard() if user_id == message.from_user.id else None)
+
+# -------------------------
+#  Отсев перебора токенов (/redeem)
+# -------------------------
+class TokenFilter:
+    """
+    Counting Bloom filter живых токенов (строк tokens во всех шардах): "точно нет" — без запроса к БД,
+    "возможно есть" — обычный поиск в БД (ложных срабатываний ~REDEEM_FILTER_FP).
+    Токен попадает в фильтр при выдаче и покидает его, когда чистильщик удаляет строку. Погашенные и
+    отозванные остаются: на повторный /redeem сервер по-прежнему получает already_used / revoked.
+    Счётчики — байты: дошедший до 255 больше не уменьшается (лишь ложное "есть").
+    Пополняется из потоков-писателей шардов — под lock; проверка из event loop-а — без lock.
+
+    При WORKERS > 1 выдача в соседнем процессе сюда не попадает: промах проверяется догрузкой токенов,
+    созданных с последней догрузки (индекс по created_ts), не чаще раза в REDEEM_FILTER_CATCHUP_MS —
+    нагрузка на БД от перебора ограничена этой частотой. Удалённые чистильщиком токены в этом режиме
+    остаются в фильтре: доля ложных "есть" растёт до рестарта (см. метрику redeem_filter_items).
+    """
+    LAG = 10  # сек: транзакция выдачи может закоммититься позже своего created_ts
+
+    def __init__(self, capacity: int, fp_rate: float, shared: bool):
+        self.fp_rate = fp_rate
+        self.shared = shared
+        self.ready = False  # до warm() пропускает всё
+        self.items = 0
+        self._lock = threading.Lock()
+        self._alloc(capacity)
+        self.watermark = 0  # created_ts, до которого (минус LAG) токены уже в фильтре
+        self._recent = {}  # token -> created_ts за последние LAG сек: догрузка не добавит их второй раз
+        self.next_catch_up = 0.0
+
+    def _alloc(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self.m = max(64, math.ceil(-self.capacity * math.log(self.fp_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / self.capacity * math.log(2)))
+        self._counters = bytearray(self.m)
+
+    def _positions(self, token: str):
+        digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def _add_locked(self, tokens, created_ts: int):
+        counters = self._counters
+        for token in tokens:
+            if self.shared:
+                if token in self._recent:
+                    continue
+                self._recent[token] = created_ts
+            for pos in self._positions(token):
+                if counters[pos] < 255:
+                    counters[pos] += 1
+            self.items += 1
+
+    def add(self, tokens, created_ts: int):
+        # до warm() не нужен: всё уже выданное warm() прочитает из базы
+        if not self.ready:
+            return
+        with self._lock:
+            self._add_locked(tokens, created_ts)
+
+    def remove(self, tokens):
+        # при WORKERS > 1 токены соседних воркеров могли сюда не попасть: их вычитание обнулило бы счётчики
+        # живых токенов, и те навсегда получали бы not_found. Лишние "есть" там и так допускаются.
+        if not self.ready or self.shared:
+            return
+        with self._lock:
+            counters = self._counters
+            for token in tokens:
+                for pos in self._positions(token):
+                    if 0 < counters[pos] < 255:
+                        counters[pos] -= 1
+                self.items -= 1
+
+    def might_contain(self, token: str) -> bool:
+        if not self.ready:
+            return True
+        counters = self._counters
+        return all(counters[pos] for pos in self._positions(token))
+
+    def warm(self):
+        """Загрузка всех токенов из всех шардов (вызывать из потока БД, до приёма запросов)."""
+        total = sum(get_conn(shard).execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+                    for shard in range(DB_SHARDS))
+        with self._lock:
+            self._alloc(max(REDEEM_FILTER_CAPACITY, 2 * total))
+            self.items = 0
+            self._recent.clear()
+            self.watermark = int(time.time())
+            for shard in range(DB_SHARDS):
+                cur = get_conn(shard).execute("SELECT token, created_ts FROM tokens")
+                while rows := cur.fetchmany(MIGRATION_BATCH):
+                    for token, created_ts in rows:
+                        self._add_locked((token,), created_ts or 0)
+            self._prune_recent_locked()
+            self.ready = True
+        log.info("[redeem] фильтр токенов: %d токенов, %d КБ, k=%d", self.items, self.m // 1024, self.k)
+
+    def _prune_recent_locked(self):
+        cutoff = self.watermark - self.LAG
+        for token in [t for t, ts in self._recent.items() if ts < cutoff]:
+            del self._recent[token]
+
+    def catch_up(self, rows: list, now: int):
+        """Токены, созданные соседними воркерами: строки (token, created_ts) с created_ts >= watermark - LAG."""
+        with self._lock:
+            for token, created_ts in rows:
+                self._add_locked((token,), created_ts)
+            self.watermark = now
+            self._prune_recent_locked()
+
+def tokens_created_since(since_ts: int) -> list:
+    return get_conn().execute("SELECT token, created_ts FROM tokens WHERE created_ts >= ?", (since_ts,)).fetchall()
+
+token_filter = TokenFilter(REDEEM_FILTER_CAPACITY, REDEEM_FILTER_FP, WORKERS > 1)
+_filter_catch_up_task = None
+
+async def token_filter_catch_up():
+    """Догрузка фильтра (только WORKERS > 1); параллельные промахи ждут одну и ту же догрузку."""
+    global _filter_catch_up_task
+    if _filter_catch_up_task is None or _filter_catch_up_task.done():
+        if time.monotonic() < token_filter.next_catch_up:
+            return
+        token_filter.next_catch_up = time.monotonic() + REDEEM_FILTER_CATCHUP_MS / 1000
+
+        async def run():
+            now = int(time.time())
+            chunks = await db_read_all(tokens_created_since, token_filter.watermark - TokenFilter.LAG)
+            token_filter.catch_up([row for chunk in chunks for row in chunk], now)
+
+        _filter_catch_up_task = asyncio.create_task(run())
+    await asyncio.shield(_filter_catch_up_task)
+
+async def token_maybe_live(token: str) -> bool:
+    if not isinstance(token, str) or not token:
+        return False
+    if token_filter.might_contain(token):
+        return True
+    if not token_filter.shared:
+        return False
+    await token_filter_catch_up()
+    return token_filter.might_contain(token)
+
+# лимиты /redeem: ключ -> TokenBucket; запись живёт, пока ведро не наполнилось бы заново
+redeem_ip_buckets = TTLCache(REDEEM_THROTTLE_KEYS)
+redeem_jwt_buckets = TTLCache(REDEEM_THROTTLE_KEYS)
+
+def redeem_throttled(cache: TTLCache, key, rate: float, burst: float, n: int = 1) -> bool:
+    """n — сколько токенов проверяет запрос: пачка расходует лимит так же, как n одиночных /redeem."""
+    if rate <= 0:
+        return False
+    bucket = cache.get(key)
+    if bucket is None:
+        bucket = TokenBucket(rate, burst)
+    limited = not bucket.try_acquire(n)
+    # TTL — время до полного ведра: после большой пачки долг гасится дольше burst / rate
+    cache.set(key, bucket, max(burst - bucket.tokens, 1) / rate)
+    return limited
+
+def _throttled_response():
+    return web.json_response({"ok": False, "error": "rate_limited"}, status=429, headers={"Retry-After": "1"})
+
 # -------------------------
+#  API: /redeem, /redeem_batch, /peers, /traffic, /issue_jwt
+# -------------------------
+# уже проверенные JWT: строка токена -> (kid, payload); запись живёт не дольше exp
+jwt_cache = TTLCache(JWT_CACHE_SIZE)
+api_requests_by_sub = {}  # sub -> число запросов к API
+
+def issue_server_jwt(sub: str) -> str:
+    now = int(time.time())
+    payload = {"iss": "vpn_bot", "sub": sub, "iat": now, "exp": now + JWT_LIFETIME_HOURS * 3600}
+    return jwt.encode(payload, JWT_KEYS[JWT_ACTIVE_KID], algorithm=JWT_ALGO, headers={"kid": JWT_ACTIVE_KID})
+
+def verify_server_jwt(token: str) -> dict:
+    """
+    Проверка JWT сервера. Повторные запросы с тем же JWT берутся из кэша без HMAC.
+    Бросает jwt.InvalidTokenError.
+    """
+    cached = jwt_cache.get(token)
+    if cached is not None:
+        kid, payload = cached
+        if kid is None or kid in JWT_KEYS:
+            return payload
+        jwt_cache.pop(token)
+    kid = jwt.get_unverified_header(token).get("kid")
+    key = JWT_KEYS.get(kid) if kid is not None else JWT_SECRET
+    if key is None:
+        raise jwt.InvalidTokenError(f"unknown kid: {kid}")
+    payload = jwt.decode(token, key, algorithms=[JWT_ALGO])
+    exp = payload.get("exp")
+    ttl = min(JWT_CACHE_MAX_TTL, exp - time.time()) if exp else JWT_CACHE_MAX_TTL
+    if ttl > 0:
+        jwt_cache.set(token, (kid, payload), ttl)
+    return payload
+
+def _check_api_jwt(jwt_token: str):
+    """Возвращает (payload, None) или (None, json_response с ошибкой)."""
+    try:
+        payload = verify_server_jwt(jwt_token)
+    except Exception as e:
+        return None, web.json_response({"ok": False, "error": "bad_jwt", "detail": str(e)}, status=403)
+    sub = payload.get("sub", "-")
+    api_requests_by_sub[sub] = api_requests_by_sub.get(sub, 0) + 1
+    return payload, None
+
 async def api_redeem(request):
+    # лимит по IP — до разбора тела и проверки подписи JWT
+    if redeem_throttled(redeem_ip_buckets, request.remote, REDEEM_IP_RATE, REDEEM_IP_BURST):
+        REDEEM_REJECTED["ip_throttle"].inc()
+        return _throttled_response()
     try:
         data = await request.json()
     except:
         return web.json_response({"ok": False, "error": "bad_json"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"ok": False, "error": "bad_json"}, status=400)
     # expect jwt and token OR secret
     jwt_token = data.get("jwt")
     token = data.get("token")
-    if not jwt_token or not token:
+    if not jwt_token or not isinstance(token, str) or not token:
         return web.json_response({"ok": False, "error": "missing_jwt_or_token"}, status=400)
     # validate jwt
-    try:
-        payload = jwt.decode(jwt_token, JWT_SECRET, algorithms=[JWT_ALGO])
-    except Exception as e:
-        return web.json_response({"ok": False, "error": "bad_jwt", "detail": str(e)}, status=403)
-    ok, code, info = redeem_token_api(token)
+    payload, err = _check_api_jwt(jwt_token)
+    if err:
+        return err
+    # утёкший JWT перебирает токены с разных адресов — его лимит общий
+    if redeem_throttled(redeem_jwt_buckets, payload.get("sub", "-"), REDEEM_JWT_RATE, REDEEM_JWT_BURST):
+        REDEEM_REJECTED["jwt_throttle"].inc()
+        return _throttled_response()
+    ok, code, info = await redeem_token(token)
     if not ok:
         return web.json_response({"ok": False, "error": code}, status=400)
     # on success return wg private/public so vpn server can configure interface
     return web.json_response({"ok": True, "status": "redeemed", "info": info})
 
+async def api_redeem_batch(request):
+    """
+    Пакетное погашение для VPN-узла после простоя: {"jwt": "...", "tokens": ["...", ...]}.
+    Все токены — одна проверка JWT и одна транзакция; статус у каждого токена свой.
+    Лимит по IP — запрос, лимит по JWT — каждый токен пачки.
+    """
+    if redeem_throttled(redeem_ip_buckets, request.remote, REDEEM_IP_RATE, REDEEM_IP_BURST):
+        REDEEM_REJECTED["ip_throttle"].inc()
+        return _throttled_response()
+    try:
+        data = await request.json()
+    except:
+        return web.json_response({"ok": False, "error": "bad_json"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"ok": False, "error": "bad_json"}, status=400)
+    jwt_token = data.get("jwt")
+    tokens = data.get("tokens")
+    if not jwt_token or not isinstance(tokens, list):
+        return web.json_response({"ok": False, "error": "missing_jwt_or_tokens"}, status=400)
+    if len(tokens) > REDEEM_BATCH_MAX:
+        return web.json_response({"ok": False, "error": "too_many_tokens", "max": REDEEM_BATCH_MAX}, status=413)
+    payload, err = _check_api_jwt(jwt_token)
+    if err:
+        return err
+    if redeem_throttled(redeem_jwt_buckets, payload.get("sub", "-"), REDEEM_JWT_RATE, REDEEM_JWT_BURST, len(tokens)):
+        REDEEM_REJECTED["jwt_throttle"].inc()
+        return _throttled_response()
+    results = await redeem_batch(tokens)
+    return web.json_response({"ok": True, "results": [
+        {"token": token, "ok": ok, "status": code, "code": REDEEM_STATUS_CODES[code], "info": info}
+        for token, ok, code, info in results
+    ]})
+
+async def api_peers(request):
+    """
+    Лента пиров для VPN-серверов: GET /peers?since=<версия>&wait=<сек>, JWT в "Authorization: Bearer <jwt>".
+    Без since (или с устаревшим) — снимок всех пиров с "reset": true, иначе — добавления и удаления после since.
+    С wait ответ откладывается до первого изменения. ETag — версия ответа: If-None-Match с ней даёт 304.
+    Ответ сжимается, если клиент прислал Accept-Encoding.
+    """
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return web.json_response({"ok": False, "error": "missing_jwt"}, status=401)
+    payload, err = _check_api_jwt(auth[7:])
+    if err:
+        return err
+    try:
+        wait = min(max(float(request.query.get("wait", 0)), 0.0), PEERS_MAX_WAIT)
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad_wait"}, status=400)
+    cursor = parse_peers_cursor(request.query.get("since"))
+    feed = await wait_peers(cursor, wait) if cursor is not None and wait else await peers_feed(cursor)
+    # слабый ETag: тело одно и то же, а байты зависят от сжатия
+    tag = f'"{feed["version"]}{".full" if feed["reset"] else ""}"'
+    headers = {"ETag": f"W/{tag}", "Cache-Control": "no-cache"}
+    if tag in (t.strip().removeprefix("W/") for t in request.headers.get("If-None-Match", "").split(",")):
+        return web.Response(status=304, headers=headers)
+    resp = web.json_response({"ok": True, **feed}, headers=headers)
+    resp.enable_compression()
+    return resp
+
+async def read_body_limited(request, limit: int) -> Optional[bytes]:
+    """Тело запроса (gzip aiohttp уже распаковал), не больше limit байт; больше — None."""
+    body = bytearray()
+    async for chunk in request.content.iter_chunked(64 * 1024):
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+async def api_traffic(request):
+    """
+    Приём трафика от VPN-сервера: POST /traffic, JWT в "Authorization: Bearer <jwt>",
+    тело {"snapshots": [{"ts": <unix>, "dump": "<вывод wg show wg0 dump>"}, ...]} (можно gzip).
+    Счётчики считаются по серверу (sub из JWT): снимки накопленные за простой можно прислать одним запросом.
+    """
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return web.json_response({"ok": False, "error": "missing_jwt"}, status=401)
+    payload, err = _check_api_jwt(auth[7:])
+    if err:
+        return err
+    # общий предел приложения (1 МБ) поднят только здесь и только после проверки JWT
+    body = await read_body_limited(request, TRAFFIC_MAX_BODY)
+    if body is None:
+        return web.json_response({"ok": False, "error": "body_too_large", "max": TRAFFIC_MAX_BODY}, status=413)
+    try:
+        data = json.loads(body)
+    except:
+        return web.json_response({"ok": False, "error": "bad_json"}, status=400)
+    snapshots = data.get("snapshots") if isinstance(data, dict) else None
+    if not isinstance(snapshots, list) or not all(isinstance(s, dict) for s in snapshots):
+        return web.json_response({"ok": False, "error": "missing_snapshots"}, status=400)
+    if len(snapshots) > TRAFFIC_SNAPSHOTS_MAX:
+        return web.json_response({"ok": False, "error": "too_many_snapshots", "max": TRAFFIC_SNAPSHOTS_MAX},
+                                 status=413)
+    try:
+        res = await store_traffic(payload.get("sub", "-"), snapshots)
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        return web.json_response({"ok": False, "error": "bad_snapshot"}, status=400)
+    return web.json_response({"ok": True, **res})
+
 async def api_issue_jwt(request):
     # simple endpoint to issue a JWT for a server; protected by simple shared secret in header (for demo)
     secret = request.headers.get("X-ADMIN-SECRET")
     if secret != JWT_SECRET:
         return web.json_response({"ok": False, "error": "bad_secret"}, status=403)
-    now = datetime.datetime.utcnow()
-    payload = {"iss": "vpn_bot", "iat": int(now.timestamp()), "exp": int((now + datetime.timedelta(hours=24)).timestamp())}
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGO)
-    return web.json_response({"ok": True, "jwt": token})
+    # имя сервера: ?sub=node-1 (по умолчанию — случайное)
+    sub = request.query.get("sub") or f"srv-{secrets.token_hex(3)}"
+    return web.json_response({"ok": True, "jwt": issue_server_jwt(sub), "sub": sub})
+
+API_ROUTES = ("/redeem", "/redeem_batch", "/peers", "/traffic", "/issue_jwt")
+if BOT_MODE == "webhook":
+    API_ROUTES += (WEBHOOK_PATH,)
+for _route in API_ROUTES:
+    _api_metrics(_route)
+
+@web.middleware
+async def api_metrics_middleware(request, handler):
+    route = request.path if request.path in API_SECONDS else None
+    if route is None:
+        return await handler(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        API_SECONDS[route].observe(time.perf_counter() - started)
+        API_RESPONSES[(route, "2xx" if status < 400 else "4xx" if status < 500 else "5xx")].inc()
+
+async def api_metrics(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=403)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+# метрики, которые проще снять в момент запроса, чем обновлять на горячем пути
+GaugeFunc("tg_cache_hits_total", "Telegram data cache hits", lambda: tg_cache.hits, kind="counter")
+GaugeFunc("tg_cache_misses_total", "Telegram data cache misses", lambda: tg_cache.misses, kind="counter")
+GaugeFunc("jwt_cache_hits_total", "Verified-JWT cache hits", lambda: jwt_cache.hits, kind="counter")
+GaugeFunc("jwt_cache_misses_total", "Verified-JWT cache misses", lambda: jwt_cache.misses, kind="counter")
+GaugeFunc("wg_key_pool_size", "Ready keypairs in the pool", lambda: len(wg_key_pool))
+GaugeFunc("wg_key_pool_misses_total", "Keypairs generated inline because the pool was empty",
+          lambda: wg_key_pool.misses, kind="counter")
+GaugeFunc("ipam_free_addresses", "Free client addresses", lambda: ipam_stats()["free"])
+GaugeFunc("ipam_exhausted_total", "Address allocations refused because the client subnet is full",
+          lambda: sum(ipam.exhausted for ipam in ipams), kind="counter")
+GaugeFunc("flood_dropped_total", "Events dropped by the anti-flood middleware", lambda: flood_limiter.dropped,
+          kind="counter")
+GaugeFunc("sweeper_tokens_last_run", "Tokens swept by the last sweeper run", lambda: SWEEP_STATS["tokens_last"])
+GaugeFunc("sweeper_tokens_total", "Tokens swept since start", lambda: SWEEP_STATS["tokens_total"], kind="counter")
+GaugeFunc("sweeper_referrals_total", "Referrals archived since start", lambda: SWEEP_STATS["referrals_total"],
+          kind="counter")
+GaugeFunc("sweeper_last_duration_seconds", "Duration of the last sweeper run", lambda: SWEEP_STATS["last_duration"])
+GaugeFunc("referral_graph_edges", "Referral edges in the in-memory graph", lambda: len(referral_graph))
+GaugeFunc("referrals_held_total", "Referral rewards held for review", lambda: referral_graph.held, kind="counter")
+GaugeFunc("redeem_filter_items", "Tokens in the redeem negative-lookup filter", lambda: token_filter.items)
+GaugeFunc("redeem_throttle_clients", "Client IPs and JWTs tracked by the redeem throttle",
+          lambda: len(redeem_ip_buckets) + len(redeem_jwt_buckets))
+GaugeFunc("peers_longpoll_waiting", "Clients waiting in /peers long-poll", lambda: peers_waiting)
+DictCounter("api_requests_by_server_total", "Authenticated API requests by JWT sub", "sub", api_requests_by_sub)
 
 async def start_api():
-    app = web.Application()
+    """
+    aiohttp-сервер API. В режиме webhook на нём же принимаются апдейты Telegram (WEBHOOK_PATH).
+    При WORKERS > 1 порт открывается с SO_REUSEPORT: ядро раскидывает соединения по процессам.
+    """
+    app = web.Application(middlewares=[api_metrics_middleware])
     app.router.add_post("/redeem", api_redeem)
+    app.router.add_post("/redeem_batch", api_redeem_batch)
+    app.router.add_get("/peers", api_peers)
+    app.router.add_post("/traffic", api_traffic)
     app.router.add_post("/issue_jwt", api_issue_jwt)
+    app.router.add_get("/metrics", api_metrics)
+    if BOT_MODE == "webhook":
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)  # startup/shutdown диспетчера и закрытие сессии бота
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, host="0.0.0.0", port=5001)
+    site = web.TCPSite(runner, host=API_HOST, port=API_PORT, reuse_port=WORKERS > 1 or None)
     await site.start()
+    return runner
+
+# -------------------------
+#  Профилирование по запросу (/profile)
+# -------------------------
+# Хендлеры aiogram и маршруты aiohttp выполняются в потоке event loop-а, поэтому оба режима снимают их вместе:
+#   cprofile — детерминированный cProfile потока loop-а: точные вызовы и время, но заметно замедляет бота;
+#   sample   — отдельный поток раз в PROFILE_SAMPLE_INTERVAL_MS снимает стеки всех потоков (loop, пулы БД,
+#              генератор ключей); накладные расходы малы, годится для прода.
+# На время сессии loop переводится в debug с slow_callback_duration: asyncio сообщает о каждом шаге дольше
+# PROFILE_SLOW_CALLBACK_MS — так видны синхронные SQLite/subprocess, застрявшие в loop-е. Debug-режим сам
+# стоит времени (traceback/linecache в профиле — это он). При WORKERS > 1 профилируется только воркер,
+# получивший команду.
+class StackSampler:
+    """Сэмплирующий профилировщик: счётчики одинаковых стеков (поток;кадр;...;кадр -> сэмплов)."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.loop_thread = threading.get_ident()  # создаётся из event loop-а
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append("event loop" if ident == self.loop_thread else names.get(ident, str(ident)))
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """Формат collapsed stacks: flamegraph.pl / speedscope читают его как есть."""
+        return "".join(f"{';'.join(stack)} {n}\n" for stack, n in sorted(self.stacks.items()))
+
+    def summary(self, top: int) -> str:
+        out = [f"Сэмплов: {self.samples} (раз в {self.interval * 1000:g} мс)\n"]
+        for title, in_loop in (("Поток event loop-а", True), ("Остальные потоки", False)):
+            own, total, threads_samples = {}, {}, 0
+            for stack, n in self.stacks.items():
+                if (stack[0] == "event loop") != in_loop:
+                    continue
+                threads_samples += n
+                own[stack[-1]] = own.get(stack[-1], 0) + n
+                for func in set(stack[1:]):
+                    total[func] = total.get(func, 0) + n
+            out.append(f"\n== {title}: {threads_samples} сэмплов ==\n")
+            if not threads_samples:
+                continue
+            out.append(f"{'self %':>7} {'total %':>8}  функция\n")
+            for func, n in heapq.nlargest(top, own.items(), key=lambda kv: kv[1]):
+                out.append(f"{n / threads_samples:>7.1%} {total[func] / threads_samples:>8.1%}  {func}\n")
+        return "".join(out)
+
+class _SlowCallbackLog(logging.Handler):
+    """Сообщения asyncio "Executing <Handle ...> took N seconds" за время сессии."""
+
+    def __init__(self, limit: int = 1000):
+        super().__init__(logging.WARNING)
+        self.limit = limit
+        self.messages = []
+        self.dropped = 0
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if not msg.startswith("Executing "):
+            return
+        if len(self.messages) < self.limit:
+            self.messages.append(msg)
+        else:
+            self.dropped += 1
+
+_profile_running = False
+
+async def run_profile(mode: str, seconds: int) -> list:
+    """
+    Профилирует seconds секунд. Возвращает [(имя файла, bytes, подпись)]: сводку (топ функций и медленные
+    шаги loop-а) и сырой профиль — .pstats (python -m pstats, snakeviz) или .folded (flamegraph).
+    """
+    loop = asyncio.get_running_loop()
+    slow_log = _SlowCallbackLog()
+    asyncio_logger = logging.getLogger("asyncio")
+    was_debug, was_slow = loop.get_debug(), loop.slow_callback_duration
+    asyncio_logger.addHandler(slow_log)
+    loop.slow_callback_duration = PROFILE_SLOW_CALLBACK_MS / 1000
+    loop.set_debug(True)
+    profiler = cProfile.Profile() if mode == "cprofile" else StackSampler(PROFILE_SAMPLE_INTERVAL_MS / 1000)
+    started = time.strftime("%Y%m%d-%H%M%S")
+    try:
+        if mode == "cprofile":
+            profiler.enable()
+        else:
+            profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            if mode == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+    finally:
+        loop.set_debug(was_debug)
+        loop.slow_callback_duration = was_slow
+        asyncio_logger.removeHandler(slow_log)
+
+    if mode == "cprofile":
+        buf = io.StringIO()
+        stats = pstats.Stats(profiler, stream=buf)
+        for key in ("tottime", "cumulative"):
+            buf.write(f"== Сортировка: {key} ==\n")
+            stats.sort_stats(key).print_stats(PROFILE_TOP)
+        summary = buf.getvalue()
+        profiler.create_stats()
+        raw = (f"profile_{started}.pstats", marshal.dumps(profiler.stats))
+    else:
+        summary = profiler.summary(PROFILE_TOP)
+        raw = (f"profile_{started}.folded", profiler.folded().encode())
+    summary += (f"\n== Шаги event loop-а дольше {PROFILE_SLOW_CALLBACK_MS:g} мс: "
+                f"{len(slow_log.messages) + slow_log.dropped} ==\n")
+    summary += "".join(m + "\n" for m in slow_log.messages)
+    if slow_log.dropped:
+        summary += f"... и ещё {slow_log.dropped}\n"
+    caption = f"{mode}, {seconds} с, медленных шагов loop-а: {len(slow_log.messages) + slow_log.dropped}"
+    return [(f"profile_{started}.txt", summary.encode(), caption), (*raw, "сырой профиль")]
+
+async def _profile_and_send(chat_id: int, mode: str, seconds: int):
+    global _profile_running
+    try:
+        for filename, data, caption in await run_profile(mode, seconds):
+            await bot.send_document(chat_id, BufferedInputFile(data, filename=filename), caption=caption)
+    except Exception as e:
+        log.exception("[profile] ошибка")
+        await bot.send_message(chat_id, f"Профилирование не удалось: {e!r}")
+    finally:
+        _profile_running = False
+
+def start_profile(chat_id: int, mode: str, seconds: int) -> bool:
+    global _profile_running
+    if _profile_running:
+        return False
+    _profile_running = True
+    asyncio.create_task(_profile_and_send(chat_id, mode, seconds))
+    return True
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    mode, seconds = "sample", PROFILE_SECONDS
+    for arg in message.text.split()[1:]:
+        if arg in ("sample", "cprofile"):
+            mode = arg
+        elif arg.isdigit() and 0 < int(arg) <= PROFILE_MAX_SECONDS:
+            seconds = int(arg)
+        else:
+            await message.answer(f"Использование: /profile [sample|cprofile] [секунд, до {PROFILE_MAX_SECONDS}]")
+            return
+    if not start_profile(message.chat.id, mode, seconds):
+        await message.answer("Профилирование уже идёт.")
+        return
+    await message.answer(f"Профилирование ({mode}) на {seconds} с — отчёт придёт документом.")
+
+@dp.callback_query(F.data == "adm_profile")
+async def cb_adm_profile(query: CallbackQuery):
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    if not start_profile(query.message.chat.id, "sample", PROFILE_SECONDS):
+        await query.answer("Профилирование уже идёт")
+        return
+    await query.message.answer(f"Профилирование (sample) на {PROFILE_SECONDS} с — отчёт придёт документом. "
+                               "Точнее, но медленнее: /profile cprofile [секунд]")
 
 # -------------------------
 #  Запуск
 # -------------------------
-async def main():
-    init_db()
-    await start_api()
-    print("API запущен на порту 5001")
-    await dp.start_polling(bot)
+# polling — один процесс. webhook — WORKERS процессов на одном порту; общее между ними только SQLite:
+# FSM (FSM_STORAGE=db), дневная квота (TOKEN_QUOTA_BACKEND=db), адреса IPAM (таблица ip_allocations),
+# статус рассылок. Кэши (подписка, JWT) у каждого воркера свои. Воркер 0 — ведущий: ставит вебхук,
+# продолжает рассылки и запускает чистильщик, чтобы фоновые задачи не шли в N экземплярах.
+async def main(worker_id: int = 0):
+    leader = worker_id == 0
+    wg_key_pool.start()
+    if WORKERS == 1:
+        await db_write_all(init_db)  # при нескольких воркерах миграции делает родительский процесс
+    await asyncio.gather(*(db_write_on(i, ipams[i].load) for i in range(DB_SHARDS)))
+    await db_read(token_quota.warm)
+    await db_read(referral_graph.warm)
+    if REDEEM_FILTER_CAPACITY > 0:
+        await db_read(token_filter.warm)
+    # гистограммы хендлеров создаём заранее, а не на первом запросе
+    for observer in (dp.message, dp.callback_query, dp.chat_member):
+        for h in observer.handlers:
+            _handler_metrics(h.callback.__name__)
+    if leader:
+        await resume_broadcasts()
+        asyncio.create_task(expiry_sweeper())
+        if WORKERS > 1 and not FLOOD_REDIS_URL:
+            log.warning("[flood] FLOOD_REDIS_URL не задан: лимит антифлуда считается в каждом воркере отдельно")
+    runner = await start_api()
+    log.info("[worker %d] API запущен на порту %d, режим %s", worker_id, API_PORT, BOT_MODE)
+    try:
+        if BOT_MODE == "webhook":
+            if leader:
+                # chat_member приходит только если явно запрошен в allowed_updates
+                await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=dp.resolve_used_update_types(),
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS)
+            await asyncio.Event().wait()
+        else:
+            if leader:
+                await bot.delete_webhook()  # getUpdates не работает, пока вебхук установлен
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await runner.cleanup()
+        close_db()
+
+def run_worker(worker_id: int):
+    try:
+        asyncio.run(main(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+def run_workers():
+    """Миграции один раз, затем WORKERS процессов; упал один — останавливаем всех (перезапуск — дело systemd/docker)."""
+    for shard in range(DB_SHARDS):
+        init_db(shard)
+    close_db()
+    ctx = multiprocessing.get_context("spawn")  # без fork: в родителе уже есть потоки пулов БД
+    procs = [ctx.Process(target=run_worker, args=(i,), name=f"worker-{i}") for i in range(WORKERS)]
+    for proc in procs:
+        proc.start()
+    # SIGTERM от systemd/docker — через finally, иначе воркеры останутся сиротами на порту
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        multiprocessing.connection.wait([proc.sentinel for proc in procs])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook требует WEBHOOK_URL")
+    if WORKERS > 1 and BOT_MODE == "webhook":
+        run_workers()
+    else:
+        if WORKERS > 1:
+            log.warning("[main] WORKERS > 1 работает только с BOT_MODE=webhook, запускаем один процесс")
+        asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Перераскладка базы бота на другое число шардов (в т.ч. из одного vpn_full.db в несколько файлов).
+
+  python reshard.py --src vpn_full.db --src-shards 1 --dst vpn_new.db --dst-shards 4
+
+Бот при этом должен быть остановлен. Исходные файлы не меняются; новые создаются рядом:
+vpn_new.db (шард 0), vpn_new.shard1.db, ... Затем переименуйте их в DB_PATH и выставьте DB_SHARDS.
+
+Строки таблиц из SHARD_ROUTING уходят в шард своего пользователя, остальные таблицы (рассылки, FSM)
+копируются из исходного шарда 0 в новый шард 0. Журналы шардов (SHARD_LOCAL_TABLES) не переносятся:
+VPN-серверы после переезда получат в /peers полный снимок. Токены не переписываются: номер бакета в префиксе
+указывает на новый шард сам, старые токены без префикса бот ищет во всех шардах.
+В конце число строк в каждой таблице сверяется с исходным.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--src", default=os.getenv("DB_PATH", "vpn_full.db"), help="шард 0 исходной базы")
+ap.add_argument("--src-shards", type=int, default=int(os.getenv("DB_SHARDS", "1")))
+ap.add_argument("--dst", required=True, help="шард 0 новой базы")
+ap.add_argument("--dst-shards", type=int, required=True)
+ap.add_argument("--batch", type=int, default=5000, help="строк за одну вставку")
+args = ap.parse_args()
+
+# схема и маршрутизация — из main.py, новые файлы создаются его миграциями
+os.environ["DB_PATH"] = args.dst
+os.environ["DB_SHARDS"] = str(args.dst_shards)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+
+def open_src(shard):
+    path = main.shard_path(shard, args.src)
+    if not os.path.exists(path):
+        raise SystemExit(f"нет файла {path}")
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != len(main.MIGRATIONS):
+        raise SystemExit(f"{path}: схема версии {version}, нужна {len(main.MIGRATIONS)} — запустите бот один раз")
+    return conn
+
+
+def tables(conn):
+    return [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+def copy_table(src, dst, table, src_shard):
+    columns = [r[1] for r in src.execute(f"PRAGMA table_info({table})")]
+    route = main.SHARD_ROUTING.get(table)
+    if route is None and src_shard != 0:
+        return 0  # общие таблицы живут только в шарде 0
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    cur = src.execute(f"SELECT {', '.join(columns)} FROM {table}")
+    key = columns.index(route) if route else None
+    copied = 0
+    while rows := cur.fetchmany(args.batch):
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(main.user_shard(row[key]) if key is not None else 0, []).append(row)
+        for shard, chunk in by_shard.items():
+            dst[shard].executemany(insert, chunk)
+        copied += len(rows)
+    return copied
+
+
+def count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def run():
+    for shard in range(args.dst_shards):
+        if os.path.exists(main.shard_path(shard)):
+            raise SystemExit(f"{main.shard_path(shard)} уже существует")
+    started = time.perf_counter()
+    srcs = [open_src(i) for i in range(args.src_shards)]
+    dst = []
+    for shard in range(args.dst_shards):
+        main.init_db(shard)
+        dst.append(main.get_conn(shard))
+    for conn in dst:
+        conn.execute("BEGIN")
+    names = [t for t in tables(srcs[0]) if t not in main.SHARD_LOCAL_TABLES]
+    for table in names:
+        n = sum(copy_table(src, dst, table, i) for i, src in enumerate(srcs))
+        print(f"{table}: {n} строк")
+    for conn in dst:
+        conn.commit()
+
+    # сверка: общие таблицы — с шардом 0, остальные — сумма по шардам
+    bad = False
+    for table in names:
+        src_shards = srcs if table in main.SHARD_ROUTING else srcs[:1]
+        before = sum(count(c, table) for c in src_shards)
+        after = sum(count(c, table) for c in dst)
+        if before != after:
+            print(f"ОШИБКА: {table}: было {before}, стало {after}")
+            bad = True
+    for conn in dst:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    main.close_db()
+    if bad:
+        raise SystemExit(1)
+    print(f"готово за {time.perf_counter() - started:.1f} c: {args.src_shards} -> {args.dst_shards} шардов, "
+          f"файлы: {', '.join(main.shard_path(i) for i in range(args.dst_shards))}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,50 @@
+"""
+main читает настройки из окружения при импорте и держит пулы потоков БД до close_db(), поэтому каждый
+сценарий выполняется в отдельном процессе (spawn) со своим окружением: run_main(fn, **env) импортирует
+main, накатывает миграции на все шарды и возвращает fn(main) (корутину — через asyncio.run).
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import traceback
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child(env, fn, init, out):
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    try:
+        import main
+        try:
+            if init:
+                for shard in range(main.DB_SHARDS):
+                    main.init_db(shard)
+            res = fn(main)
+            if asyncio.iscoroutine(res):
+                res = asyncio.run(res)
+            out.put((True, res))
+        finally:
+            main.close_db()
+    except BaseException:
+        out.put((False, traceback.format_exc()))
+
+
+@pytest.fixture
+def run_main(tmp_path):
+    def run(fn, init=True, timeout=120, **env):
+        full_env = {"DB_PATH": str(tmp_path / "vpn.db"), "DB_SHARDS": "1", "WG_KEY_POOL_SIZE": "0",
+                    "LOG_LEVEL": "WARNING", **{k: str(v) for k, v in env.items()}}
+        ctx = multiprocessing.get_context("spawn")
+        out = ctx.Queue()
+        proc = ctx.Process(target=_child, args=(full_env, fn, init, out))
+        proc.start()
+        ok, res = out.get(timeout=timeout)
+        proc.join()
+        assert ok, res
+        return res
+    return run
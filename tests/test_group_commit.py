@@ -0,0 +1,88 @@
+"""
+Регрессия группового коммита при нескольких процессах (WORKERS > 1, TOKEN_QUOTA_BACKEND=db):
+пачка выдачи токенов сначала читает (квота), потом пишет. Отложенный BEGIN в такой транзакции
+получал "database is locked" мимо busy_timeout, и SAVEPOINT превращал это в отказ отдельной выдачи.
+
+  python -m pytest -q tests
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS_PER_PROCESS = 1500
+CONCURRENCY = 200
+
+
+def _setup_env(db_path):
+    os.environ.update({
+        "DB_PATH": db_path,
+        "DB_SHARDS": "1",
+        "TOKEN_QUOTA_BACKEND": "db",
+        "TOKENS_PER_DAY_LIMIT": "1000000",
+        "WG_CLIENT_SUBNET": "10.0.0.0/8",
+        "WG_KEY_POOL_SIZE": "0",
+    })
+    sys.path.insert(0, ROOT)
+
+
+def _init(db_path):
+    _setup_env(db_path)
+    import main
+    main.init_db(0)
+    main.close_db()
+
+
+def _issue(db_path, user_base, start, out):
+    _setup_env(db_path)
+    import main
+
+    async def run():
+        await main.db_write_on(0, main.ipams[0].load)
+        start.wait()
+        sem = asyncio.Semaphore(CONCURRENCY)
+
+        async def one(uid):
+            async with sem:
+                return await main.create_token_for_user(uid)
+
+        results = await asyncio.gather(*(one(user_base + i) for i in range(USERS_PER_PROCESS)),
+                                       return_exceptions=True)
+        errors = [repr(r) for r in results if isinstance(r, BaseException)]
+        refused = [r[1] for r in results if not isinstance(r, BaseException) and not r[0]]
+        return errors, refused
+
+    try:
+        out.put(asyncio.run(run()))
+    finally:
+        main.close_db()
+
+
+def test_grouped_issuance_from_two_processes(tmp_path):
+    db_path = str(tmp_path / "gc.db")
+    ctx = multiprocessing.get_context("spawn")
+    init = ctx.Process(target=_init, args=(db_path,))
+    init.start()
+    init.join()
+    assert init.exitcode == 0
+
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=_issue, args=(db_path, 1_000_000 * (i + 1), start, out)) for i in range(2)]
+    for proc in procs:
+        proc.start()
+    start.set()
+    results = [out.get(timeout=300) for _ in procs]
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    errors = [e for errs, _ in results for e in errs]
+    assert not [e for e in errors if "locked" in e], errors[:5]
+    assert not errors, errors[:5]
+    assert not [r for _, refused in results for r in refused]
+
+    import sqlite3
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0] == 2 * USERS_PER_PROCESS
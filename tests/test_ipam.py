@@ -0,0 +1,58 @@
+"""
+Исчерпание адресов IPAM на маленькой подсети: выдача токена отказывает, награда за приглашение остаётся
+невыданной, а адреса из откатившихся операций пачки возвращаются в карту.
+"""
+
+SUBNET = "10.9.9.0/29"  # адреса .2-.6: пять клиентов
+
+
+async def _exhaust(main):
+    ipam = main.ipams[0]
+    issued = [(await main.create_token_for_user(uid))[0] for uid in range(1, 8)]
+    free_after_issue = ipam.stats()["free"]
+
+    await main.db_write(main.register_user, 100, None)
+    await main.db_write(main.register_user, 101, 100)
+    credited = await main.db_write(main.credit_referral_for, 101, True)
+    conn = main.get_conn(0)
+    held = conn.execute("SELECT credited FROM referrals WHERE new_user=101").fetchone()[0]
+    refs = conn.execute("SELECT refs_count FROM users WHERE user_id=100").fetchone()[0]
+    return issued, free_after_issue, credited, held, refs, ipam.exhausted
+
+
+def test_exhausted_subnet_refuses_tokens_and_holds_rewards(run_main):
+    issued, free, credited, held, refs, exhausted = run_main(_exhaust, WG_CLIENT_SUBNET=SUBNET, REF_REWARD=1)
+
+    assert issued == [True] * 5 + [False] * 2
+    assert free == 0
+    assert credited == (False, None)
+    assert (held, refs) == (0, 0)
+    assert exhausted == 3
+
+
+def _failing_op(conn, user_id):
+    import main
+    main._insert_tokens(conn, user_id, 2)
+    raise RuntimeError("операция упала после выдачи адресов")
+
+
+def _ok_op(conn, user_id):
+    import main
+    return main._insert_tokens(conn, user_id, 1)
+
+
+async def _rollback(main):
+    ipam = main.ipams[0]
+    await main.db_write(ipam.load)
+    before = ipam.stats()["free"]
+    results = await main.db_write(main._run_group, [(_failing_op, (1,)), (_ok_op, (2,)), (_failing_op, (3,))])
+    allocations = main.get_conn(0).execute("SELECT COUNT(*) FROM ip_allocations").fetchone()[0]
+    return before, [ok for ok, _ in results], ipam.stats()["free"], allocations
+
+
+def test_rolled_back_group_op_returns_addresses(run_main):
+    before, oks, after, allocations = run_main(_rollback, WG_CLIENT_SUBNET=SUBNET)
+
+    assert oks == [False, True, False]
+    assert allocations == 1
+    assert after == before - 1
@@ -0,0 +1,72 @@
+"""
+Миграции с базы исходной версии бота (три таблицы без user_version): данные сохраняются,
+epoch-колонки заполняются из текстовых дат, старые токены без префикса шарда гасятся.
+"""
+
+import datetime
+import sqlite3
+
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    ref_by INTEGER,
+    refs_count INTEGER DEFAULT 0,
+    joined_at TEXT,
+    paid INTEGER DEFAULT 0
+);
+CREATE TABLE tokens (
+    token TEXT PRIMARY KEY,
+    user_id INTEGER,
+    created_at TEXT,
+    expires_at TEXT,
+    used INTEGER DEFAULT 0,
+    wg_private TEXT,
+    wg_public TEXT
+);
+CREATE TABLE referrals (
+    new_user INTEGER PRIMARY KEY,
+    ref_by INTEGER,
+    credited INTEGER DEFAULT 0,
+    created_at TEXT
+);
+"""
+
+NOW = datetime.datetime.utcnow().replace(microsecond=0)
+CREATED = (NOW - datetime.timedelta(hours=1)).isoformat()
+EXPIRES = (NOW + datetime.timedelta(hours=23)).isoformat()
+
+
+def _baseline_db(path):
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany("INSERT INTO users (user_id, ref_by, refs_count, joined_at) VALUES (?, ?, ?, ?)",
+                         [(1, None, 1, CREATED), (2, 1, 0, CREATED)])
+        conn.execute("INSERT INTO referrals (new_user, ref_by, credited, created_at) VALUES (2, 1, 1, ?)", (CREATED,))
+        conn.executemany("INSERT INTO tokens (token, user_id, created_at, expires_at, used, wg_private, wg_public)"
+                         " VALUES (?, ?, ?, ?, ?, '', '')",
+                         [("legacyfresh", 1, CREATED, EXPIRES, 0), ("legacyused", 1, CREATED, EXPIRES, 1)])
+    conn.close()
+
+
+async def _check(main):
+    conn = main.get_conn(0)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    epochs = dict((t, (c, e)) for t, c, e in conn.execute("SELECT token, created_ts, expires_ts FROM tokens"))
+    main.init_db(0)  # повторный запуск ничего не меняет
+    version_again = conn.execute("PRAGMA user_version").fetchone()[0]
+    await main.db_read(main.token_filter.warm)
+    redeemed = [r[2] for r in await main.redeem_batch(["legacyfresh", "legacyused", "legacyfresh"])]
+    counts = [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("users", "referrals")]
+    return version, version_again, main.MIGRATIONS[-1][0], epochs, redeemed, counts
+
+
+def test_migrate_from_baseline(run_main, tmp_path):
+    _baseline_db(tmp_path / "vpn.db")
+    version, version_again, latest, epochs, redeemed, counts = run_main(_check)
+
+    assert version == version_again == latest
+    to_ts = lambda iso: int(datetime.datetime.fromisoformat(iso).replace(tzinfo=datetime.timezone.utc).timestamp())
+    assert epochs == {"legacyfresh": (to_ts(CREATED), to_ts(EXPIRES)),
+                      "legacyused": (to_ts(CREATED), to_ts(EXPIRES))}
+    assert redeemed == ["ok", "already_used", "already_used"]
+    assert counts == [2, 1]
@@ -0,0 +1,47 @@
+"""
+Keyset-пагинация общих списков при двух шардах: проход "Старее" до конца и обратно "Новее"
+отдаёт каждую строку ровно один раз и в порядке ключа, без пропусков на стыке шардов.
+"""
+
+USERS = 40
+PAGE = 7
+
+
+async def _walk(main, listing):
+    nkeys = len(main.LISTINGS[listing][1])
+    pages, cursor, more = [], None, True
+    while more:
+        rows, more = await main.read_page(listing, None, cursor, "n")
+        pages.append([row[:nkeys] for row in rows])
+        cursor = rows[-1][:nkeys]
+    back, cursor, more = [], pages[-1][0], True
+    while more:
+        rows, more = await main.read_page(listing, None, cursor, "p")
+        back.insert(0, [row[:nkeys] for row in rows])
+        cursor = rows[0][:nkeys]
+    return pages, back
+
+
+async def _listings(main):
+    for uid in range(1, USERS + 1):
+        await main.db_write_on(main.user_shard(uid), main.register_user, uid, None)
+    for uid in range(1, USERS + 1, 2):
+        ok, res = await main.create_token_for_user(uid)
+        assert ok, res
+    keys = {}
+    for listing, sql in (("au", "SELECT joined_at, user_id FROM users"),
+                         ("at", "SELECT created_ts, token FROM tokens")):
+        keys[listing] = [tuple(row) for shard in range(main.DB_SHARDS) for row in main.get_conn(shard).execute(sql)]
+    shards = {main.user_shard(uid) for uid in range(1, USERS + 1)}
+    return keys, shards, {listing: await _walk(main, listing) for listing in keys}
+
+
+def test_keyset_pages_across_shards(run_main):
+    keys, shards, walks = run_main(_listings, DB_SHARDS=2, ADMIN_PAGE_SIZE=PAGE, TOKENS_PER_DAY_LIMIT=10)
+
+    assert shards == {0, 1}
+    for listing, (pages, back) in walks.items():
+        expected = sorted(keys[listing], reverse=True)
+        assert [key for page in pages for key in page] == expected, listing
+        assert all(len(page) == PAGE for page in pages[:-1]), listing
+        assert [key for page in back for key in page] == expected[:-len(pages[-1])], listing
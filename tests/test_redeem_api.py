@@ -0,0 +1,46 @@
+"""
+/redeem и /redeem_batch на входных данных не того типа: 400 с кодом ошибки вместо 500.
+"""
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+
+async def _requests(main):
+    app = web.Application()
+    app.router.add_post("/redeem", main.api_redeem)
+    app.router.add_post("/redeem_batch", main.api_redeem_batch)
+    await main.db_read(main.token_filter.warm)
+    ok, issued = await main.create_token_for_user(1)
+    assert ok, issued
+    jwt_token = main.issue_server_jwt("test")
+    out = {}
+    async with TestClient(TestServer(app)) as client:
+        async def call(name, path, body):
+            resp = await client.post(path, json=body)
+            out[name] = (resp.status, await resp.json())
+
+        for body in ([], "x", 5, None):
+            await call(f"redeem body {body!r}", "/redeem", body)
+            await call(f"batch body {body!r}", "/redeem_batch", body)
+        for token in (5, [], {}, True, ""):
+            await call(f"redeem token {token!r}", "/redeem", {"jwt": jwt_token, "token": token})
+        await call("batch items", "/redeem_batch",
+                   {"jwt": jwt_token, "tokens": [5, None, "", ["x"], "missing", issued["token"]]})
+        await call("redeem used", "/redeem", {"jwt": jwt_token, "token": issued["token"]})
+    return out
+
+
+def test_bad_input_types(run_main):
+    out = run_main(_requests, REDEEM_IP_RATE=0, REDEEM_JWT_RATE=0)
+
+    for body in ([], "x", 5, None):
+        assert out[f"redeem body {body!r}"] == (400, {"ok": False, "error": "bad_json"})
+        assert out[f"batch body {body!r}"] == (400, {"ok": False, "error": "bad_json"})
+    for token in (5, [], {}, True, ""):
+        assert out[f"redeem token {token!r}"] == (400, {"ok": False, "error": "missing_jwt_or_token"})
+
+    status, body = out["batch items"]
+    assert status == 200
+    assert [r["status"] for r in body["results"]] == ["bad_token"] * 4 + ["not_found", "ok"]
+    assert out["redeem used"] == (400, {"ok": False, "error": "already_used"})
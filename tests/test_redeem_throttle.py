@@ -0,0 +1,21 @@
+"""
+Лимит /redeem после пачки больше burst: ведро уходит в долг, и запись в кэше живёт, пока долг не погашен,
+а не burst / rate — иначе следующий запрос получал бы новое полное ведро.
+"""
+
+RATE, BURST, BATCH = 10.0, 5, 50
+
+
+def _throttle(main):
+    clock = [1000.0]
+    main.time.monotonic = lambda: clock[0]
+    cache = main.TTLCache(16)
+    out = [main.redeem_throttled(cache, "jwt", RATE, BURST, BATCH)]
+    for t in (1.0, 2.0, 4.0, 4.6):  # долг 45 токенов гасится за 4.5 с
+        clock[0] = 1000.0 + t
+        out.append(main.redeem_throttled(cache, "jwt", RATE, BURST))
+    return out
+
+
+def test_batch_debt_outlives_burst_window(run_main):
+    assert run_main(_throttle, init=False) == [False, True, True, True, False]